@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+import redis_client
+from config import SHORT_CODE_ALLOCATOR, SHORT_CODE_LENGTH, SHORT_CODE_BLOCK_SIZE, SHORT_CODE_KEY
+from database import SessionLocal
+from models import CodeSequence
+from utils import encode_base62, generate_short_code, permute
+
+SEQUENCE_NAME = "short_code"
+
+
+class RedisBlockSource:
+    def __init__(self, key: str = f"seq:{SEQUENCE_NAME}"):
+        self.key = key
+
+    async def lease(self, size: int) -> int:
+        end = await redis_client.r.incrby(self.key, size)
+        return end - size
+
+
+class DatabaseBlockSource:
+    def __init__(self, name: str = SEQUENCE_NAME, session_factory=SessionLocal):
+        self.name = name
+        self.session_factory = session_factory
+
+    async def lease(self, size: int) -> int:
+        async with self.session_factory() as db:
+            # the UPDATE takes the row (or database) write lock, so the value
+            # read back inside the same transaction is ours alone
+            result = await db.execute(
+                update(CodeSequence)
+                .where(CodeSequence.name == self.name)
+                .values(value=CodeSequence.value + size)
+            )
+            if result.rowcount == 0:
+                db.add(CodeSequence(name=self.name, value=size))
+                try:
+                    await db.commit()
+                except IntegrityError:
+                    await db.rollback()
+                    return await self.lease(size)
+                return 0
+            end = (await db.execute(select(CodeSequence.value).where(CodeSequence.name == self.name))).scalar_one()
+            await db.commit()
+            return end - size
+
+
+# Hands out sequence numbers from a leased block and maps each one to a
+# fixed-width base62 code through a keyed permutation, so generating a code
+# never needs a lookup and consecutive codes do not look sequential.
+class LeasedBlockAllocator:
+    def __init__(self, source, block_size: int, length: int, key: str):
+        self.source = source
+        self.block_size = block_size
+        self.length = length
+        self.domain = 62 ** length
+        self.key = hashlib.blake2b(key.encode(), digest_size=32).digest()
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def _lease(self):
+        async with self._lock:
+            if self._next < self._end:
+                return
+            start = await self.source.lease(self.block_size)
+            if start + self.block_size > self.domain:
+                raise RuntimeError("short code space exhausted, increase SHORT_CODE_LENGTH")
+            self._next, self._end = start, start + self.block_size
+
+    async def next_code(self) -> str:
+        while self._next >= self._end:
+            await self._lease()
+        number = self._next
+        self._next += 1
+        return encode_base62(permute(number, self.domain, self.key), self.length)
+
+    async def next_codes(self, count: int) -> list:
+        # whatever is left of the current block, then one lease for the rest
+        numbers = list(range(self._next, min(self._end, self._next + count)))
+        self._next += len(numbers)
+        missing = count - len(numbers)
+        if missing:
+            start = await self.source.lease(missing)
+            if start + missing > self.domain:
+                raise RuntimeError("short code space exhausted, increase SHORT_CODE_LENGTH")
+            numbers.extend(range(start, start + missing))
+        return [encode_base62(permute(n, self.domain, self.key), self.length) for n in numbers]
+
+
+class RandomAllocator:
+    def __init__(self, length: int):
+        self.length = length
+
+    async def next_code(self) -> str:
+        return generate_short_code(self.length)
+
+    async def next_codes(self, count: int) -> list:
+        return [generate_short_code(self.length) for _ in range(count)]
+
+
+def build_allocator(kind: str = SHORT_CODE_ALLOCATOR):
+    if kind == "redis":
+        return LeasedBlockAllocator(RedisBlockSource(), SHORT_CODE_BLOCK_SIZE, SHORT_CODE_LENGTH, SHORT_CODE_KEY)
+    if kind == "db":
+        return LeasedBlockAllocator(DatabaseBlockSource(), SHORT_CODE_BLOCK_SIZE, SHORT_CODE_LENGTH, SHORT_CODE_KEY)
+    if kind == "random":
+        return RandomAllocator(SHORT_CODE_LENGTH)
+    raise ValueError(f"Unknown short code allocator: {kind}")
+
+
+allocator = build_allocator()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, delete, func, text
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import CLICK_ROLLUP_INTERVAL_MS, CLICK_ROLLUP_BATCH_SIZE
+from database import SessionLocal
+from models import ClickEvent, ClickRollup
+
+logger = logging.getLogger(__name__)
+
+GRANULARITIES = ("minute", "hour", "day")
+DEFAULT_BUCKETS = {
+    "minute": timedelta(hours=1),
+    "hour": timedelta(days=2),
+    "day": timedelta(days=30),
+}
+
+
+def to_naive_utc(moment: datetime) -> datetime:
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def truncate(moment: datetime, granularity: str) -> datetime:
+    moment = moment.replace(second=0, microsecond=0)
+    if granularity in ("hour", "day"):
+        moment = moment.replace(minute=0)
+    if granularity == "day":
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def _upsert(dialect: str):
+    # insert a rollup row or add to the count already there
+    if dialect == "mysql":
+        stmt = mysql.insert(ClickRollup)
+        return stmt.on_duplicate_key_update(count=ClickRollup.count + stmt.inserted.count)
+    if dialect == "postgresql":
+        stmt = postgresql.insert(ClickRollup)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(ClickRollup)
+    else:
+        raise NotImplementedError(f"Click rollups need an upsert for {dialect}")
+    return stmt.on_conflict_do_update(
+        index_elements=[ClickRollup.link_id, ClickRollup.granularity, ClickRollup.bucket_start],
+        set_={"count": ClickRollup.count + stmt.excluded.count},
+    )
+
+
+async def delete_click_history(db: AsyncSession, link_ids):
+    # part of the caller's transaction
+    await db.execute(delete(ClickEvent).where(ClickEvent.link_id.in_(link_ids)))
+    await db.execute(delete(ClickRollup).where(ClickRollup.link_id.in_(link_ids)))
+
+
+async def rollup_events(db: AsyncSession, batch_size: int = CLICK_ROLLUP_BATCH_SIZE) -> int:
+    # every worker runs this job: the row locks claim the batch, so a
+    # concurrent run skips to other events instead of counting these twice.
+    # SQLite has no row locks and pysqlite opens no transaction for a SELECT,
+    # so take the write lock before reading; an overlapping run then waits and
+    # reads the batch already gone.
+    if db.bind.dialect.name == "sqlite":
+        await db.execute(text("BEGIN IMMEDIATE"))
+    events = (await db.execute(
+        select(ClickEvent.id, ClickEvent.link_id, ClickEvent.bucket_start, ClickEvent.count)
+        .order_by(ClickEvent.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )).all()
+    if not events:
+        return 0
+    totals = {}
+    for _, link_id, bucket_start, count in events:
+        for granularity in GRANULARITIES:
+            key = (link_id, granularity, truncate(bucket_start, granularity))
+            totals[key] = totals.get(key, 0) + count
+
+    await db.execute(_upsert(db.bind.dialect.name), [
+        {"link_id": link_id, "granularity": granularity, "bucket_start": bucket_start, "count": count}
+        for (link_id, granularity, bucket_start), count in totals.items()
+    ])
+    # exactly the claimed rows: an id range could take in events committed
+    # after the SELECT, or rows another run has claimed
+    await db.execute(delete(ClickEvent).where(ClickEvent.id.in_([event_id for event_id, *_ in events])))
+    await db.commit()
+    return len(events)
+
+
+async def click_series(db: AsyncSession, link_id: int, granularity: str, start: datetime, end: datetime):
+    result = await db.execute(
+        select(ClickRollup.bucket_start, ClickRollup.count)
+        .where(
+            ClickRollup.link_id == link_id,
+            ClickRollup.granularity == granularity,
+            ClickRollup.bucket_start >= truncate(start, granularity),
+            ClickRollup.bucket_start <= end,
+        )
+        .order_by(ClickRollup.bucket_start)
+    )
+    return [{"bucket_start": bucket_start, "count": count} for bucket_start, count in result.all()]
+
+
+async def hot_link_ids(db: AsyncSession, since: datetime, limit: int) -> list:
+    total = func.sum(ClickRollup.count)
+    result = await db.execute(
+        select(ClickRollup.link_id)
+        .where(ClickRollup.granularity == "hour", ClickRollup.bucket_start >= truncate(since, "hour"))
+        .group_by(ClickRollup.link_id)
+        .order_by(total.desc())
+        .limit(limit)
+    )
+    return result.scalars().all()
+
+
+# Periodically folds the click_events log into the minute/hour/day rollups,
+# a bounded batch per transaction.
+class RollupJob:
+    def __init__(self, interval_ms: int, batch_size: int, session_factory=SessionLocal):
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self._stopping = None
+        self._task = None
+
+    async def run_once(self) -> int:
+        folded = 0
+        while True:
+            async with self.session_factory() as db:
+                count = await rollup_events(db, self.batch_size)
+            folded += count
+            if count < self.batch_size:
+                return folded
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Click rollup failed, events kept for the next run")
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+
+rollups = RollupJob(CLICK_ROLLUP_INTERVAL_MS, CLICK_ROLLUP_BATCH_SIZE)
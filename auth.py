@@ -1,25 +1,101 @@
+import time
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import (SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES,
+                    PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL, PRINCIPAL_INVALIDATION_CHANNEL)
 from schemas import TokenData
 from models import User
-from database import SessionLocal
+from database import SessionLocal, ReplicaSessionLocal
+import cache
+import redis_client
 
-from passlib.context import CryptContext
+import hashing
+import metrics
+from hashing import pwd_context
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
+
+# Verified principals keyed by bearer token, so repeat requests skip both the
+# JWT signature check and the user query. Revoking a username rejects every
+# entry cached before the revocation.
+class PrincipalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.ttl = ttl
+        self._entries = cache.LocalCache(maxsize, ttl)
+        self._revoked = {}
+
+    def get(self, token: str):
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        cached_at, user = entry
+        revoked_at = self._revoked.get(user.username)
+        if revoked_at is not None and cached_at <= revoked_at:
+            self._entries.delete(token)
+            return None
+        return user
+
+    def set(self, token: str, user: User, ttl: float = None):
+        self._entries.set(token, (time.monotonic(), user), ttl)
+
+    def revoke(self, username: str):
+        now = time.monotonic()
+        # revocations older than the TTL cannot match a live entry any more
+        self._revoked = {name: at for name, at in self._revoked.items() if now - at < self.ttl}
+        self._revoked[username] = now
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return self._entries.stats()
+
+
+principals = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+principal_listener = cache.InvalidationListener(PRINCIPAL_INVALIDATION_CHANNEL, principals.revoke, principals.clear)
+
+
+async def invalidate_user(username: str):
+    principals.revoke(username)
+    await redis_client.r.publish(PRINCIPAL_INVALIDATION_CHANNEL, username)
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _hashing_unavailable():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many password operations in progress, retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+_bcrypt_latency = {operation: metrics.bcrypt_latency.labels(operation) for operation in metrics.HASH_OPERATIONS}
+
+async def _run_bcrypt(operation, func, *args):
+    started = time.perf_counter()
+    try:
+        result = await hashing.pool.run(func, *args)
+    except hashing.PoolSaturated:
+        metrics.bcrypt_rejected.inc()
+        raise _hashing_unavailable()
+    _bcrypt_latency[operation].observe(time.perf_counter() - started)
+    return result
+
+async def verify_password_async(plain_password, hashed_password):
+    return await _run_bcrypt("verify", hashing.check_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await _run_bcrypt("hash", hashing.hash_password, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -30,19 +106,24 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
+
+async def get_read_db():
+    async with ReplicaSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(User).filter(User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     if not token:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Not authenticated")
+    user = principals.get(token)
+    if user is not None:
+        return user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -56,15 +137,18 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         token_data = TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = get_user_by_username(db, username=token_data.username)
+    user = await get_user_by_username(db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    expires_in = payload.get("exp", 0) - time.time()
+    if expires_in > 0:
+        principals.set(token, user, expires_in)
     return user
 
-def get_current_user_optional(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user_optional(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     if token:
         try:
-            return get_current_user(token, db)
+            return await get_current_user(token, db)
         except:
             return None
     return None
\ No newline at end of file
@@ -0,0 +1,304 @@
+import asyncio
+import hashlib
+import logging
+import math
+import uuid
+
+from sqlalchemy import select
+
+import cache
+import redis_client
+from config import (BLOOM_FILTER_BACKEND, BLOOM_FILTER_CAPACITY, BLOOM_FILTER_ERROR_RATE, BLOOM_FILTER_CHANNEL,
+                    BLOOM_FILTER_REBUILD_HOURS)
+from database import SessionLocal
+from models import Link
+
+logger = logging.getLogger(__name__)
+
+BUILD_BATCH_SIZE = 10000
+BUILD_LOCK_TTL = 600
+
+
+def optimal_size(capacity: int, error_rate: float):
+    size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(size / capacity * math.log(2)))
+    return size, hashes
+
+
+def _positions(item: str, size: int, hashes: int):
+    digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+    first, second = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+    return [(first + i * second) % size for i in range(hashes)]
+
+
+# Counting Bloom filter: one saturating byte per slot so codes can be removed
+# again when links are deleted.
+class CountingBloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hashes = optimal_size(capacity, error_rate)
+        self.counters = bytearray(self.size)
+        self.items = 0
+
+    def add(self, item: str):
+        for position in _positions(item, self.size, self.hashes):
+            if self.counters[position] < 255:
+                self.counters[position] += 1
+        self.items += 1
+
+    def remove(self, item: str):
+        positions = _positions(item, self.size, self.hashes)
+        if not all(self.counters[position] for position in positions):
+            return
+        for position in positions:
+            # a saturated counter no longer knows its true count, leave it
+            if self.counters[position] < 255:
+                self.counters[position] -= 1
+        self.items -= 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.counters[position] for position in _positions(item, self.size, self.hashes))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self.counters)
+
+
+# Plain bit-array Bloom filter in one Redis string, shared by every worker.
+# Bits are never cleared, so deleted codes only raise the false-positive rate.
+# The key names the layout, so a deploy with another capacity or error rate
+# builds a fresh bitmap instead of reading the old one at the wrong positions.
+# The bitmap is only trusted while its "ready" marker exists. The marker
+# expires, and workers that don't feed the bitmap drop it, so codes the bitmap
+# missed are added back by a rebuild.
+class RedisBloomFilter:
+    def __init__(self, capacity: int, error_rate: float, prefix: str = "bloom:short_codes"):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size, self.hashes = optimal_size(capacity, error_rate)
+        self.key = f"{prefix}:{self.size}:{self.hashes}"
+        self.ready_key = f"{self.key}:ready"
+
+    async def allocate(self):
+        # the bitmap exists even with no codes, so its absence means eviction
+        await redis_client.r.setbit(self.key, self.size - 1, 0)
+
+    async def add_many(self, items):
+        async with redis_client.r.pipeline(transaction=False) as pipe:
+            for item in items:
+                for position in _positions(item, self.size, self.hashes):
+                    pipe.setbit(self.key, position, 1)
+            await pipe.execute()
+
+    async def contains_many(self, items):
+        # None when the bitmap or its marker is gone: evicted bits would all
+        # read as 0, and without the marker the bitmap may be missing codes
+        async with redis_client.r.pipeline(transaction=False) as pipe:
+            pipe.exists(self.key, self.ready_key)
+            for item in items:
+                for position in _positions(item, self.size, self.hashes):
+                    pipe.getbit(self.key, position)
+            exists, *bits = await pipe.execute()
+        if exists < 2:
+            return None
+        return [all(bits[i:i + self.hashes]) for i in range(0, len(bits), self.hashes)]
+
+    @property
+    def memory_bytes(self) -> int:
+        return math.ceil(self.size / 8)
+
+
+# Short-code membership in front of the cache and the database. Until the
+# filter has been built it answers "maybe" for everything, so a cold or
+# disabled filter never turns a real link into a 404.
+class ShortCodeFilter:
+    def __init__(self, backend: str, capacity: int, error_rate: float, channel: str):
+        if backend not in ("off", "local", "redis"):
+            raise ValueError(f"Unknown bloom filter backend: {backend}")
+        self.backend = backend
+        self.channel = channel
+        self.ready = False
+        self.rejected = 0
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._building = False
+        self._task = None
+        self._shared = RedisBloomFilter(capacity, error_rate)
+        if backend == "local":
+            self._filter = CountingBloomFilter(capacity, error_rate)
+        elif backend == "redis":
+            self._filter = self._shared
+        else:
+            self._filter = None
+
+    async def _load_codes(self, session_factory, sink):
+        count = 0
+        async with session_factory() as db:
+            result = await db.stream_scalars(select(Link.short_code).execution_options(yield_per=BUILD_BATCH_SIZE))
+            async for codes in result.partitions(BUILD_BATCH_SIZE):
+                await sink(codes)
+                count += len(codes)
+        return count
+
+    # Loads from the primary: a lagging replica can miss codes committed before
+    # this worker heard about new ones, and those would 404 until a rebuild.
+    async def build(self, session_factory=SessionLocal):
+        if self._filter is None or self.ready:
+            return
+        self._building = True
+        try:
+            if self.backend == "redis":
+                # only one worker fills the shared filter; the others wait for
+                # its "ready" marker, taking over if the builder died
+                while not await self._shared_ready():
+                    if await redis_client.r.set(f"{self._filter.key}:building", "1", nx=True, ex=BUILD_LOCK_TTL):
+                        await self._filter.allocate()
+                        count = await self._load_codes(session_factory, self._filter.add_many)
+                        await redis_client.r.set(self._filter.ready_key, "1",
+                                                 ex=round(BLOOM_FILTER_REBUILD_HOURS * 3600))
+                        await redis_client.r.delete(f"{self._filter.key}:building")
+                        logger.info("Built shared short code filter with %d codes", count)
+                        break
+                    await asyncio.sleep(0.5)
+            else:
+                async def add_local(codes):
+                    for code in codes:
+                        self._filter.add(code)
+                count = await self._load_codes(session_factory, add_local)
+                logger.info("Built short code filter with %d codes", count)
+        finally:
+            self._building = False
+        self.ready = True
+        logger.info("Short code filter footprint: %s", self.stats())
+
+    async def _shared_ready(self) -> bool:
+        if not await redis_client.r.get(self._filter.ready_key):
+            return False
+        if await redis_client.r.exists(self._filter.key):
+            return True
+        # the bitmap was evicted without its marker
+        await redis_client.r.delete(self._filter.ready_key)
+        return False
+
+    async def _shared_lost(self):
+        # a rebuild sets the bits of every code again on top of the old ones,
+        # so codes already there never read as missing
+        logger.warning("Shared short code filter is gone or stale, rebuilding it")
+        self.ready = False
+        await redis_client.r.delete(self._filter.ready_key)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.build())
+
+    async def retire_shared(self):
+        # codes created by this worker never reach the shared bitmap, so a
+        # worker using it later must rebuild it first
+        if self.backend == "redis":
+            return
+        try:
+            await redis_client.r.delete(self._shared.ready_key)
+        except Exception:
+            logger.warning("Could not mark the shared short code filter stale")
+
+    def start(self):
+        if self._filter is None or self._task is not None:
+            return
+        self._task = asyncio.create_task(self.build())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def might_contain(self, short_code: str) -> bool:
+        if not self.ready:
+            return True
+        if self.backend == "redis":
+            flags = await self._filter.contains_many([short_code])
+            if flags is None:
+                await self._shared_lost()
+                return True
+            found = flags[0]
+        else:
+            found = short_code in self._filter
+        if not found:
+            self.rejected += 1
+        return found
+
+    async def might_contain_many(self, short_codes) -> set:
+        short_codes = list(short_codes)
+        if not self.ready:
+            return set(short_codes)
+        if self.backend == "redis":
+            flags = await self._filter.contains_many(short_codes)
+            if flags is None:
+                await self._shared_lost()
+                return set(short_codes)
+            return {code for code, found in zip(short_codes, flags) if found}
+        return {code for code in short_codes if code in self._filter}
+
+    async def add(self, short_codes):
+        if self._filter is None:
+            return
+        if self.backend == "redis":
+            await self._filter.add_many(short_codes)
+            return
+        for short_code in short_codes:
+            self._filter.add(short_code)
+        await self._publish("+", short_codes)
+
+    async def remove(self, short_codes):
+        if self.backend != "local":
+            return
+        for short_code in short_codes:
+            self._apply_remove(short_code)
+        await self._publish("-", short_codes)
+
+    async def _publish(self, op: str, short_codes):
+        message = " ".join([self.worker_id] + [f"{op}{code}" for code in short_codes])
+        await redis_client.r.publish(self.channel, message)
+
+    def _apply_remove(self, short_code: str):
+        # the build may not have added the code yet; removing it now would
+        # clear slots other codes rely on
+        if not self._building:
+            self._filter.remove(short_code)
+
+    # Updates published by other workers, delivered by the listener.
+    def apply_update(self, message: str):
+        worker_id, *entries = message.split()
+        if worker_id == self.worker_id:
+            return
+        for entry in entries:
+            if entry.startswith("+"):
+                self._filter.add(entry[1:])
+            elif entry.startswith("-"):
+                self._apply_remove(entry[1:])
+
+    def updates_lost(self):
+        # updates may have been missed, stop trusting negative answers
+        if self.ready:
+            logger.warning("Short code filter lost its update stream, disabling it")
+        self.ready = False
+
+    def stats(self) -> dict:
+        if self._filter is None:
+            return {"backend": self.backend}
+        return {
+            "backend": self.backend,
+            "ready": self.ready,
+            "capacity": self._filter.capacity,
+            "error_rate": self._filter.error_rate,
+            "slots": self._filter.size,
+            "hashes": self._filter.hashes,
+            "memory_bytes": self._filter.memory_bytes,
+            "rejected": self.rejected,
+        }
+
+
+codes = ShortCodeFilter(BLOOM_FILTER_BACKEND, BLOOM_FILTER_CAPACITY, BLOOM_FILTER_ERROR_RATE, BLOOM_FILTER_CHANNEL)
+listener = cache.InvalidationListener(BLOOM_FILTER_CHANNEL, codes.apply_update, codes.updates_lost)
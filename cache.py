@@ -0,0 +1,288 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Optional
+
+import redis_client
+from config import (LINK_CACHE_TTL, LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL, LINK_INVALIDATION_CHANNEL,
+                    NEGATIVE_CACHE_TTL, SINGLE_FLIGHT_LOCK_TTL_MS)
+
+logger = logging.getLogger(__name__)
+
+
+# Negative entries share the link key, so a later create or update only has
+# to invalidate one key.
+NOT_FOUND = "!404"
+EXPIRED = "!410"
+
+
+def link_cache_key(short_code: str) -> str:
+    return f"link:{short_code}"
+
+
+def fill_lock_key(short_code: str) -> str:
+    return f"lock:link:{short_code}"
+
+
+def _expiry_timestamp(expires_at: Optional[datetime]) -> Optional[float]:
+    if expires_at is None:
+        return None
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at.timestamp()
+
+
+# Cached value is a compact JSON array [link_id, expires_ts, original_url,
+# permanent] so a cache hit can redirect, enforce expiry, pick the redirect
+# policy and count the click without SQL.
+def dump_link(link) -> str:
+    return json.dumps([link.id, _expiry_timestamp(link.expires_at), link.original_url, int(bool(link.permanent))],
+                      separators=(",", ":"))
+
+
+def load_link(raw):
+    if raw in (NOT_FOUND, EXPIRED):
+        return raw
+    if not raw or not raw.startswith("["):
+        return None
+    try:
+        # entries written before the permanent flag existed are triples
+        link_id, expires_ts, original_url, permanent = (json.loads(raw) + [0])[:4]
+    except ValueError:
+        return None
+    return link_id, expires_ts, original_url, bool(permanent)
+
+
+def is_expired(expires_ts: Optional[float], now: float = None) -> bool:
+    if expires_ts is None:
+        return False
+    return (now or time.time()) > expires_ts
+
+
+def link_ttl(link, now: float = None) -> int:
+    expires_ts = _expiry_timestamp(link.expires_at)
+    if expires_ts is None:
+        return LINK_CACHE_TTL
+    return min(LINK_CACHE_TTL, int(expires_ts - (now or time.time())))
+
+
+# Per-worker LRU with a TTL, sitting in front of Redis for the hottest codes.
+class LocalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# Subscribes to a pub/sub channel and hands every message to `on_message`.
+# `on_lost` runs whenever the subscription drops, since messages published
+# meanwhile are gone. For links every worker drops its local copy when a link
+# is updated or deleted anywhere, and its whole cache when the stream breaks.
+class InvalidationListener:
+    def __init__(self, channel: str, on_message, on_lost):
+        self.channel = channel
+        self.on_message = on_message
+        self.on_lost = on_lost
+        self._pubsub = None
+        self._stopping = False
+        self._task = None
+
+    async def start(self):
+        if self._task is not None:
+            return
+        self._pubsub = redis_client.r.pubsub(ignore_subscribe_messages=True)
+        await self._pubsub.subscribe(self.channel)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception:
+                logger.exception("Invalidation listener lost its subscription")
+                self.on_lost()
+                await asyncio.sleep(1.0)
+                continue
+            if message and message["type"] == "message":
+                self.on_message(message["data"])
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping = True
+        await self._task
+        self._task = None
+        await self._pubsub.aclose()
+        self._pubsub = None
+
+
+local = LocalCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+listener = InvalidationListener(LINK_INVALIDATION_CHANNEL, local.delete, local.clear)
+
+
+async def get_link(short_code: str):
+    cached = local.get(short_code)
+    if cached is not None:
+        return cached
+    cached = load_link(await redis_client.link_store().get(link_cache_key(short_code)))
+    if cached:
+        local.set(short_code, cached)
+    return cached
+
+
+async def set_link(short_code: str, link, ttl: int):
+    record = dump_link(link)
+    await redis_client.link_store().set(link_cache_key(short_code), record, ex=ttl)
+    cached = load_link(record)
+    local.set(short_code, cached, ttl)
+    return cached
+
+
+async def set_negative(short_code: str, marker: str):
+    ttl = LINK_CACHE_TTL if marker == EXPIRED else NEGATIVE_CACHE_TTL
+    await redis_client.link_store().set(link_cache_key(short_code), marker, ex=ttl)
+    local.set(short_code, marker, ttl)
+    return marker
+
+
+async def set_links(links) -> int:
+    stored = 0
+    async with redis_client.link_store().pipeline(transaction=False) as pipe:
+        for link in links:
+            ttl = link_ttl(link)
+            if ttl > 0:
+                record = dump_link(link)
+                pipe.set(link_cache_key(link.short_code), record, ex=ttl)
+                local.set(link.short_code, load_link(record), ttl)
+                stored += 1
+        await pipe.execute()
+    return stored
+
+
+async def load_local(short_codes) -> int:
+    # fills this worker's cache from Redis in one pipelined round trip
+    async with redis_client.link_store().pipeline(transaction=False) as pipe:
+        for short_code in short_codes:
+            pipe.get(link_cache_key(short_code))
+        records = await pipe.execute()
+    loaded = 0
+    for short_code, record in zip(short_codes, records):
+        cached = load_link(record)
+        if isinstance(cached, tuple):
+            local.set(short_code, cached)
+            loaded += 1
+    return loaded
+
+
+async def invalidate_link(short_code: str):
+    local.delete(short_code)
+    await redis_client.link_store().delete(link_cache_key(short_code))
+    await redis_client.r.publish(LINK_INVALIDATION_CHANNEL, short_code)
+
+
+async def invalidate_links(short_codes):
+    for short_code in short_codes:
+        local.delete(short_code)
+    async with redis_client.link_store().pipeline(transaction=False) as pipe:
+        for short_code in short_codes:
+            pipe.delete(link_cache_key(short_code))
+        await pipe.execute()
+    # invalidations always go over the primary node, where every worker listens
+    async with redis_client.r.pipeline(transaction=False) as pipe:
+        for short_code in short_codes:
+            pipe.publish(LINK_INVALIDATION_CHANNEL, short_code)
+        await pipe.execute()
+
+
+# Coalesces concurrent cache fills for the same code within this worker: the
+# first caller runs the loader, everyone else awaits its result.
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, loader):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(loader())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        else:
+            self.coalesced += 1
+        # shielded so one cancelled waiter does not cancel the shared load
+        return await asyncio.shield(task)
+
+
+single_flight = SingleFlight()
+
+
+async def acquire_fill_lock(short_code: str) -> bool:
+    return bool(await redis_client.link_store().set(fill_lock_key(short_code), "1", nx=True, px=SINGLE_FLIGHT_LOCK_TTL_MS))
+
+
+async def release_fill_lock(short_code: str):
+    await redis_client.link_store().delete(fill_lock_key(short_code))
+
+
+async def wait_for_fill(short_code: str, poll_interval: float = 0.02):
+    deadline = time.monotonic() + SINGLE_FLIGHT_LOCK_TTL_MS / 1000
+    while time.monotonic() < deadline:
+        await asyncio.sleep(poll_interval)
+        cached = load_link(await redis_client.link_store().get(link_cache_key(short_code)))
+        if cached:
+            local.set(short_code, cached)
+            return cached
+    return None
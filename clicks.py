@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+import crud
+from config import CLICK_FLUSH_INTERVAL_MS, CLICK_FLUSH_MAX_EVENTS
+from database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+# Redirects only add to in-memory per-link deltas; the flusher writes them
+# to `links` as one batched UPDATE every interval or every N events, and
+# appends per-minute counts to the click_events log for the rollup job.
+class ClickBuffer:
+    def __init__(self, flush_interval_ms: int, flush_max_events: int, session_factory=SessionLocal):
+        self.flush_interval = flush_interval_ms / 1000
+        self.flush_max_events = flush_max_events
+        self.session_factory = session_factory
+        self._pending = {}
+        self._buckets = {}
+        self._events = 0
+        self._oldest = None
+        self._wakeup = None
+        self._stopping = False
+        self._task = None
+
+    @property
+    def pending_events(self) -> int:
+        return self._events
+
+    async def record(self, link_id: int, accessed_at: datetime = None):
+        accessed_at = accessed_at or datetime.utcnow()
+        delta, last = self._pending.get(link_id, (0, accessed_at))
+        self._pending[link_id] = (delta + 1, max(last, accessed_at))
+        bucket = (link_id, accessed_at.replace(second=0, microsecond=0))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        self._events += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if self._events >= self.flush_max_events:
+            if self._task is not None:
+                self._wakeup.set()
+            else:
+                await self.flush()
+
+    # Draining and restoring never await, so concurrent flushes on the same
+    # loop always work on disjoint sets of deltas.
+    def _drain(self):
+        pending, self._pending = self._pending, {}
+        buckets, self._buckets = self._buckets, {}
+        self._events = 0
+        self._oldest = None
+        return pending, buckets
+
+    def _restore(self, pending: dict, buckets: dict):
+        for link_id, (delta, last) in pending.items():
+            current_delta, current_last = self._pending.get(link_id, (0, last))
+            self._pending[link_id] = (current_delta + delta, max(current_last, last))
+            self._events += delta
+        for bucket, count in buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    async def flush(self) -> int:
+        pending, buckets = self._drain()
+        if not pending:
+            return 0
+        try:
+            async with self.session_factory() as db:
+                return await crud.apply_click_deltas(db, pending, buckets)
+        except Exception:
+            self._restore(pending, buckets)
+            raise
+
+    async def flush_if_stale(self, max_staleness_ms: int):
+        oldest = self._oldest
+        if oldest is None:
+            return 0
+        if (time.monotonic() - oldest) * 1000 >= max_staleness_ms:
+            return await self.flush()
+        return 0
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Click flush failed, deltas kept for the next attempt")
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+
+buffer = ClickBuffer(CLICK_FLUSH_INTERVAL_MS, CLICK_FLUSH_MAX_EVENTS)
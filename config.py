@@ -1,10 +1,113 @@
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./test.db")
+READ_REPLICA_URL = os.getenv("READ_REPLICA_URL")
+DB_POOL_SIZE = os.getenv("DB_POOL_SIZE")
+DB_MAX_OVERFLOW = os.getenv("DB_MAX_OVERFLOW")
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
 SECRET_KEY = os.getenv("SECRET_KEY", "supersecretkey")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
-REDIS_DB = int(os.getenv("REDIS_DB", 0))
\ No newline at end of file
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# comma-separated redis:// URLs; link cache keys are spread over them by
+# consistent hashing, everything else stays on REDIS_HOST
+REDIS_CACHE_NODES = [node.strip() for node in os.getenv("REDIS_CACHE_NODES", "").split(",") if node.strip()]
+REDIS_CACHE_VNODES = int(os.getenv("REDIS_CACHE_VNODES", 160))
+
+CLICK_FLUSH_INTERVAL_MS = int(os.getenv("CLICK_FLUSH_INTERVAL_MS", 1000))
+CLICK_FLUSH_MAX_EVENTS = int(os.getenv("CLICK_FLUSH_MAX_EVENTS", 500))
+# Only the worker serving /stats flushes its own buffer before reading; clicks
+# held by other workers reach the database within CLICK_FLUSH_INTERVAL_MS, so
+# that interval is the real staleness bound and this one is clamped to it.
+CLICK_STATS_WORKER_STALENESS_MS = min(
+    int(os.getenv("CLICK_STATS_WORKER_STALENESS_MS", os.getenv("CLICK_STATS_MAX_STALENESS_MS", 0))),
+    CLICK_FLUSH_INTERVAL_MS,
+)
+
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", 60 * 60))
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", 4096))
+LOCAL_CACHE_TTL = float(os.getenv("LOCAL_CACHE_TTL", 30))
+LINK_INVALIDATION_CHANNEL = os.getenv("LINK_INVALIDATION_CHANNEL", "link-invalidations")
+
+SHORT_CODE_ALLOCATOR = os.getenv("SHORT_CODE_ALLOCATOR", "db")
+SHORT_CODE_LENGTH = int(os.getenv("SHORT_CODE_LENGTH", 6))
+SHORT_CODE_BLOCK_SIZE = int(os.getenv("SHORT_CODE_BLOCK_SIZE", 1000))
+SHORT_CODE_KEY = os.getenv("SHORT_CODE_KEY", SECRET_KEY)
+
+BATCH_SHORTEN_MAX_ITEMS = int(os.getenv("BATCH_SHORTEN_MAX_ITEMS", 5000))
+
+CLICK_ROLLUP_INTERVAL_MS = int(os.getenv("CLICK_ROLLUP_INTERVAL_MS", 10000))
+CLICK_ROLLUP_BATCH_SIZE = int(os.getenv("CLICK_ROLLUP_BATCH_SIZE", 5000))
+
+VISITOR_HLL_BACKEND = os.getenv("VISITOR_HLL_BACKEND", "redis")
+VISITOR_HLL_RETENTION_DAYS = int(os.getenv("VISITOR_HLL_RETENTION_DAYS", 90))
+VISITOR_HLL_MEMORY_MAX_SKETCHES = int(os.getenv("VISITOR_HLL_MEMORY_MAX_SKETCHES", 100000))
+
+SEARCH_DEFAULT_LIMIT = int(os.getenv("SEARCH_DEFAULT_LIMIT", 50))
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", 500))
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+PRINCIPAL_INVALIDATION_CHANNEL = os.getenv("PRINCIPAL_INVALIDATION_CHANNEL", "principal-invalidations")
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", 2))
+HASH_POOL_MAX_QUEUE = int(os.getenv("HASH_POOL_MAX_QUEUE", 32))
+# the server runs threads (thread pools, SQLite, Redis), so plain fork is unsafe
+HASH_POOL_START_METHOD = os.getenv("HASH_POOL_START_METHOD", "forkserver")
+
+EXPIRY_SWEEP_MODE = os.getenv("EXPIRY_SWEEP_MODE", "archive")
+EXPIRY_SWEEP_INTERVAL_MS = int(os.getenv("EXPIRY_SWEEP_INTERVAL_MS", 60000))
+EXPIRY_SWEEP_BATCH_SIZE = int(os.getenv("EXPIRY_SWEEP_BATCH_SIZE", 500))
+EXPIRY_SWEEP_BATCH_PAUSE_MS = int(os.getenv("EXPIRY_SWEEP_BATCH_PAUSE_MS", 100))
+EXPIRED_LINK_RETENTION_HOURS = float(os.getenv("EXPIRED_LINK_RETENTION_HOURS", 24))
+
+NEGATIVE_CACHE_TTL = int(os.getenv("NEGATIVE_CACHE_TTL", 30))
+SINGLE_FLIGHT_REDIS_LOCK = os.getenv("SINGLE_FLIGHT_REDIS_LOCK", "false").lower() == "true"
+SINGLE_FLIGHT_LOCK_TTL_MS = int(os.getenv("SINGLE_FLIGHT_LOCK_TTL_MS", 2000))
+
+BLOOM_FILTER_BACKEND = os.getenv("BLOOM_FILTER_BACKEND", "off")
+BLOOM_FILTER_CAPACITY = int(os.getenv("BLOOM_FILTER_CAPACITY", 1_000_000))
+BLOOM_FILTER_ERROR_RATE = float(os.getenv("BLOOM_FILTER_ERROR_RATE", 0.01))
+BLOOM_FILTER_CHANNEL = os.getenv("BLOOM_FILTER_CHANNEL", "short-code-filter")
+# the shared filter is rebuilt this often, to pick up codes it never heard of
+BLOOM_FILTER_REBUILD_HOURS = float(os.getenv("BLOOM_FILTER_REBUILD_HOURS", 24))
+
+QUERY_TRACE_ENABLED = os.getenv("QUERY_TRACE_ENABLED", "false").lower() == "true"
+QUERY_TRACE_HEADER = os.getenv("QUERY_TRACE_HEADER", "true").lower() == "true"
+QUERY_TRACE_DUPLICATE_THRESHOLD = int(os.getenv("QUERY_TRACE_DUPLICATE_THRESHOLD", 3))
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+IMPORT_MAX_LINE_LENGTH = int(os.getenv("IMPORT_MAX_LINE_LENGTH", 64 * 1024))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+TRANSFER_PROGRESS_EVERY = int(os.getenv("TRANSFER_PROGRESS_EVERY", 50000))
+
+MIGRATE_ON_STARTUP = os.getenv("MIGRATE_ON_STARTUP", "false").lower() == "true"
+CACHE_WARMUP_SOURCE = os.getenv("CACHE_WARMUP_SOURCE", "clicks")
+CACHE_WARMUP_SIZE = int(os.getenv("CACHE_WARMUP_SIZE", 1000))
+CACHE_WARMUP_WINDOW_HOURS = int(os.getenv("CACHE_WARMUP_WINDOW_HOURS", 24))
+CACHE_WARMUP_TIMEOUT_MS = int(os.getenv("CACHE_WARMUP_TIMEOUT_MS", 5000))
+CACHE_WARMUP_LOCK_TTL = int(os.getenv("CACHE_WARMUP_LOCK_TTL", 300))
+
+REDIRECT_FAST_PATH = os.getenv("REDIRECT_FAST_PATH", "true").lower() == "true"
+
+REDIRECT_TEMPORARY_STATUS = int(os.getenv("REDIRECT_TEMPORARY_STATUS", 307))
+REDIRECT_TEMPORARY_MAX_AGE = int(os.getenv("REDIRECT_TEMPORARY_MAX_AGE", 60))
+REDIRECT_PERMANENT_MAX_AGE = int(os.getenv("REDIRECT_PERMANENT_MAX_AGE", 31536000))
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# comma separated "METHOD PATH REQUESTS/SECONDS [BURST]", applied per client IP
+RATE_LIMIT_RULES = os.getenv(
+    "RATE_LIMIT_RULES",
+    "POST /links/shorten 60/60 30, POST /links/shorten/batch 20/60 10, POST /links/import 5/60 2, "
+    "POST /token 10/60 10, POST /users/register 10/3600 5",
+)
+RATE_LIMIT_USER_MULTIPLIER = float(os.getenv("RATE_LIMIT_USER_MULTIPLIER", 2))
+RATE_LIMIT_REDIS_TIMEOUT_MS = int(os.getenv("RATE_LIMIT_REDIS_TIMEOUT_MS", 100))
+RATE_LIMIT_REDIS_RETRY_MS = int(os.getenv("RATE_LIMIT_REDIS_RETRY_MS", 5000))
+RATE_LIMIT_LOCAL_SIZE = int(os.getenv("RATE_LIMIT_LOCAL_SIZE", 10000))
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", 512))
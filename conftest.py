@@ -0,0 +1,9 @@
+import migrations
+import ratelimit
+
+
+def pytest_configure(config):
+    # the app no longer migrates on import; bring test.db up to date once
+    migrations.upgrade()
+    # the suites share one client address; tests/test_ratelimit.py turns limits back on
+    ratelimit.enabled = False
@@ -1,7 +1,13 @@
-from sqlalchemy.orm import Session
-from models import Link, User
+import base64
+from sqlalchemy import select, insert, update, bindparam, func, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Link, User, ClickEvent, ReservedCode
 from schemas import LinkCreate, LinkUpdate
-from utils import generate_short_code
+import allocator
+import analytics
+import bloom
+from utils import url_hash, url_domain
 from datetime import datetime
 from pydantic import HttpUrl
 
@@ -11,60 +17,270 @@ def normalize_url(url: str) -> str:
     except Exception:
         return url
 
-def create_link(db: Session, link_in: LinkCreate, owner_id: int = None):
-    short_code = link_in.custom_alias if link_in.custom_alias else generate_short_code()
-    while db.query(Link).filter(Link.short_code == short_code).first():
-        short_code = generate_short_code()
+def url_fields(normalized_url: str) -> dict:
+    return {
+        "original_url": normalized_url,
+        "url_hash": url_hash(normalized_url),
+        "domain": url_domain(normalized_url),
+    }
 
+class ShortCodeTaken(Exception):
+    pass
+
+class PermanentLink(Exception):
+    pass
+
+PERMANENT_EXPIRY_ERROR = "Permanent links cannot expire"
+
+MAX_CODE_ATTEMPTS = 5
+
+async def create_link(db: AsyncSession, link_in: LinkCreate, owner_id: int = None):
     normalized_url = normalize_url(str(link_in.original_url))
-    link = Link(
-        original_url=normalized_url,
-        short_code=short_code,
-        expires_at=link_in.expires_at,
-        owner_id=owner_id
-    )
-    db.add(link)
-    db.commit()
-    db.refresh(link)
-    return link
+    # The unique index on short_code is the only conflict check: a taken
+    # custom alias is reported, a generated code that hits a legacy or custom
+    # code just moves on to the next one.
+    for _ in range(MAX_CODE_ATTEMPTS):
+        short_code = link_in.custom_alias or await allocator.allocator.next_code()
+        if await reserved_short_codes(db, [short_code]):
+            if link_in.custom_alias:
+                break
+            continue
+        link = Link(
+            **url_fields(normalized_url),
+            short_code=short_code,
+            expires_at=link_in.expires_at,
+            owner_id=owner_id,
+            permanent=link_in.permanent,
+        )
+        db.add(link)
+        try:
+            await db.commit()
+        except IntegrityError:
+            await db.rollback()
+            if link_in.custom_alias:
+                break
+            continue
+        await db.refresh(link)
+        return link
+    raise ShortCodeTaken(short_code)
+
+IN_CLAUSE_CHUNK = 500
 
-def get_link_by_code(db: Session, short_code: str):
-    return db.query(Link).filter(Link.short_code == short_code).first()
+async def reserved_short_codes(db: AsyncSession, codes) -> set:
+    codes = list(codes)
+    found = set()
+    for start in range(0, len(codes), IN_CLAUSE_CHUNK):
+        result = await db.execute(select(ReservedCode.short_code)
+                                  .where(ReservedCode.short_code.in_(codes[start:start + IN_CLAUSE_CHUNK])))
+        found.update(result.scalars())
+    return found
 
-def update_link(db: Session, short_code: str, link_in: LinkUpdate, user: User):
-    link = get_link_by_code(db, short_code)
+async def existing_short_codes(db: AsyncSession, codes) -> set:
+    codes = list(codes)
+    # reserved codes have no link, so the short code filter does not know them
+    found = await reserved_short_codes(db, codes)
+    # codes the short code filter rules out cannot exist, skip their lookup
+    live = list(await bloom.codes.might_contain_many(codes))
+    for start in range(0, len(live), IN_CLAUSE_CHUNK):
+        result = await db.execute(select(Link.short_code).where(Link.short_code.in_(live[start:start + IN_CLAUSE_CHUNK])))
+        found.update(result.scalars())
+    return found
+
+async def create_links_bulk(db: AsyncSession, links_in: list, owner_id: int = None, retry: bool = True,
+                            extra: list = None):
+    errors = {}
+    codes = {}
+    seen_aliases = set()
+    for index, link_in in enumerate(links_in):
+        if link_in.permanent and link_in.expires_at:
+            errors[index] = PERMANENT_EXPIRY_ERROR
+        elif link_in.custom_alias:
+            if link_in.custom_alias in seen_aliases:
+                errors[index] = "Short code already in use"
+            else:
+                seen_aliases.add(link_in.custom_alias)
+                codes[index] = link_in.custom_alias
+
+    pending = [index for index, link_in in enumerate(links_in) if not link_in.custom_alias and index not in errors]
+    for _ in range(MAX_CODE_ATTEMPTS):
+        if pending:
+            for index, short_code in zip(pending, await allocator.allocator.next_codes(len(pending))):
+                codes[index] = short_code
+        taken = await existing_short_codes(db, codes.values())
+        pending = []
+        for index, short_code in list(codes.items()):
+            if short_code in taken:
+                del codes[index]
+                if links_in[index].custom_alias:
+                    errors[index] = "Short code already in use"
+                else:
+                    pending.append(index)
+        if not pending:
+            break
+    for index in pending:
+        errors[index] = "Could not allocate a short code"
+
+    indexes = sorted(codes)
+    rows = [
+        {
+            **url_fields(normalize_url(str(links_in[index].original_url))),
+            "short_code": codes[index],
+            "expires_at": links_in[index].expires_at,
+            "owner_id": owner_id,
+            "permanent": links_in[index].permanent,
+            **(extra[index] if extra else {}),
+        }
+        for index in indexes
+    ]
+    created = {}
+    if rows:
+        try:
+            result = await db.scalars(insert(Link).returning(Link, sort_by_parameter_order=True), rows)
+            created = dict(zip(indexes, result.all()))
+            await db.commit()
+        except IntegrityError:
+            # an alias was taken between the check and the insert
+            await db.rollback()
+            if not retry:
+                raise ShortCodeTaken()
+            return await create_links_bulk(db, links_in, owner_id, retry=False, extra=extra)
+    return [(created.get(index), errors.get(index)) for index in range(len(links_in))]
+
+async def get_link_by_code(db: AsyncSession, short_code: str):
+    result = await db.execute(select(Link).where(Link.short_code == short_code))
+    return result.scalars().first()
+
+async def update_link(db: AsyncSession, short_code: str, link_in: LinkUpdate, user: User):
+    link = await get_link_by_code(db, short_code)
     if not link:
         return None
     if link.owner_id != user.id:
         return None
+    if link.permanent:
+        raise PermanentLink(short_code)
     if link_in.original_url:
-        link.original_url = normalize_url(str(link_in.original_url))
+        for field, value in url_fields(normalize_url(str(link_in.original_url))).items():
+            setattr(link, field, value)
     if link_in.expires_at:
         link.expires_at = link_in.expires_at
-    db.commit()
-    db.refresh(link)
+    # validators handed out for this link (stats ETags) change with it
+    link.version = (link.version or 1) + 1
+    await db.commit()
+    await db.refresh(link)
     return link
 
-def delete_link(db: Session, short_code: str, user: User):
-    link = get_link_by_code(db, short_code)
+async def delete_link(db: AsyncSession, short_code: str, user: User):
+    link = await get_link_by_code(db, short_code)
     if not link:
         return None
     if link.owner_id != user.id:
         return None
-    db.delete(link)
-    db.commit()
+    # clients may still hold a permanent link's 301, so its code stays taken
+    if link.permanent:
+        db.add(ReservedCode(short_code=link.short_code, link_id=link.id))
+    await analytics.delete_click_history(db, [link.id])
+    await db.delete(link)
+    await db.commit()
     return link
 
-def increment_click(db: Session, link: Link):
-    link.click_count += 1
-    link.last_accessed = datetime.utcnow()
-    db.commit()
-    db.refresh(link)
-    return link
+async def apply_click_deltas(db: AsyncSession, deltas: dict, buckets: dict = None):
+    if not deltas:
+        return 0
+    links = Link.__table__
+    stmt = (
+        update(links)
+        .where(links.c.id == bindparam("link_id"))
+        .values(
+            click_count=func.coalesce(links.c.click_count, 0) + bindparam("delta"),
+            last_accessed=bindparam("accessed_at"),
+        )
+    )
+    rows = [
+        {"link_id": link_id, "delta": delta, "accessed_at": accessed_at}
+        for link_id, (delta, accessed_at) in deltas.items()
+    ]
+    await db.execute(stmt, rows)
+    if buckets:
+        await db.execute(insert(ClickEvent), [
+            {"link_id": link_id, "bucket_start": bucket_start, "count": count}
+            for (link_id, bucket_start), count in buckets.items()
+        ])
+    await db.commit()
+    return len(rows)
 
-def get_link_stats(db: Session, short_code: str):
-    return get_link_by_code(db, short_code)
+async def get_link_stats(db: AsyncSession, short_code: str):
+    return await get_link_by_code(db, short_code)
 
-def search_link_by_original(db: Session, original_url: str):
+def _page(query, limit: int, after_id: int = None):
+    if after_id is not None:
+        query = query.where(Link.id > after_id)
+    return query.order_by(Link.id).limit(limit)
+
+async def search_link_by_original(db: AsyncSession, original_url: str, limit: int = 50, after_id: int = None):
     normalized = normalize_url(original_url)
-    return db.query(Link).filter(Link.original_url == normalized).all()
\ No newline at end of file
+    query = select(Link).where(Link.url_hash == url_hash(normalized), Link.original_url == normalized)
+    result = await db.execute(_page(query, limit, after_id))
+    return result.scalars().all()
+
+async def search_links_by_domain(db: AsyncSession, domain: str, limit: int = 50, after_id: int = None):
+    query = select(Link).where(Link.domain == domain.lower())
+    result = await db.execute(_page(query, limit, after_id))
+    return result.scalars().all()
+
+async def search_links_by_prefix(db: AsyncSession, prefix: str, limit: int = 50, after_id: int = None):
+    # Normalized like the stored URLs, so it needs a scheme and a complete host:
+    # the domain index narrows the scan and the prefix is checked on those rows
+    # only. A partial host such as "https://exam" searches the host "exam".
+    prefix = normalize_url(prefix)
+    domain = url_domain(prefix)
+    if not domain:
+        raise ValueError("prefix has no scheme and host")
+    query = select(Link).where(Link.domain == domain, Link.original_url.startswith(prefix, autoescape=True))
+    result = await db.execute(_page(query, limit, after_id))
+    return result.scalars().all()
+
+USER_LINK_COLUMNS = (Link.id, Link.short_code, Link.original_url, Link.created_at, Link.expires_at,
+                     Link.last_accessed, Link.click_count, func.coalesce(Link.permanent, False).label("permanent"))
+
+def encode_link_cursor(created_at: datetime, link_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{link_id}".encode()).decode()
+
+def decode_link_cursor(cursor: str):
+    try:
+        created_at, link_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(link_id)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("invalid cursor")
+
+def _user_links_query(owner_id: int, after=None):
+    # newest first; walks ix_links_owner_created_id from the cursor onwards
+    query = select(*USER_LINK_COLUMNS).where(Link.owner_id == owner_id)
+    if after is not None:
+        query = query.where(tuple_(Link.created_at, Link.id) < tuple_(*after, types=(Link.created_at.type, Link.id.type)))
+    return query.order_by(Link.created_at.desc(), Link.id.desc())
+
+async def list_user_links(db: AsyncSession, owner_id: int, limit: int, after=None):
+    result = await db.execute(_user_links_query(owner_id, after).limit(limit))
+    return result.all()
+
+async def stream_user_links(db: AsyncSession, owner_id: int, after=None, batch_size: int = 1000):
+    result = await db.stream(_user_links_query(owner_id, after).execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+async def stream_all_links(db: AsyncSession, batch_size: int = 1000):
+    result = await db.stream(select(*USER_LINK_COLUMNS).order_by(Link.id).execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+def _live(query, now: datetime = None):
+    now = now or datetime.utcnow()
+    return query.where((Link.expires_at.is_(None)) | (Link.expires_at > now))
+
+async def top_links_by_clicks(db: AsyncSession, limit: int):
+    result = await db.execute(_live(select(Link)).order_by(Link.click_count.desc()).limit(limit))
+    return result.scalars().all()
+
+async def get_links_by_ids(db: AsyncSession, link_ids: list):
+    result = await db.execute(_live(select(Link).where(Link.id.in_(link_ids))))
+    return result.scalars().all()
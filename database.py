@@ -1,12 +1,108 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker,declarative_base
-
-SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    pool_size=100,
-    max_overflow=30,
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
\ No newline at end of file
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import metrics
+import tracing
+
+from config import (DATABASE_URL, READ_REPLICA_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT,
+                    SQLITE_BUSY_TIMEOUT_MS)
+
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg", "mysql": "aiomysql"}
+# (pool_size, max_overflow) per backend; SQLite serialises writers anyway
+POOL_DEFAULTS = {"sqlite": (20, 10), "postgresql": (20, 30), "mysql": (20, 30)}
+
+
+def async_url(url: str):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if url.get_driver_name() == url.get_dialect().driver and backend in ASYNC_DRIVERS:
+        url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url
+
+
+def sync_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=url.get_backend_name())
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.db_pool_wait.observe(time.perf_counter() - started)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    latency, _ = metrics.sql_verb(statement)
+    latency.observe(elapsed)
+    tracing.record_sql(statement, elapsed)
+
+
+def _handle_error(context):
+    if context.connection is None or not context.connection.info.get("query_started"):
+        return
+    context.connection.info["query_started"].pop()
+    _, errors = metrics.sql_verb(context.statement or "")
+    errors.inc()
+
+
+def instrument(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", _before_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_execute)
+    event.listen(sync_engine, "handle_error", _handle_error)
+
+
+def build_engine(url: str):
+    url = async_url(url)
+    backend = url.get_backend_name()
+    pool_size, max_overflow = POOL_DEFAULTS.get(backend, (20, 30))
+    options = {
+        "pool_size": int(DB_POOL_SIZE or pool_size),
+        "max_overflow": int(DB_MAX_OVERFLOW or max_overflow),
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_pre_ping": backend != "sqlite",
+        "poolclass": TimedQueuePool,
+    }
+    if backend == "sqlite":
+        options["connect_args"] = {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}
+    built = create_async_engine(url, **options)
+    if backend == "sqlite":
+        event.listen(built.sync_engine, "connect", _sqlite_pragmas)
+    instrument(built.sync_engine)
+    return built
+
+
+def build_sessionmaker(bind):
+    return async_sessionmaker(bind, autoflush=False, expire_on_commit=False)
+
+
+engine = build_engine(DATABASE_URL)
+SessionLocal = build_sessionmaker(engine)
+
+# Read-only crud calls go to the replica when one is configured; without one
+# the replica names simply point at the primary.
+replica_engine = build_engine(READ_REPLICA_URL) if READ_REPLICA_URL else engine
+ReplicaSessionLocal = build_sessionmaker(replica_engine) if READ_REPLICA_URL else SessionLocal
+HAS_REPLICA = READ_REPLICA_URL is not None
+
+Base = declarative_base()
@@ -0,0 +1,102 @@
+from functools import lru_cache
+from urllib.parse import quote
+
+import cache
+import clicks
+import httpcache
+import visitors
+from config import REDIRECT_FAST_PATH, LOCAL_CACHE_SIZE
+
+REDIRECT_PREFIX = "/links/"
+REDIRECT_HEADERS = [(b"content-length", b"0")]
+PERMANENT_HEADERS = REDIRECT_HEADERS + [(b"cache-control", httpcache.PERMANENT_CACHE_CONTROL.encode())]
+TEMPORARY_HEADERS = REDIRECT_HEADERS + [(b"cache-control", httpcache.TEMPORARY_CACHE_CONTROL.encode())]
+ERROR_HEADERS = [(b"content-type", b"application/json")]
+NOT_FOUND_BODY = b'{"detail":"Link not found"}'
+EXPIRED_BODY = b'{"detail":"Link expired"}'
+
+enabled = REDIRECT_FAST_PATH
+
+
+@lru_cache(maxsize=LOCAL_CACHE_SIZE)
+def _location(original_url: str) -> bytes:
+    # same escaping as starlette's RedirectResponse
+    return quote(original_url, safe=":/%#?=@[]!$&'()*+,;").encode("latin-1")
+
+
+def _header(scope, name: bytes):
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def record_hit(link_id: int, client_host, user_agent):
+    await clicks.buffer.record(link_id)
+    visitors.counter.add(link_id, visitors.visitor_fingerprint(client_host, user_agent))
+
+
+async def _send(send, status: int, headers, body: bytes = b""):
+    if body:
+        headers = headers + [(b"content-length", str(len(body)).encode())]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+# Answers GET /links/{code} straight from the link cache, before routing and
+# dependency injection. Anything it cannot answer from cache goes on to the
+# regular handler, which skips the cache lookup already done here.
+class RedirectFastPath:
+    def __init__(self, app):
+        self.app = app
+        self._route = None
+        self._reserved = None
+
+    def _routes(self, scope):
+        # static routes like /links/search win over the redirect in the router
+        self._reserved = set()
+        for route in scope["app"].routes:
+            path = getattr(route, "path", "")
+            if path == REDIRECT_PREFIX + "{short_code}" and "GET" in getattr(route, "methods", ()):
+                self._route = route
+            elif path.startswith(REDIRECT_PREFIX) and "{" not in path:
+                self._reserved.add(path[len(REDIRECT_PREFIX):])
+
+    async def __call__(self, scope, receive, send):
+        if not enabled or scope["type"] != "http" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        if not path.startswith(REDIRECT_PREFIX):
+            await self.app(scope, receive, send)
+            return
+        if self._reserved is None:
+            self._routes(scope)
+        short_code = path[len(REDIRECT_PREFIX):]
+        if not short_code or "/" in short_code or short_code in self._reserved or self._route is None:
+            await self.app(scope, receive, send)
+            return
+
+        cached = await cache.get_link(short_code)
+        if not cached:
+            scope["link_cache_checked"] = True
+            await self.app(scope, receive, send)
+            return
+        scope["route"] = self._route
+        if cached == cache.NOT_FOUND:
+            await _send(send, 404, ERROR_HEADERS, NOT_FOUND_BODY)
+            return
+        if cached == cache.EXPIRED or cache.is_expired(cached[1]):
+            await _send(send, 410, ERROR_HEADERS, EXPIRED_BODY)
+            return
+        link_id, expires_ts, original_url, permanent = cached
+        client = scope.get("client")
+        await record_hit(link_id, client[0] if client else None, _header(scope, b"user-agent"))
+        status, cache_control = httpcache.redirect_policy(expires_ts, permanent)
+        if cache_control == httpcache.PERMANENT_CACHE_CONTROL:
+            headers = PERMANENT_HEADERS
+        elif cache_control == httpcache.TEMPORARY_CACHE_CONTROL:
+            headers = TEMPORARY_HEADERS
+        else:
+            headers = REDIRECT_HEADERS + [(b"cache-control", cache_control.encode())]
+        await _send(send, status, headers + [(b"location", _location(original_url))])
@@ -0,0 +1,94 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import BCRYPT_ROUNDS, HASH_POOL_WORKERS, HASH_POOL_MAX_QUEUE, HASH_POOL_START_METHOD
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def check_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+class PoolSaturated(Exception):
+    pass
+
+
+# bcrypt runs in its own processes so a burst of logins cannot hold the GIL
+# of the worker serving redirects. Work beyond `max_queue` waiting calls is
+# rejected instead of queued. Workers come from a forkserver (or spawn), never
+# a fork of the threaded server process.
+class HashingPool:
+    def __init__(self, workers: int, max_queue: int, start_method: str = HASH_POOL_START_METHOD):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.start_method = start_method
+        self._executor = None
+        self.inflight = 0
+        self.calls = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.workers > 0:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == "forkserver":
+                    context.set_forkserver_preload(["hashing"])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hashing")
+        return self._executor
+
+    async def start(self):
+        # start every worker up front so the first logins don't pay for it
+        executor = self._get_executor()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(executor, time.sleep, 0) for _ in range(max(self.workers, 1))))
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.inflight - max(self.workers, 1))
+
+    async def run(self, func, *args):
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise PoolSaturated()
+        self.inflight += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.inflight -= 1
+            elapsed = time.perf_counter() - started
+            self.calls += 1
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "inflight": self.inflight,
+            "queue_depth": self.queue_depth,
+            "calls": self.calls,
+            "rejected": self.rejected,
+            "total_seconds": self.total_seconds,
+            "max_seconds": self.max_seconds,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+pool = HashingPool(HASH_POOL_WORKERS, HASH_POOL_MAX_QUEUE)
@@ -0,0 +1,51 @@
+import hashlib
+import json
+import time
+from typing import Optional
+
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+from config import REDIRECT_TEMPORARY_STATUS, REDIRECT_TEMPORARY_MAX_AGE, REDIRECT_PERMANENT_MAX_AGE
+
+PERMANENT_CACHE_CONTROL = f"public, max-age={REDIRECT_PERMANENT_MAX_AGE}, immutable"
+TEMPORARY_CACHE_CONTROL = f"public, max-age={REDIRECT_TEMPORARY_MAX_AGE}"
+# responses that may be stored but have to be revalidated with the ETag
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+# Permanent links can be cached for good. Everything else gets a temporary
+# redirect whose max-age never outlives the link.
+def redirect_policy(expires_ts: Optional[float], permanent: bool, now: float = None):
+    if permanent and expires_ts is None:
+        return 301, PERMANENT_CACHE_CONTROL
+    if expires_ts is None:
+        return REDIRECT_TEMPORARY_STATUS, TEMPORARY_CACHE_CONTROL
+    max_age = max(0, min(REDIRECT_TEMPORARY_MAX_AGE, int(expires_ts - (now or time.time()))))
+    return REDIRECT_TEMPORARY_STATUS, f"public, max-age={max_age}"
+
+
+def make_etag(body: bytes, version=None) -> str:
+    digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+    return f'W/"{version}-{digest}"' if version is not None else f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
+# Serializes `content` once, tags it, and answers 304 when the client already
+# holds that representation. The DB work is still done; the body is not sent.
+def conditional_json(request, content, version=None, headers: dict = None) -> Response:
+    body = json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False,
+                      separators=(",", ":")).encode()
+    headers = {**(headers or {}), "ETag": make_etag(body, version), "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
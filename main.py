@@ -1,57 +1,152 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Request
-from fastapi.responses import RedirectResponse, HTMLResponse
+import asyncio
+import logging
+import time
+from functools import lru_cache
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import RedirectResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy.orm import Session
-from database import Base, engine
+from sqlalchemy.ext.asyncio import AsyncSession
+import migrations
+from database import SessionLocal, ReplicaSessionLocal, HAS_REPLICA, engine
 import models
 import schemas
 import crud
 import auth
-import redis_client
-from auth import get_current_user, get_current_user_optional, create_access_token, get_password_hash, verify_password
+import cache
+import clicks
+import analytics
+import visitors
+import hashing
+import sweeper
+import bloom
+import metrics
+import tracing
+import transfer
+import warmup
+import fastpath
+import httpcache
+import ratelimit
+from config import (CLICK_STATS_WORKER_STALENESS_MS, SEARCH_DEFAULT_LIMIT, SEARCH_MAX_LIMIT,
+                    SINGLE_FLIGHT_REDIS_LOCK, MIGRATE_ON_STARTUP)
+from auth import get_current_user, get_current_user_optional, create_access_token
 from datetime import timedelta, datetime
+from typing import Optional
 from fastapi.security import OAuth2PasswordRequestForm
 
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.monotonic()
+    if MIGRATE_ON_STARTUP:
+        # single-worker setups only; deploys run `python -m migrations` once instead
+        await asyncio.to_thread(migrations.upgrade)
+    metrics.register_routes(app.routes)
+    clicks.buffer.start()
+    analytics.rollups.start()
+    visitors.counter.start()
+    sweeper.sweeper.start()
+    await hashing.pool.start()
+    try:
+        await cache.listener.start()
+        await auth.principal_listener.start()
+    except Exception:
+        logger.exception("Could not subscribe to link invalidations, relying on local cache TTL")
+    try:
+        if bloom.codes.backend == "local":
+            # a per-worker filter is only safe while it hears the other workers' updates
+            await bloom.listener.start()
+        await bloom.codes.retire_shared()
+        bloom.codes.start()
+    except Exception:
+        logger.exception("Could not subscribe to short code updates, bloom filter disabled")
+    await warmup.warmer.run()
+    logger.info("Worker ready in %.2fs", time.monotonic() - started)
+    yield
+    await bloom.codes.stop()
+    await bloom.listener.stop()
+    await sweeper.sweeper.stop()
+    await cache.listener.stop()
+    await auth.principal_listener.stop()
+    # flush whatever clicks are still buffered before the worker exits
+    await clicks.buffer.stop()
+    await analytics.rollups.stop()
+    await visitors.counter.stop()
+    hashing.pool.shutdown()
+
+
 app = FastAPI(
     title="URL Shortener API",
     description="Service to shorten URLs, track analytics, and manage links.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
-#simple html ui
-templates = Jinja2Templates(directory="templates")
-Base.metadata.create_all(bind=engine)
+app.add_middleware(fastpath.RedirectFastPath)
+app.add_middleware(ratelimit.AdmissionMiddleware)
+app.add_middleware(tracing.QueryTraceMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.GaugeFunc("link_local_cache", "Per-worker link cache size and counters.", ("stat",),
+                  lambda: {(stat,): value for stat, value in cache.local.stats().items()})
+metrics.GaugeFunc("principal_cache", "Per-worker verified token cache size and counters.", ("stat",),
+                  lambda: {(stat,): value for stat, value in auth.principals.stats().items()})
+metrics.GaugeFunc("db_pool_checked_out", "Connections currently checked out of the primary pool.", (),
+                  lambda: {(): engine.pool.checkedout()})
+metrics.GaugeFunc("bcrypt_pool", "Password hashing pool state.", ("stat",),
+                  lambda: {(stat,): hashing.pool.stats()[stat] for stat in ("inflight", "queue_depth")})
+metrics.GaugeFunc("click_buffer_pending", "Clicks buffered in this worker and not yet flushed.", (),
+                  lambda: {(): clicks.buffer.pending_events})
+metrics.GaugeFunc("bloom_rejected", "Redirects answered 404 by the short code filter.", (),
+                  lambda: {(): bloom.codes.rejected})
+metrics.GaugeFunc("cache_warmup", "Links preloaded at startup and how long it took.", ("stat",),
+                  lambda: {("links",): warmup.warmer.loaded, ("seconds",): warmup.warmer.seconds or 0})
+metrics.GaugeFunc("admission_inflight_requests", "Requests admitted and still in flight in this worker.", (),
+                  lambda: {(): ratelimit.limiter.inflight})
+
+
+#simple html ui, built on first use
+@lru_cache(maxsize=1)
+def get_templates():
+    return Jinja2Templates(directory="templates")
 
 
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to the URL Shortener API. Visit /ui for the web interface."}
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
 @app.get("/ui", response_class=HTMLResponse)
-def ui(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
+async def ui(request: Request):
+    return get_templates().TemplateResponse("index.html", {"request": request})
 
 
 @app.post("/users/register", response_model=schemas.UserResponse)
-def register(user_in: schemas.UserCreate, db: Session = Depends(auth.get_db)):
-    if db.query(models.User).filter(models.User.username == user_in.username).first():
+async def register(user_in: schemas.UserCreate, db: AsyncSession = Depends(auth.get_db)):
+    if await auth.get_user_by_username(db, user_in.username):
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = get_password_hash(user_in.password)
+    hashed_password = await auth.get_password_hash_async(user_in.password)
     user = models.User(
         username=user_in.username,
         email=user_in.email,
         hashed_password=hashed_password
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await db.refresh(user)
     return user
 
 
 @app.post("/token", response_model=schemas.Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(auth.get_db)):
-    user = db.query(models.User).filter(models.User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(auth.get_db)):
+    user = await auth.get_user_by_username(db, form_data.username)
+    if not user or not await auth.verify_password_async(form_data.password, user.hashed_password):
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -60,64 +155,213 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+async def _stream_user_links(owner_id: int, after):
+    # own session: the request's dependencies are torn down while the body streams;
+    # rows go through UserLink so both listing modes return the same fields
+    async with ReplicaSessionLocal() as db:
+        async for rows in crud.stream_user_links(db, owner_id, after):
+            yield "".join(schemas.UserLink.model_validate(row._asdict()).model_dump_json() + "\n" for row in rows)
+
+
+@app.get("/users/me/links", response_model=list[schemas.UserLink])
+async def list_my_links(request: Request, response: Response,
+                        limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+                        cursor: Optional[str] = None, db: AsyncSession = Depends(auth.get_read_db),
+                        current_user: models.User = Depends(get_current_user)):
+    try:
+        after = crud.decode_link_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if "application/x-ndjson" in request.headers.get("accept", ""):
+        # the whole listing from the cursor on, read in batches from a server-side cursor
+        return StreamingResponse(_stream_user_links(current_user.id, after), media_type="application/x-ndjson")
+    rows = await crud.list_user_links(db, current_user.id, limit, after)
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = crud.encode_link_cursor(rows[-1].created_at, rows[-1].id)
+    return [row._asdict() for row in rows]
+
+
 @app.post("/links/shorten", response_model=schemas.LinkResponse)
-def create_short_link(link_in: schemas.LinkCreate, db: Session = Depends(auth.get_db),
-                      current_user: models.User = Depends(get_current_user_optional)):
-    link = crud.create_link(db, link_in, owner_id=current_user.id if current_user else None)
+async def create_short_link(link_in: schemas.LinkCreate, db: AsyncSession = Depends(auth.get_db),
+                            current_user: models.User = Depends(get_current_user_optional)):
+    if link_in.permanent and link_in.expires_at:
+        raise HTTPException(status_code=400, detail=crud.PERMANENT_EXPIRY_ERROR)
+    try:
+        link = await crud.create_link(db, link_in, owner_id=current_user.id if current_user else None)
+    except crud.ShortCodeTaken:
+        raise HTTPException(status_code=400, detail="Short code already in use")
+    # drop any negative cache entry left by earlier probes of this code
+    await cache.invalidate_link(link.short_code)
+    await bloom.codes.add([link.short_code])
     return link
 
 
+@app.post("/links/shorten/batch", response_model=list[schemas.LinkBatchResult])
+async def create_short_links_batch(batch: schemas.LinkBatchCreate, db: AsyncSession = Depends(auth.get_db),
+                                   current_user: models.User = Depends(get_current_user_optional)):
+    try:
+        results = await crud.create_links_bulk(db, batch.items, owner_id=current_user.id if current_user else None)
+    except crud.ShortCodeTaken:
+        raise HTTPException(status_code=409, detail="Short codes changed during the batch, retry it")
+    created = [link for link, _ in results if link is not None]
+    if created:
+        await cache.invalidate_links([link.short_code for link in created])
+        await bloom.codes.add([link.short_code for link in created])
+    if batch.prefill_cache:
+        await cache.set_links(created)
+    return [
+        schemas.LinkBatchResult(index=index, error=error) if link is None else
+        schemas.LinkBatchResult(index=index, short_code=link.short_code,
+                                original_url=link.original_url, expires_at=link.expires_at)
+        for index, (link, error) in enumerate(results)
+    ]
+
+
+@app.get("/links/export")
+async def export_links(format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                       current_user: models.User = Depends(get_current_user)):
+    return StreamingResponse(
+        transfer.export_links(format, owner_id=current_user.id),
+        media_type=transfer.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="links.{format}"'},
+    )
+
+
+@app.post("/links/import", response_model=schemas.ImportSummary)
+async def import_links(request: Request, format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                       current_user: models.User = Depends(get_current_user)):
+    progress = await transfer.import_links(request.stream(), format, owner_id=current_user.id)
+    return progress.summary()
+
+
 # Place the search route before the dynamic route so that /links/search is matched correctly.
 @app.get("/links/search", response_model=list[schemas.LinkResponse])
-def search_links(original_url: str, db: Session = Depends(auth.get_db)):
-    links = crud.search_link_by_original(db, original_url)
-    return links
+async def search_links(request: Request, original_url: Optional[str] = None, domain: Optional[str] = None,
+                       prefix: Optional[str] = None,
+                       limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+                       cursor: Optional[int] = None, db: AsyncSession = Depends(auth.get_read_db)):
+    if sum(value is not None for value in (original_url, domain, prefix)) != 1:
+        raise HTTPException(status_code=400, detail="Pass exactly one of original_url, domain or prefix")
+    if original_url is not None:
+        links = await crud.search_link_by_original(db, original_url, limit, cursor)
+    elif domain is not None:
+        links = await crud.search_links_by_domain(db, domain, limit, cursor)
+    else:
+        try:
+            links = await crud.search_links_by_prefix(db, prefix, limit, cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="prefix must start with a scheme and a full host, "
+                                                        "e.g. https://example.com/docs")
+    headers = {"X-Next-Cursor": str(links[-1].id)} if len(links) == limit else None
+    return httpcache.conditional_json(
+        request, [schemas.LinkResponse.model_validate(link, from_attributes=True) for link in links], headers=headers)
 
 
 @app.get("/links/{short_code}/stats", response_model=schemas.LinkStats)
-def get_link_statistics(short_code: str, db: Session = Depends(auth.get_db)):
-    link = crud.get_link_stats(db, short_code)
+async def get_link_statistics(request: Request, short_code: str, granularity: Optional[schemas.Granularity] = None,
+                              start: Optional[datetime] = Query(None, alias="from"),
+                              end: Optional[datetime] = Query(None, alias="to"),
+                              db: AsyncSession = Depends(auth.get_read_db)):
+    await clicks.buffer.flush_if_stale(CLICK_STATS_WORKER_STALENESS_MS)
+    link = await crud.get_link_stats(db, short_code)
     if not link:
         raise HTTPException(status_code=404, detail="Link not found")
-    return link
+    stats = {
+        "original_url": link.original_url,
+        "created_at": link.created_at,
+        "last_accessed": link.last_accessed,
+        "click_count": link.click_count,
+    }
+    now = datetime.utcnow()
+    if granularity is None and start is None and end is None:
+        created = (link.created_at or now).date()
+        stats["unique_visitors"] = await visitors.counter.count(link.id, created, now.date())
+        return httpcache.conditional_json(request, schemas.LinkStats(**stats), version=link.version or 1)
 
+    # time series come from the pre-aggregated rollups only
+    granularity = granularity or schemas.Granularity.hour
+    end = analytics.to_naive_utc(end) or now
+    start = analytics.to_naive_utc(start) or end - analytics.DEFAULT_BUCKETS[granularity.value]
+    stats["granularity"] = granularity
+    stats["series"] = await analytics.click_series(db, link.id, granularity.value, start, end)
+    stats["unique_visitors"] = await visitors.counter.count(link.id, start.date(), end.date())
+    return httpcache.conditional_json(request, schemas.LinkStats(**stats), version=link.version or 1)
 
-@app.get("/links/{short_code}")
-def redirect_to_url(short_code: str, db: Session = Depends(auth.get_db)):
-    cache_key = f"link:{short_code}"
-    cached_url = redis_client.r.get(cache_key)
-    if cached_url:
-        link = crud.get_link_by_code(db, short_code)
-        if link:
-            crud.increment_click(db, link)
-        return RedirectResponse(url=cached_url)
-
-    link = crud.get_link_by_code(db, short_code)
+
+async def _load_link(short_code: str):
+    async with ReplicaSessionLocal() as db:
+        link = await crud.get_link_by_code(db, short_code)
+    if not link and HAS_REPLICA:
+        # the replica may not have caught up with a link created moments ago
+        async with SessionLocal() as primary:
+            link = await crud.get_link_by_code(primary, short_code)
     if not link:
-        raise HTTPException(status_code=404, detail="Link not found")
+        return await cache.set_negative(short_code, cache.NOT_FOUND)
     if link.expires_at and datetime.utcnow() > link.expires_at:
+        return await cache.set_negative(short_code, cache.EXPIRED)
+    ttl = cache.link_ttl(link)
+    if ttl > 0:
+        return await cache.set_link(short_code, link, ttl)
+    return cache.load_link(cache.dump_link(link))
+
+
+async def _fill_link(short_code: str):
+    if not SINGLE_FLIGHT_REDIS_LOCK:
+        return await _load_link(short_code)
+    # only the lock holder reloads; other workers wait for it to fill Redis
+    if not await cache.acquire_fill_lock(short_code):
+        cached = await cache.wait_for_fill(short_code)
+        if cached:
+            return cached
+        return await _load_link(short_code)
+    try:
+        return await _load_link(short_code)
+    finally:
+        await cache.release_fill_lock(short_code)
+
+
+@app.get("/links/{short_code}")
+async def redirect_to_url(short_code: str, request: Request):
+    # on a fast path miss the cache has already been checked for this request
+    cached = None if request.scope.get("link_cache_checked") else await cache.get_link(short_code)
+    if not cached:
+        if not await bloom.codes.might_contain(short_code):
+            raise HTTPException(status_code=404, detail="Link not found")
+        cached = await cache.single_flight.do(short_code, lambda: _fill_link(short_code))
+    if cached == cache.NOT_FOUND:
+        raise HTTPException(status_code=404, detail="Link not found")
+    if cached == cache.EXPIRED:
+        raise HTTPException(status_code=410, detail="Link expired")
+    link_id, expires_ts, original_url, permanent = cached
+    if cache.is_expired(expires_ts):
         raise HTTPException(status_code=410, detail="Link expired")
 
-    crud.increment_click(db, link)
-    redis_client.r.set(cache_key, link.original_url, ex=60 * 60)
-    return RedirectResponse(url=link.original_url)
+    await fastpath.record_hit(link_id, request.client.host if request.client else None,
+                              request.headers.get("user-agent"))
+    status_code, cache_control = httpcache.redirect_policy(expires_ts, permanent)
+    return RedirectResponse(url=original_url, status_code=status_code, headers={"Cache-Control": cache_control})
 
 
 @app.put("/links/{short_code}", response_model=schemas.LinkResponse)
-def update_link(short_code: str, link_in: schemas.LinkUpdate, db: Session = Depends(auth.get_db),
-                current_user: models.User = Depends(get_current_user)):
-    link = crud.update_link(db, short_code, link_in, current_user)
+async def update_link(short_code: str, link_in: schemas.LinkUpdate, db: AsyncSession = Depends(auth.get_db),
+                      current_user: models.User = Depends(get_current_user)):
+    try:
+        link = await crud.update_link(db, short_code, link_in, current_user)
+    except crud.PermanentLink:
+        raise HTTPException(status_code=409, detail="Permanent links cannot be changed")
     if not link:
         raise HTTPException(status_code=404, detail="Link not found or not authorized")
-    redis_client.r.delete(f"link:{short_code}")
+    await cache.invalidate_link(short_code)
     return link
 
 
 @app.delete("/links/{short_code}")
-def delete_link(short_code: str, db: Session = Depends(auth.get_db),
-                current_user: models.User = Depends(get_current_user)):
-    link = crud.delete_link(db, short_code, current_user)
+async def delete_link(short_code: str, db: AsyncSession = Depends(auth.get_db),
+                      current_user: models.User = Depends(get_current_user)):
+    link = await crud.delete_link(db, short_code, current_user)
     if not link:
         raise HTTPException(status_code=404, detail="Link not found or not authorized")
-    redis_client.r.delete(f"link:{short_code}")
+    visitors.counter.forget([link.id])
+    await cache.invalidate_link(short_code)
+    await bloom.codes.remove([short_code])
     return {"detail": "Link deleted successfully"}
\ No newline at end of file
@@ -0,0 +1,217 @@
+import bisect
+import math
+import time
+
+# Small in-process Prometheus registry. Children for every label set the hot
+# paths use are created up front, so recording a sample is a dict lookup and
+# a couple of additions.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+REGISTRY = []
+
+SQL_VERBS = ("SELECT", "INSERT", "UPDATE", "DELETE", "OTHER")
+REDIS_COMMANDS = ("GET", "SET", "DEL", "INCRBY", "EXPIRE", "PFADD", "PFCOUNT", "PUBLISH",
+                  "GETBIT", "SETBIT", "EVALSHA", "PIPELINE", "OTHER")
+HASH_OPERATIONS = ("hash", "verify")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._default = self.labels()
+        registry.append(self)
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples())
+        return "\n".join(lines)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default.value += amount
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield f"{self.name}_total", _format_labels(self.labelnames, values), child.value
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), child.counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(bound)
+                yield f"{self.name}_bucket", _format_labels(self.labelnames, values, f'le="{le}"'), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labelnames, values), child.sum
+            yield f"{self.name}_count", _format_labels(self.labelnames, values), cumulative
+
+
+# Gauge read from existing state at scrape time; `read` returns a mapping of
+# label-value tuples to numbers.
+class GaugeFunc(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames, read, registry=REGISTRY):
+        self.read = read
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return None
+
+    def _samples(self):
+        try:
+            values = self.read()
+        except Exception:
+            return
+        for labels, value in values.items():
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+def render(registry=REGISTRY) -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+http_requests = Counter("http_requests", "HTTP requests by route, method and status.",
+                        ("route", "method", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency by route and method.",
+                         ("route", "method"))
+redis_latency = Histogram("redis_command_duration_seconds", "Redis command latency.", ("command",))
+redis_errors = Counter("redis_errors", "Redis commands that raised.", ("command",))
+redis_hits = Counter("redis_cache_hits", "Redis GETs that found a value.")
+redis_misses = Counter("redis_cache_misses", "Redis GETs that found nothing.")
+sql_queries = Histogram("sql_query_duration_seconds", "SQL statement latency by verb.", ("verb",))
+sql_errors = Counter("sql_errors", "SQL statements that raised.", ("verb",))
+db_pool_wait = Histogram("db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.")
+bcrypt_latency = Histogram("bcrypt_duration_seconds", "bcrypt latency including pool queueing.",
+                           ("operation",), buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+bcrypt_rejected = Counter("bcrypt_rejected", "bcrypt calls rejected because the pool was saturated.")
+rate_limited = Counter("rate_limited_requests", "Requests rejected before reaching a handler.",
+                       ("route", "reason"))
+rate_limit_fallbacks = Counter("rate_limit_local_fallbacks", "Rate limit checks made in-process because Redis failed.")
+
+_redis_commands = {command: (redis_latency.labels(command), redis_errors.labels(command))
+                   for command in REDIS_COMMANDS}
+_sql_verbs = {verb: (sql_queries.labels(verb), sql_errors.labels(verb)) for verb in SQL_VERBS}
+
+
+def redis_command(name: str):
+    return _redis_commands.get(name.upper() if isinstance(name, str) else name, _redis_commands["OTHER"])
+
+
+def sql_verb(statement: str):
+    return _sql_verbs.get(statement.lstrip()[:6].upper(), _sql_verbs["OTHER"])
+
+
+def register_routes(routes):
+    for route in routes:
+        for method in getattr(route, "methods", None) or ():
+            http_latency.labels(route.path, method)
+
+
+# Pure ASGI middleware: a BaseHTTPMiddleware would add a task and a stream
+# per request to every redirect.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            http_latency.labels(path, method).observe(time.perf_counter() - started)
+            http_requests.labels(path, method, status).inc()
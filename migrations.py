@@ -0,0 +1,104 @@
+import logging
+
+from sqlalchemy import create_engine, inspect, select, update, bindparam, text
+
+from config import DATABASE_URL
+from database import Base, sync_url
+import models
+from utils import url_hash, url_domain
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _add_missing_columns(conn):
+    inspector = inspect(conn)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+            logger.info("Added column %s.%s", table.name, column.name)
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(conn)
+                logger.info("Created index %s", index.name)
+
+
+def _backfill_link_urls(conn):
+    links = models.Link.__table__
+    stmt = (
+        update(links)
+        .where(links.c.id == bindparam("link_id"))
+        .values(url_hash=bindparam("hash"), domain=bindparam("url_domain"))
+    )
+    while True:
+        rows = conn.execute(
+            select(links.c.id, links.c.original_url)
+            .where(links.c.url_hash.is_(None))
+            .limit(BACKFILL_BATCH_SIZE)
+        ).all()
+        if not rows:
+            return
+        conn.execute(stmt, [
+            {"link_id": link_id, "hash": url_hash(original_url), "url_domain": url_domain(original_url)}
+            for link_id, original_url in rows
+        ])
+
+
+def _enable_sqlite_link_autoincrement(conn):
+    # tables created before links used AUTOINCREMENT hand the highest id out
+    # again once that link is swept or deleted; SQLite can only change this by
+    # rebuilding the table
+    if conn.dialect.name != "sqlite":
+        return
+    table_sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'links'")).scalar()
+    if table_sql is None or "AUTOINCREMENT" in table_sql.upper():
+        return
+    links = models.Link.__table__
+    for index in inspect(conn).get_indexes("links"):
+        conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+    conn.execute(text("ALTER TABLE links RENAME TO links_old"))
+    links.create(conn)
+    columns = ", ".join(f'"{column.name}"' for column in links.columns)
+    conn.execute(text(f"INSERT INTO links ({columns}) SELECT {columns} FROM links_old"))
+    conn.execute(text("DROP TABLE links_old"))
+    # ids already handed out may live on in archives and click history
+    high_water = conn.execute(text(
+        "SELECT MAX(id) FROM (SELECT MAX(id) AS id FROM links UNION ALL SELECT MAX(link_id) FROM archived_links"
+        " UNION ALL SELECT MAX(link_id) FROM click_events UNION ALL SELECT MAX(link_id) FROM click_rollups)"
+    )).scalar() or 0
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'links'"))
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('links', :seq)"), {"seq": high_water})
+    logger.info("Rebuilt links with AUTOINCREMENT, next id above %d", high_water)
+
+
+def _backfill_archived_link_ids(conn):
+    # archives written before link_id existed used the link id as their own
+    conn.execute(update(models.ArchivedLink.__table__)
+                 .where(models.ArchivedLink.link_id.is_(None))
+                 .values(link_id=models.ArchivedLink.id))
+
+
+def upgrade(url: str = DATABASE_URL):
+    # DDL runs on a short-lived blocking engine so it can happen before the
+    # event loop exists.
+    sync_engine = create_engine(sync_url(url))
+    try:
+        Base.metadata.create_all(bind=sync_engine)
+        with sync_engine.begin() as conn:
+            _add_missing_columns(conn)
+            _backfill_archived_link_ids(conn)
+            _enable_sqlite_link_autoincrement(conn)
+            _backfill_link_urls(conn)
+    finally:
+        sync_engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    upgrade()
@@ -1,22 +1,66 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy import Index, Column, Integer, BigInteger, Boolean, String, DateTime, ForeignKey
+from sqlalchemy.dialects import sqlite
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from database import Base
 
+# SQLite's CURRENT_TIMESTAMP has no fractional seconds; binding values in the
+# same text format keeps keyset comparisons on created_at consistent
+CreatedAt = DateTime(timezone=True).with_variant(
+    sqlite.DATETIME(storage_format="%(year)04d-%(month)02d-%(day)02d %(hour)02d:%(minute)02d:%(second)02d"),
+    "sqlite",
+)
+
 
 class Link(Base):
     __tablename__ = "links"
     id = Column(Integer, primary_key=True, index=True)
     original_url = Column(String, nullable=False)
+    url_hash = Column(String(64), index=True, nullable=True)
+    domain = Column(String, nullable=True)
     short_code = Column(String, unique=True, index=True, nullable=False)
-    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    created_at = Column(CreatedAt, server_default=func.now())
     last_accessed = Column(DateTime(timezone=True), nullable=True)
     click_count = Column(Integer, default=0)
-    expires_at = Column(DateTime, nullable=True)
+    expires_at = Column(DateTime, nullable=True, index=True)
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
+    # permanent links never change or expire, so their redirects are 301s
+    permanent = Column(Boolean, default=False)
+    version = Column(Integer, default=1)
 
     owner = relationship("User", back_populates="links")
 
+    __table_args__ = (
+        Index("ix_links_domain_id", "domain", "id"),
+        Index("ix_links_owner_created_id", "owner_id", "created_at", "id"),
+        # ids of swept or deleted links must never come back: archives, click
+        # history and visitor sketches are keyed by them
+        {"sqlite_autoincrement": True},
+    )
+
+
+class ArchivedLink(Base):
+    __tablename__ = "archived_links"
+    id = Column(Integer, primary_key=True)
+    link_id = Column(Integer, index=True)
+    original_url = Column(String, nullable=False)
+    short_code = Column(String, index=True, nullable=False)
+    created_at = Column(DateTime(timezone=True))
+    last_accessed = Column(DateTime(timezone=True), nullable=True)
+    click_count = Column(Integer, default=0)
+    expires_at = Column(DateTime, nullable=True)
+    owner_id = Column(Integer, nullable=True)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+# Codes of deleted permanent links: clients may still hold their 301, so the
+# code is never handed out again.
+class ReservedCode(Base):
+    __tablename__ = "reserved_codes"
+    short_code = Column(String, primary_key=True)
+    link_id = Column(Integer)
+    reserved_at = Column(DateTime(timezone=True), server_default=func.now())
+
 
 class User(Base):
     __tablename__ = "users"
@@ -26,4 +70,26 @@ class User(Base):
     hashed_password = Column(String, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    links = relationship("Link", back_populates="owner")
\ No newline at end of file
+    links = relationship("Link", back_populates="owner")
+
+
+class CodeSequence(Base):
+    __tablename__ = "code_sequences"
+    name = Column(String, primary_key=True)
+    value = Column(BigInteger, nullable=False, default=0)
+
+
+class ClickEvent(Base):
+    __tablename__ = "click_events"
+    id = Column(Integer, primary_key=True)
+    link_id = Column(Integer, nullable=False)
+    bucket_start = Column(DateTime, nullable=False)
+    count = Column(Integer, nullable=False, default=1)
+
+
+class ClickRollup(Base):
+    __tablename__ = "click_rollups"
+    link_id = Column(Integer, primary_key=True)
+    granularity = Column(String, primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
\ No newline at end of file
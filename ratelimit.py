@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import math
+import time
+from collections import OrderedDict
+
+from jose import JWTError, jwt
+from redis.exceptions import NoScriptError, RedisError
+
+import auth
+import metrics
+import redis_client
+from config import (RATE_LIMIT_ENABLED, RATE_LIMIT_RULES, RATE_LIMIT_USER_MULTIPLIER, RATE_LIMIT_REDIS_TIMEOUT_MS,
+                    RATE_LIMIT_REDIS_RETRY_MS, RATE_LIMIT_LOCAL_SIZE, ADMISSION_MAX_INFLIGHT, SECRET_KEY, ALGORITHM)
+
+logger = logging.getLogger(__name__)
+
+enabled = RATE_LIMIT_ENABLED
+
+# Refill, take and store in one round trip. The clock is Redis' own, so
+# workers with skewed clocks still share one consistent bucket. Times are in
+# milliseconds to stay inside Lua's number precision.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate / 1000)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(retry_after)}
+"""
+
+TOO_MANY_BODY = b'{"detail":"Too many requests, retry later"}'
+OVERLOADED_BODY = b'{"detail":"Server is overloaded, retry later"}'
+
+
+def take(tokens, updated: float, now: float, rate: float, burst: float, cost: float = 1):
+    # the in-process twin of TOKEN_BUCKET_SCRIPT, with times in seconds
+    tokens = burst if tokens is None else min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return True, tokens - cost, 0.0
+    return False, tokens, (cost - tokens) / rate
+
+
+class Rule:
+    def __init__(self, method: str, path: str, requests: float, seconds: float, burst: float = None):
+        self.method = method.upper()
+        self.path = path
+        self.rate = requests / seconds
+        self.burst = burst if burst is not None else requests
+
+    @property
+    def name(self) -> str:
+        return f"{self.method}:{self.path}"
+
+
+def parse_rules(spec: str) -> list:
+    rules = []
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        fields = item.split()
+        if len(fields) not in (3, 4) or "/" not in fields[2]:
+            raise ValueError(f"Bad rate limit rule {item!r}, expected 'METHOD PATH REQUESTS/SECONDS [BURST]'")
+        requests, seconds = fields[2].split("/")
+        burst = float(fields[3]) if len(fields) == 4 else None
+        rules.append(Rule(fields[0], fields[1], float(requests), float(seconds), burst))
+    return rules
+
+
+# Per-worker buckets used while Redis is unreachable. Limits are then only
+# enforced per worker, which is looser but keeps abusive clients in check.
+class LocalBuckets:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def take(self, key: str, rate: float, burst: float, now: float = None):
+        now = now if now is not None else time.monotonic()
+        tokens, updated = self._buckets.pop(key, (None, now))
+        allowed, tokens, retry_after = take(tokens, updated, now, rate, burst)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RateLimiter:
+    def __init__(self, rules, user_multiplier: float = RATE_LIMIT_USER_MULTIPLIER,
+                 max_inflight: int = ADMISSION_MAX_INFLIGHT, local_size: int = RATE_LIMIT_LOCAL_SIZE):
+        self.rules = {(rule.method, rule.path): rule for rule in rules}
+        self.user_multiplier = user_multiplier
+        self.max_inflight = max_inflight
+        self.local = LocalBuckets(local_size)
+        self.inflight = 0
+        self.redis_down_until = 0.0
+        self._sha = None
+
+    def identity(self, scope, headers: dict):
+        # signed-in clients are limited per user, everyone else per address
+        authorization = headers.get(b"authorization", b"").decode("latin-1")
+        scheme, _, token = authorization.partition(" ")
+        if scheme.lower() == "bearer" and token:
+            user = auth.principals.get(token)
+            if user is not None:
+                return f"user:{user.username}", self.user_multiplier
+            try:
+                username = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            except JWTError:
+                username = None
+            if username:
+                return f"user:{username}", self.user_multiplier
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}", 1.0
+
+    async def _redis_take(self, key: str, rate: float, burst: float):
+        client = redis_client.r
+        if self._sha is None:
+            self._sha = await client.script_load(TOKEN_BUCKET_SCRIPT)
+        try:
+            allowed, retry_after = await client.evalsha(self._sha, 1, key, rate, burst, 1)
+        except NoScriptError:
+            # Redis restarted or the client changed, load the script again
+            self._sha = await client.script_load(TOKEN_BUCKET_SCRIPT)
+            allowed, retry_after = await client.evalsha(self._sha, 1, key, rate, burst, 1)
+        return bool(int(allowed)), float(retry_after)
+
+    async def hit(self, rule: Rule, identity: str, multiplier: float = 1.0):
+        key = f"ratelimit:{rule.name}:{identity}"
+        rate, burst = rule.rate * multiplier, rule.burst * multiplier
+        now = time.monotonic()
+        if now >= self.redis_down_until:
+            try:
+                return await asyncio.wait_for(self._redis_take(key, rate, burst), RATE_LIMIT_REDIS_TIMEOUT_MS / 1000)
+            except (RedisError, OSError, asyncio.TimeoutError):
+                # don't pay a timeout on every request while Redis is gone
+                self.redis_down_until = now + RATE_LIMIT_REDIS_RETRY_MS / 1000
+                logger.warning("Rate limiter cannot reach Redis, limiting per worker for %.1fs",
+                               RATE_LIMIT_REDIS_RETRY_MS / 1000)
+        metrics.rate_limit_fallbacks.inc()
+        return self.local.take(key, rate, burst, now)
+
+
+limiter = RateLimiter(parse_rules(RATE_LIMIT_RULES))
+
+
+# Admission control in front of routing: sheds load with a 503 once too many
+# requests are in flight, and applies the per-route token buckets. Both
+# answer before any dependency opens a DB session.
+class AdmissionMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route(self, scope):
+        if self._routes is None:
+            self._routes = {
+                (method, route.path): route
+                for route in scope["app"].routes
+                for method in getattr(route, "methods", None) or ()
+            }
+        return self._routes.get((scope["method"], scope["path"]))
+
+    async def _reject(self, scope, send, status: int, reason: str, body: bytes, retry_after: float):
+        route = self._route(scope)
+        if route is not None:
+            # label the rejection with its route in the request metrics
+            scope["route"] = route
+        metrics.rate_limited.labels(route.path if route is not None else "unmatched", reason).inc()
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if not enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if limiter.inflight >= limiter.max_inflight > 0 and scope["path"] != "/metrics":
+            await self._reject(scope, send, 503, "overload", OVERLOADED_BODY, 1)
+            return
+        rule = limiter.rules.get((scope["method"], scope["path"]))
+        if rule is not None:
+            identity, multiplier = limiter.identity(scope, dict(scope["headers"]))
+            allowed, retry_after = await limiter.hit(rule, identity, multiplier)
+            if not allowed:
+                await self._reject(scope, send, 429, "limit", TOO_MANY_BODY, retry_after)
+                return
+        limiter.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.inflight -= 1
@@ -1,15 +1,192 @@
-import redis
+import asyncio
+import bisect
+import hashlib
 import os
+import time
+
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+
+import metrics
+import tracing
+from config import REDIS_CACHE_NODES, REDIS_CACHE_VNODES
 
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB = int(os.getenv("REDIS_DB", "0"))
 
-r = redis.Redis(
+
+class TimedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        latency, errors = metrics.redis_command("PIPELINE")
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            latency.observe(elapsed)
+            tracing.record_redis("PIPELINE", elapsed)
+
+
+class InstrumentedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        latency, errors = metrics.redis_command(args[0])
+        started = time.perf_counter()
+        try:
+            result = await super().execute_command(*args, **options)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            latency.observe(elapsed)
+            tracing.record_redis(args[0], elapsed)
+        if args[0] == "GET":
+            if result is None:
+                metrics.redis_misses.inc()
+            else:
+                metrics.redis_hits.inc()
+        return result
+
+    def pipeline(self, transaction: bool = True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+r = InstrumentedRedis(
     host=REDIS_HOST,
     port=REDIS_PORT,
     db=REDIS_DB,
     decode_responses=True,
     socket_connect_timeout=5,
     socket_timeout=5,
-)
\ No newline at end of file
+)
+
+
+# Consistent hashing with virtual nodes: adding or removing one of N nodes
+# only moves about 1/N of the keys.
+class HashRing:
+    def __init__(self, nodes=(), vnodes: int = 160):
+        self.vnodes = vnodes
+        self._points = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def add(self, node: str):
+        for replica in range(self.vnodes):
+            bisect.insort(self._points, (self._hash(f"{node}#{replica}"), node))
+        self._hashes = [point for point, _ in self._points]
+
+    def remove(self, node: str):
+        self._points = [(point, owner) for point, owner in self._points if owner != node]
+        self._hashes = [point for point, _ in self._points]
+
+    def node_for(self, key: str) -> str:
+        if not self._points:
+            raise LookupError("hash ring is empty")
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardedPipeline:
+    def __init__(self, sharded):
+        self.sharded = sharded
+        self.commands = []
+
+    def _queue(self, name, key, *args, **kwargs):
+        self.commands.append((name, key, args, kwargs))
+        return self
+
+    def get(self, key):
+        return self._queue("get", key)
+
+    def set(self, key, value, **kwargs):
+        return self._queue("set", key, value, **kwargs)
+
+    def delete(self, key):
+        return self._queue("delete", key)
+
+    async def _run_on(self, node: str, indexes: list):
+        async with self.sharded.nodes[node].pipeline(transaction=False) as pipe:
+            for index in indexes:
+                name, key, args, kwargs = self.commands[index]
+                getattr(pipe, name)(key, *args, **kwargs)
+            return indexes, await pipe.execute()
+
+    async def execute(self):
+        # one pipeline per node, all in flight at once
+        by_node = {}
+        for index, (_, key, _, _) in enumerate(self.commands):
+            by_node.setdefault(self.sharded.ring.node_for(key), []).append(index)
+        results = [None] * len(self.commands)
+        for indexes, values in await asyncio.gather(*(self._run_on(node, indexes)
+                                                      for node, indexes in by_node.items())):
+            for index, value in zip(indexes, values):
+                results[index] = value
+        self.commands = []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+
+# Key-routed client over several Redis nodes, each with its own connection
+# pool. Only covers the key/value commands the link cache uses.
+class ShardedRedis:
+    def __init__(self, nodes: dict, vnodes: int = REDIS_CACHE_VNODES):
+        self.nodes = dict(nodes)
+        self.ring = HashRing(self.nodes, vnodes)
+
+    @classmethod
+    def from_urls(cls, urls, vnodes: int = REDIS_CACHE_VNODES):
+        return cls({
+            url: InstrumentedRedis.from_url(url, decode_responses=True, socket_connect_timeout=5, socket_timeout=5)
+            for url in urls
+        }, vnodes)
+
+    def node(self, key: str):
+        return self.nodes[self.ring.node_for(key)]
+
+    def add_node(self, name: str, client):
+        self.nodes[name] = client
+        self.ring.add(name)
+
+    def remove_node(self, name: str):
+        self.ring.remove(name)
+        return self.nodes.pop(name)
+
+    async def get(self, key):
+        return await self.node(key).get(key)
+
+    async def set(self, key, value, **kwargs):
+        return await self.node(key).set(key, value, **kwargs)
+
+    async def delete(self, *keys):
+        by_node = {}
+        for key in keys:
+            by_node.setdefault(self.ring.node_for(key), []).append(key)
+        deleted = await asyncio.gather(*(self.nodes[node].delete(*node_keys) for node, node_keys in by_node.items()))
+        return sum(deleted)
+
+    def pipeline(self, transaction: bool = False):
+        return ShardedPipeline(self)
+
+    async def aclose(self):
+        for client in self.nodes.values():
+            await client.aclose()
+
+
+links = ShardedRedis.from_urls(REDIS_CACHE_NODES) if REDIS_CACHE_NODES else None
+
+
+def link_store():
+    return links if links is not None else r
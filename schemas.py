@@ -1,6 +1,8 @@
-from pydantic import BaseModel, HttpUrl, EmailStr
+from pydantic import BaseModel, HttpUrl, EmailStr, Field
 from datetime import datetime
-from typing import Optional
+from enum import Enum
+from typing import List, Optional
+from config import BATCH_SHORTEN_MAX_ITEMS
 
 class LinkBase(BaseModel):
     original_url: HttpUrl
@@ -8,16 +10,41 @@ class LinkBase(BaseModel):
 class LinkCreate(LinkBase):
     custom_alias: Optional[str] = None
     expires_at: Optional[datetime] = None
+    permanent: bool = False
+
+class LinkBatchCreate(BaseModel):
+    # checked while the items are parsed, so an oversized batch stops early
+    items: List[LinkCreate] = Field(max_length=BATCH_SHORTEN_MAX_ITEMS)
+    prefill_cache: bool = False
+
+class LinkBatchResult(BaseModel):
+    index: int
+    short_code: Optional[str] = None
+    original_url: Optional[HttpUrl] = None
+    expires_at: Optional[datetime] = None
+    error: Optional[str] = None
 
 class LinkUpdate(BaseModel):
     original_url: Optional[HttpUrl] = None
     expires_at: Optional[datetime] = None
 
+class Granularity(str, Enum):
+    minute = "minute"
+    hour = "hour"
+    day = "day"
+
+class ClickBucket(BaseModel):
+    bucket_start: datetime
+    count: int
+
 class LinkStats(BaseModel):
     original_url: HttpUrl
     created_at: datetime
     last_accessed: Optional[datetime] = None
     click_count: int
+    unique_visitors: Optional[int] = None
+    granularity: Optional[Granularity] = None
+    series: Optional[List[ClickBucket]] = None
 
     class Config:
         orm_mode = True
@@ -30,6 +57,26 @@ class LinkResponse(BaseModel):
     class Config:
         orm_mode = True
 
+class UserLink(BaseModel):
+    short_code: str
+    original_url: HttpUrl
+    created_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    last_accessed: Optional[datetime] = None
+    click_count: int = 0
+    permanent: bool = False
+
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+class ImportSummary(BaseModel):
+    imported: int
+    failed: int
+    seconds: float
+    rows_per_second: float
+    errors: List[ImportRowError]
+
 class UserBase(BaseModel):
     username: str
     email: EmailStr
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, insert, delete, text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import analytics
+import bloom
+import cache
+import visitors
+from config import (EXPIRY_SWEEP_MODE, EXPIRY_SWEEP_INTERVAL_MS, EXPIRY_SWEEP_BATCH_SIZE,
+                    EXPIRY_SWEEP_BATCH_PAUSE_MS, EXPIRED_LINK_RETENTION_HOURS)
+from database import SessionLocal
+from models import Link, ArchivedLink
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED_COLUMNS = ("original_url", "short_code", "created_at", "last_accessed",
+                    "click_count", "expires_at", "owner_id")
+
+
+async def sweep_batch(db: AsyncSession, cutoff: datetime, batch_size: int, mode: str) -> list:
+    # walks the expires_at index; each batch is its own short transaction.
+    # Every worker sweeps, so the batch is claimed the way click rollups are:
+    # row locks elsewhere, the database write lock up front on SQLite.
+    if db.bind.dialect.name == "sqlite":
+        await db.execute(text("BEGIN IMMEDIATE"))
+    rows = (await db.execute(
+        select(Link.id, Link.short_code)
+        .where(Link.expires_at < cutoff)
+        .order_by(Link.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )).all()
+    if not rows:
+        return []
+    ids = [link_id for link_id, _ in rows]
+    if mode == "archive":
+        await db.execute(insert(ArchivedLink).from_select(
+            ("link_id",) + ARCHIVED_COLUMNS,
+            select(Link.id, *(getattr(Link, column) for column in ARCHIVED_COLUMNS)).where(Link.id.in_(ids)),
+        ))
+    await analytics.delete_click_history(db, ids)
+    await db.execute(delete(Link).where(Link.id.in_(ids)))
+    await db.commit()
+    return rows
+
+
+class ExpirySweeper:
+    def __init__(self, mode: str, interval_ms: int, batch_size: int, batch_pause_ms: int,
+                 retention_hours: float, session_factory=SessionLocal):
+        if mode not in ("archive", "delete"):
+            raise ValueError(f"Unknown expiry sweep mode: {mode}")
+        self.mode = mode
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause_ms / 1000
+        self.retention = timedelta(hours=retention_hours)
+        self.session_factory = session_factory
+        self.swept = 0
+        self._stopping = None
+        self._task = None
+
+    async def run_once(self) -> int:
+        cutoff = datetime.utcnow() - self.retention
+        swept = 0
+        while True:
+            async with self.session_factory() as db:
+                rows = await sweep_batch(db, cutoff, self.batch_size, self.mode)
+            short_codes = [short_code for _, short_code in rows]
+            if rows:
+                swept += len(rows)
+                visitors.counter.forget([link_id for link_id, _ in rows])
+                try:
+                    await cache.invalidate_links(short_codes)
+                    await bloom.codes.remove(short_codes)
+                except Exception:
+                    logger.exception("Could not purge cache entries of swept links")
+            if len(short_codes) < self.batch_size:
+                break
+            # pause between batches so writers are never locked out for long
+            await asyncio.sleep(self.batch_pause)
+        self.swept += swept
+        if swept:
+            logger.info("Swept %d expired links (%s)", swept, self.mode)
+        return swept
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("Expiry sweep failed")
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+
+sweeper = ExpirySweeper(EXPIRY_SWEEP_MODE, EXPIRY_SWEEP_INTERVAL_MS, EXPIRY_SWEEP_BATCH_SIZE,
+                        EXPIRY_SWEEP_BATCH_PAUSE_MS, EXPIRED_LINK_RETENTION_HOURS)
@@ -5,22 +5,12 @@ from datetime import datetime, timedelta
 from fastapi.testclient import TestClient
 from main import app
 import redis_client
+from tests.fake_redis import FakeRedis
 
 client = TestClient(app)
 
 
 # Override redis client for tests
-class FakeRedis:
-    def get(self, key):
-        return None
-
-    def set(self, key, value, ex=None):
-        pass
-
-    def delete(self, key):
-        pass
-
-
 redis_client.r = FakeRedis()
 
 
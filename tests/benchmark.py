@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "benchmark_baseline.json")
+DEFAULT_TOLERANCE = 0.3
+BENCH_PASSWORD = "bench-password"
+# scenarios measured with the raw ASGI redirect fast path switched off
+WITHOUT_FAST_PATH = {"redirect_hit_no_fast_path"}
+# scenarios that start from a link cache holding every seeded link
+PRIMED_CACHE = {"redirect_hit", "redirect_hit_no_fast_path"}
+
+
+# Samples ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** s,
+# so a few codes take most of the traffic like on a real shortener.
+class ZipfSampler:
+    def __init__(self, n: int, s: float, rng: random.Random):
+        self.rng = rng
+        weights = [1 / (rank + 1) ** s for rank in range(n)]
+        self.cumulative = list(itertools.accumulate(weights))
+
+    def sample(self) -> int:
+        return bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+# Counts link cache lookups, so each scenario reports how many of its
+# redirects were answered without the database.
+class CacheHitCounter:
+    def __init__(self, get_link):
+        self.get_link = get_link
+        self.hits = 0
+        self.misses = 0
+
+    async def __call__(self, short_code: str):
+        cached = await self.get_link(short_code)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return cached
+
+    def reset(self):
+        self.hits = self.misses = 0
+
+    def ratio(self):
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 4) if lookups else None
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list, elapsed: float, errors: int) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+# A scenario regresses when its p95 latency grows or its throughput drops by
+# more than the tolerance, or when it starts returning unexpected statuses.
+def compare(results: dict, baseline: dict) -> list:
+    default_tolerance = baseline.get("tolerance", DEFAULT_TOLERANCE)
+    failures = []
+    for name, budget in baseline.get("scenarios", {}).items():
+        result = results["scenarios"].get(name)
+        if result is None:
+            continue
+        tolerance = budget.get("tolerance", default_tolerance)
+        if result["errors"]:
+            failures.append(f"{name}: {result['errors']} unexpected responses")
+        if "p95_ms" in budget and result["p95_ms"] > budget["p95_ms"] * (1 + tolerance):
+            failures.append(f"{name}: p95 {result['p95_ms']}ms over budget {budget['p95_ms']}ms")
+        if "rps" in budget and result["rps"] < budget["rps"] * (1 - tolerance):
+            failures.append(f"{name}: {result['rps']} req/s under budget {budget['rps']} req/s")
+    return failures
+
+
+class Benchmark:
+    def __init__(self, client, links: int, zipf_s: float, concurrency: int, seed: int):
+        self.client = client
+        self.links = links
+        self.concurrency = concurrency
+        self.rng = random.Random(seed)
+        self.popularity = ZipfSampler(links, zipf_s, self.rng)
+        self.token = None
+
+    @staticmethod
+    def seeded_code(rank: int) -> str:
+        from utils import encode_base62
+        # one character longer than allocated codes, so they never collide
+        return "b" + encode_base62(rank, 6)
+
+    async def seed(self):
+        from sqlalchemy import insert
+        import crud
+        import hashing
+        import models
+        from database import SessionLocal
+
+        domains = [f"site{i}.example.com" for i in range(50)]
+        async with SessionLocal() as db:
+            for start in range(0, self.links, 5000):
+                rows = [
+                    {
+                        **crud.url_fields(f"https://{domains[rank % len(domains)]}/page/{rank}"),
+                        "short_code": self.seeded_code(rank),
+                    }
+                    for rank in range(start, min(start + 5000, self.links))
+                ]
+                await db.execute(insert(models.Link), rows)
+            db.add(models.User(username="bench", email="bench@example.com",
+                               hashed_password=hashing.hash_password(BENCH_PASSWORD)))
+            await db.commit()
+        response = await self.client.post("/token", data={"username": "bench", "password": BENCH_PASSWORD})
+        self.token = response.json()["access_token"]
+
+    async def prime_cache(self):
+        from sqlalchemy import select
+        import cache
+        import models
+        from database import SessionLocal
+
+        cache.local.clear()
+        # coldest first, so the hottest codes are the ones left in the bounded local cache
+        codes = [self.seeded_code(rank) for rank in reversed(range(self.links))]
+        async with SessionLocal() as db:
+            for start in range(0, len(codes), 5000):
+                by_code = {link.short_code: link for link in (await db.execute(
+                    select(models.Link).where(models.Link.short_code.in_(codes[start:start + 5000]))
+                )).scalars()}
+                await cache.set_links([by_code[code] for code in codes[start:start + 5000] if code in by_code])
+
+    def scenarios(self):
+        counter = itertools.count()
+        return {
+            "redirect_hit": (
+                lambda: self.client.get(f"/links/{self.seeded_code(self.popularity.sample())}"), 307),
+            "redirect_hit_no_fast_path": (
+                lambda: self.client.get(f"/links/{self.seeded_code(self.popularity.sample())}"), 307),
+            "redirect_miss": (
+                lambda: self.client.get(f"/links/m{self.rng.getrandbits(40):012x}"), 404),
+            "shorten": (
+                lambda: self.client.post("/links/shorten",
+                                         json={"original_url": f"https://new.example.com/{next(counter)}"}), 200),
+            "batch_shorten": (
+                lambda: self.client.post("/links/shorten/batch", json={"items": [
+                    {"original_url": f"https://batch.example.com/{next(counter)}"} for _ in range(50)
+                ]}), 200),
+            "stats": (
+                lambda: self.client.get(f"/links/{self.seeded_code(self.popularity.sample())}/stats"), 200),
+            "search": (
+                lambda: self.client.get("/links/search",
+                                        params={"domain": f"site{self.rng.randrange(50)}.example.com"}), 200),
+            "login": (
+                lambda: self.client.post("/token", data={"username": "bench", "password": BENCH_PASSWORD}), 200),
+        }
+
+    async def run_scenario(self, send, expected_status: int, requests: int) -> dict:
+        remaining = iter(range(requests))
+        latencies = []
+        errors = 0
+
+        async def worker():
+            nonlocal errors
+            for _ in remaining:
+                started = time.perf_counter()
+                response = await send()
+                latencies.append(time.perf_counter() - started)
+                if response.status_code != expected_status:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        return summarize(latencies, time.perf_counter() - started, errors)
+
+
+async def run(args) -> dict:
+    import httpx
+    import cache
+    import fastpath
+    import migrations
+    import ratelimit
+    import redis_client
+    from main import app
+    from tests.fake_redis import FakeRedis
+
+    migrations.upgrade()
+    redis_client.r = FakeRedis()
+    lookups = cache.get_link = CacheHitCounter(cache.get_link)
+    # every benchmark request comes from one client; measure the app, not the limits
+    ratelimit.enabled = False
+    requests = {"login": args.login_requests, "batch_shorten": max(10, args.requests // 20)}
+    results = {
+        "config": {"links": args.links, "requests": args.requests, "concurrency": args.concurrency,
+                   "zipf_s": args.zipf_s, "seed": args.seed},
+        "scenarios": {},
+    }
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False, client=("10.0.0.1", 40000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            bench = Benchmark(client, args.links, args.zipf_s, args.concurrency, args.seed)
+            await bench.seed()
+            for name, (send, expected_status) in bench.scenarios().items():
+                if args.scenario and name not in args.scenario:
+                    continue
+                count = requests.get(name, args.requests)
+                fastpath.enabled = name not in WITHOUT_FAST_PATH
+                if name in PRIMED_CACHE:
+                    await bench.prime_cache()
+                # untimed warm-up so every scenario is measured with warm caches
+                await bench.run_scenario(send, expected_status, min(count, args.warmup))
+                lookups.reset()
+                results["scenarios"][name] = await bench.run_scenario(send, expected_status, count)
+                if name.startswith("redirect"):
+                    results["scenarios"][name]["cache_hit_ratio"] = lookups.ratio()
+                print(f"{name:>14}: {results['scenarios'][name]}", file=sys.stderr)
+            fastpath.enabled = True
+    scenarios = results["scenarios"]
+    if "redirect_hit" in scenarios and "redirect_hit_no_fast_path" in scenarios:
+        speedup = scenarios["redirect_hit"]["rps"] / scenarios["redirect_hit_no_fast_path"]["rps"]
+        results["fast_path_speedup"] = round(speedup, 2)
+        print(f"redirect fast path: {speedup:.2f}x req/s", file=sys.stderr)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="In-process benchmark of the URL shortener API")
+    parser.add_argument("--links", type=int, default=10000, help="links seeded before the run")
+    parser.add_argument("--requests", type=int, default=2000, help="timed requests per scenario")
+    parser.add_argument("--login-requests", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="Zipf exponent of code popularity")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="store this run as the new baseline instead of comparing")
+    args = parser.parse_args(argv)
+
+    # the app reads its settings at import time, so point it at a scratch
+    # database before anything imports config
+    workdir = tempfile.mkdtemp(prefix="shortener-bench-")
+    os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault("BCRYPT_ROUNDS", "12")
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        previous = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                previous = json.load(f)
+        # hand-tuned tolerances survive a refresh of the numbers
+        baseline = {
+            "tolerance": previous.get("tolerance", DEFAULT_TOLERANCE),
+            "scenarios": {
+                name: {"p95_ms": result["p95_ms"], "rps": result["rps"],
+                       **{key: value for key, value in previous.get("scenarios", {}).get(name, {}).items()
+                          if key == "tolerance"}}
+                for name, result in results["scenarios"].items()
+            },
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        return 0
+    if not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline) as f:
+        failures = compare(results, json.load(f))
+    for failure in failures:
+        print(f"REGRESSION {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import random
+import time
+import pytest
+import cache
+import redis_client
+from tests.fake_redis import FakeRedis
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    # a fresh Redis and an empty per-worker cache for one test
+    server = FakeRedis()
+    monkeypatch.setattr(redis_client, "r", server)
+    cache.local.clear()
+    return server
+
+
+def login(client, username: str = None) -> dict:
+    username = username or f"user_{int(time.time() * 1000)}{random.randint(100, 999)}"
+    client.post("/users/register", json={"username": username, "email": f"{username}@example.com", "password": "secret"})
+    token = client.post("/token", data={"username": username, "password": "secret"}).json()["access_token"]
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,177 @@
+import asyncio
+import functools
+import hashlib
+import inspect
+import queue
+import time
+
+from redis.exceptions import NoScriptError
+
+import tracing
+from visitors import HyperLogLog
+
+
+class FakePubSub:
+    def __init__(self, server, ignore_subscribe_messages=False):
+        self.server = server
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.add(channel)
+            self.server.subscribers.setdefault(channel, []).append(self)
+
+    async def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        # publishers may live on another event loop (TestClient runs each
+        # request on its own), so poll a thread-safe queue instead of awaiting it
+        deadline = asyncio.get_running_loop().time() + (timeout or 0)
+        while True:
+            try:
+                return self.messages.get_nowait()
+            except queue.Empty:
+                if asyncio.get_running_loop().time() >= deadline:
+                    return None
+                await asyncio.sleep(0.01)
+
+    async def aclose(self):
+        for channel in self.channels:
+            self.server.subscribers[channel].remove(self)
+        self.channels.clear()
+
+
+class FakePipeline:
+    def __init__(self, server):
+        self.server = server
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue_command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue_command
+
+    async def execute(self):
+        # one round trip, like a real pipeline
+        tracing.record_redis("PIPELINE", 0.0)
+        results = [await getattr(self.server, name).__wrapped__(self.server, *args, **kwargs)
+                   for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.commands = []
+
+
+def _traced_commands(cls):
+    # report commands to the request trace the way redis_client does
+    for name, func in list(vars(cls).items()):
+        if inspect.iscoroutinefunction(func):
+            def traced(self, *args, _func=func, _command=name.upper(), **kwargs):
+                tracing.record_redis(_command, 0.0)
+                return _func(self, *args, **kwargs)
+            setattr(cls, name, functools.wraps(func)(traced))
+    return cls
+
+
+def _token_bucket(server, keys, args):
+    import ratelimit
+    rate, burst, cost = map(float, args)
+    now = time.time()
+    tokens, updated = server.store.get(keys[0], (None, now))
+    allowed, tokens, retry_after = ratelimit.take(tokens, updated, now, rate, burst, cost)
+    server.store[keys[0]] = (tokens, now)
+    return [int(allowed), repr(retry_after)]
+
+
+# Python versions of the Lua scripts the app loads, keyed by script name.
+SCRIPTS = {"TOKEN_BUCKET_SCRIPT": _token_bucket}
+
+
+# In-memory stand-in for redis.asyncio.Redis covering the commands the app uses.
+@_traced_commands
+class FakeRedis:
+    def __init__(self):
+        self.store = {}
+        self.ttls = {}
+        self.subscribers = {}
+        self.scripts = {}
+
+    async def get(self, key):
+        return self.store.get(key)
+
+    async def set(self, key, value, ex=None, px=None, nx=False):
+        if nx and key in self.store:
+            return None
+        self.store[key] = value
+        self.ttls[key] = ex if px is None else px / 1000
+        return True
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self.store.pop(key, None) is not None
+            self.ttls.pop(key, None)
+        return deleted
+
+    async def exists(self, *keys):
+        return sum(key in self.store for key in keys)
+
+    async def incrby(self, key, amount=1):
+        self.store[key] = int(self.store.get(key, 0)) + amount
+        return self.store[key]
+
+    async def expire(self, key, seconds):
+        self.ttls[key] = seconds
+        return key in self.store
+
+    async def pfadd(self, key, *elements):
+        sketch = self.store.setdefault(key, HyperLogLog())
+        changed = [sketch.add(element) for element in elements]
+        return int(any(changed))
+
+    async def pfcount(self, *keys):
+        merged = HyperLogLog()
+        for key in keys:
+            if key in self.store:
+                merged.merge(self.store[key])
+        return merged.count()
+
+    async def setbit(self, key, offset, value):
+        bits = self.store.setdefault(key, set())
+        previous = int(offset in bits)
+        if value:
+            bits.add(offset)
+        else:
+            bits.discard(offset)
+        return previous
+
+    async def getbit(self, key, offset):
+        return int(offset in self.store.get(key, ()))
+
+    async def publish(self, channel, message):
+        receivers = self.subscribers.get(channel, [])
+        for pubsub in receivers:
+            pubsub.messages.put({"type": "message", "channel": channel, "data": message})
+        return len(receivers)
+
+    async def script_load(self, script):
+        import ratelimit
+        name = next(name for name in SCRIPTS if getattr(ratelimit, name) == script)
+        sha = hashlib.sha1(script.encode()).hexdigest()
+        self.scripts[sha] = SCRIPTS[name]
+        return sha
+
+    async def evalsha(self, sha, numkeys, *args):
+        if sha not in self.scripts:
+            raise NoScriptError("No matching script. Please use EVAL.")
+        return self.scripts[sha](self, args[:numkeys], args[numkeys:])
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self, ignore_subscribe_messages)
@@ -1,23 +1,94 @@
-from locust import HttpUser, task, between
+from locust import HttpUser, task, between, events
+import bisect
+import itertools
 import random
 import string
+import uuid
+
+# Run the app with RATE_LIMIT_ENABLED=false: all simulated users share one
+# address and would otherwise be throttled as a single client.
+# Links shared by every simulated user; popularity over them is Zipf-like so
+# redirects are dominated by cache hits on a few hot codes.
+POOL_SIZE = 2000
+ZIPF_S = 1.1
+DOMAINS = [f"site{i}.example.com" for i in range(50)]
+pool = []
+cumulative = list(itertools.accumulate(1 / (rank + 1) ** ZIPF_S for rank in range(POOL_SIZE)))
+
 
 def random_url():
-    rand_str = ''.join(random.choices(string.ascii_lowercase, k=5))
-    return f"http://example.com/{rand_str}"
+    rand_str = ''.join(random.choices(string.ascii_lowercase, k=8))
+    return f"https://{random.choice(DOMAINS)}/{rand_str}"
+
+
+def popular_code():
+    rank = bisect.bisect(cumulative, random.random() * cumulative[min(len(pool), POOL_SIZE) - 1])
+    return pool[min(rank, len(pool) - 1)]
+
+
+@events.test_start.add_listener
+def seed_links(environment, **kwargs):
+    import requests
+    pool.clear()
+    for _ in range(POOL_SIZE // 100):
+        response = requests.post(f"{environment.host}/links/shorten/batch",
+                                 json={"items": [{"original_url": random_url()} for _ in range(100)],
+                                       "prefill_cache": True})
+        response.raise_for_status()
+        pool.extend(item["short_code"] for item in response.json() if item.get("short_code"))
+
+
+class RedirectUser(HttpUser):
+    weight = 20
+    wait_time = between(0.1, 0.5)
+
+    @task(19)
+    def redirect_hit(self):
+        self.client.get(f"/links/{popular_code()}", allow_redirects=False, name="/links/[code]")
 
-class URLShortenerUser(HttpUser):
+    @task(1)
+    def redirect_miss(self):
+        with self.client.get(f"/links/zz{uuid.uuid4().hex[:8]}", allow_redirects=False,
+                             name="/links/[missing]", catch_response=True) as response:
+            if response.status_code == 404:
+                response.success()
+
+
+class CreatorUser(HttpUser):
+    weight = 3
     wait_time = between(1, 3)
 
-    @task(5)
+    def on_start(self):
+        username = f"load{uuid.uuid4().hex[:12]}"
+        password = uuid.uuid4().hex
+        self.client.post("/users/register", json={"username": username, "email": f"{username}@example.com",
+                                                  "password": password})
+        response = self.client.post("/token", data={"username": username, "password": password})
+        self.client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+    @task(10)
     def create_link(self):
-        original_url = random_url()
-        self.client.post("/links/shorten", json={"original_url": original_url})
+        self.client.post("/links/shorten", json={"original_url": random_url()})
+
+    @task(1)
+    def create_batch(self):
+        self.client.post("/links/shorten/batch",
+                         json={"items": [{"original_url": random_url()} for _ in range(20)]})
+
+
+class AnalystUser(HttpUser):
+    weight = 1
+    wait_time = between(2, 5)
+
+    @task(3)
+    def stats(self):
+        self.client.get(f"/links/{popular_code()}/stats", name="/links/[code]/stats")
+
+    @task(1)
+    def stats_series(self):
+        self.client.get(f"/links/{popular_code()}/stats", params={"granularity": "hour"},
+                        name="/links/[code]/stats?granularity")
 
     @task(2)
-    def redirect_link(self):
-        original_url = random_url()
-        response = self.client.post("/links/shorten", json={"original_url": original_url})
-        if response.ok:
-            short_code = response.json()["short_code"]
-            self.client.get(f"/links/{short_code}", allow_redirects=False)
\ No newline at end of file
+    def search(self):
+        self.client.get("/links/search", params={"domain": random.choice(DOMAINS)}, name="/links/search")
@@ -0,0 +1,23 @@
+import asyncio
+import redis_client
+from allocator import LeasedBlockAllocator, RedisBlockSource
+from tests.fake_redis import FakeRedis
+
+
+def test_workers_lease_disjoint_blocks(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    source = RedisBlockSource(key="seq:test")
+    first = LeasedBlockAllocator(source, block_size=3, length=6, key="k")
+    second = LeasedBlockAllocator(source, block_size=3, length=6, key="k")
+
+    async def allocate():
+        codes = []
+        for _ in range(4):
+            codes.append(await first.next_code())
+            codes.append(await second.next_code())
+        return codes
+
+    codes = asyncio.run(allocate())
+    assert len(set(codes)) == 8
+    assert all(len(code) == 6 and code.isalnum() for code in codes)
+    assert redis_client.r.store["seq:test"] == 12
@@ -1,18 +1,23 @@
+import asyncio
+import json
 import time
 import random
 from datetime import datetime, timedelta
+from anyio.from_thread import start_blocking_portal
 from fastapi.testclient import TestClient
 from main import app
+from config import BATCH_SHORTEN_MAX_ITEMS
 import redis_client
+import clicks
+import crud
+import cache
+import analytics
+import auth
+import sweeper
+from tests.conftest import login
+from tests.fake_redis import FakeRedis
 
 client = TestClient(app)
-class FakeRedis:
-    def get(self, key):
-        return None
-    def set(self, key, value, ex=None):
-        pass
-    def delete(self, key):
-        pass
 
 redis_client.r = FakeRedis()
 
@@ -38,6 +43,41 @@ def test_create_link_with_custom_alias():
     data = response.json()
     assert data["short_code"] == custom_alias
 
+def test_custom_alias_conflict():
+    custom_alias = f"taken{int(time.time() * 1000)}"
+    first = client.post("/links/shorten", json={"original_url": "http://first.com", "custom_alias": custom_alias})
+    assert first.status_code == 200, first.text
+    second = client.post("/links/shorten", json={"original_url": "http://second.com", "custom_alias": custom_alias})
+    assert second.status_code == 400
+
+def test_batch_shorten():
+    taken_alias = f"batch{int(time.time() * 1000)}"
+    client.post("/links/shorten", json={"original_url": "http://taken.com", "custom_alias": taken_alias})
+    new_alias = f"fresh{int(time.time() * 1000)}"
+    items = [{"original_url": f"http://batch.com/{i}"} for i in range(50)]
+    items += [{"original_url": "http://batch.com/a", "custom_alias": taken_alias},
+              {"original_url": "http://batch.com/b", "custom_alias": new_alias},
+              {"original_url": "http://batch.com/c", "custom_alias": new_alias}]
+    response = client.post("/links/shorten/batch", json={"items": items, "prefill_cache": True})
+    assert response.status_code == 200, response.text
+    results = response.json()
+    assert [result["index"] for result in results] == list(range(len(items)))
+    created = [result for result in results if result["error"] is None]
+    assert len(created) == 51
+    assert len({result["short_code"] for result in created}) == 51
+    assert results[50]["error"] and results[52]["error"]
+    assert results[51]["short_code"] == new_alias
+    assert f"link:{new_alias}" in redis_client.r.store
+
+    redirect_response = client.get(f"/links/{results[7]['short_code']}", follow_redirects=False)
+    assert normalize_url(redirect_response.headers["location"]) == "http://batch.com/7"
+
+def test_batch_shorten_rejects_oversized_batches():
+    items = [{"original_url": "http://batch.com/over"}] * (BATCH_SHORTEN_MAX_ITEMS + 1)
+    response = client.post("/links/shorten/batch", json={"items": items})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "too_long"
+
 def test_link_stats():
     original_url = "http://example.net"
     create_response = client.post("/links/shorten", json={"original_url": original_url})
@@ -51,6 +91,131 @@ def test_link_stats():
     assert stats["click_count"] >= 1
     assert "created_at" in stats
 
+def test_clicks_are_batched_until_flush():
+    create_response = client.post("/links/shorten", json={"original_url": "http://clicks.com"})
+    short_code = create_response.json()["short_code"]
+    for _ in range(3):
+        client.get(f"/links/{short_code}", follow_redirects=False)
+    assert clicks.buffer.pending_events >= 3
+    stats = client.get(f"/links/{short_code}/stats").json()
+    assert stats["click_count"] == 3
+    assert stats["last_accessed"] is not None
+    assert clicks.buffer.pending_events == 0
+
+def test_cache_hit_redirects_without_db(monkeypatch):
+    create_response = client.post("/links/shorten", json={"original_url": "http://cachehit.com"})
+    short_code = create_response.json()["short_code"]
+    client.get(f"/links/{short_code}", follow_redirects=False)
+    assert redis_client.r.ttls[f"link:{short_code}"] == 3600
+
+    def no_db(*args, **kwargs):
+        raise AssertionError("cache hit must not query the database")
+    monkeypatch.setattr(crud, "get_link_by_code", no_db)
+    redirect_response = client.get(f"/links/{short_code}", follow_redirects=False)
+    assert redirect_response.status_code == 307
+    assert normalize_url(redirect_response.headers["location"]) == "http://cachehit.com"
+
+def test_cached_link_ttl_capped_at_expiry():
+    expires_at = (datetime.utcnow() + timedelta(minutes=10)).isoformat()
+    create_response = client.post("/links/shorten", json={"original_url": "http://soon.com", "expires_at": expires_at})
+    short_code = create_response.json()["short_code"]
+    client.get(f"/links/{short_code}", follow_redirects=False)
+    assert 590 <= redis_client.r.ttls[f"link:{short_code}"] <= 600
+
+def test_cached_expired_link_returns_gone():
+    create_response = client.post("/links/shorten", json={"original_url": "http://stale.com"})
+    short_code = create_response.json()["short_code"]
+    past = time.time() - 60
+    redis_client.r.store[f"link:{short_code}"] = f'[1,{past},"http://stale.com/"]'
+    redirect_response = client.get(f"/links/{short_code}", follow_redirects=False)
+    assert redirect_response.status_code == 410
+
+def test_update_invalidates_local_cache_on_every_worker():
+    headers = login(client)
+    short_code = client.post("/links/shorten", json={"original_url": "http://l1.com"}, headers=headers).json()["short_code"]
+    client.get(f"/links/{short_code}", follow_redirects=False)
+    assert cache.local.get(short_code) is not None
+
+    other_worker = cache.LocalCache(maxsize=10, ttl=30)
+    other_worker.set(short_code, cache.local.get(short_code))
+    listener = cache.InvalidationListener(cache.LINK_INVALIDATION_CHANNEL, other_worker.delete, other_worker.clear)
+    with start_blocking_portal() as portal:
+        portal.call(listener.start)
+        try:
+            client.put(f"/links/{short_code}", json={"original_url": "http://l1-new.com"}, headers=headers)
+            assert cache.local.get(short_code) is None
+            deadline = time.time() + 2
+            while other_worker.get(short_code) is not None and time.time() < deadline:
+                time.sleep(0.01)
+            assert other_worker.get(short_code) is None
+        finally:
+            portal.call(listener.stop)
+
+    redirect_response = client.get(f"/links/{short_code}", follow_redirects=False)
+    assert normalize_url(redirect_response.headers["location"]) == "http://l1-new.com"
+
+def test_stats_time_series_from_rollups():
+    create_response = client.post("/links/shorten", json={"original_url": "http://series.com"})
+    short_code = create_response.json()["short_code"]
+    for _ in range(4):
+        client.get(f"/links/{short_code}", follow_redirects=False)
+    client.get(f"/links/{short_code}/stats")
+    with start_blocking_portal() as portal:
+        portal.call(analytics.rollups.run_once)
+
+    for granularity in ("minute", "hour", "day"):
+        stats = client.get(f"/links/{short_code}/stats", params={"granularity": granularity}).json()
+        assert stats["granularity"] == granularity
+        assert sum(bucket["count"] for bucket in stats["series"]) == 4
+
+    past = (datetime.utcnow() - timedelta(days=3)).isoformat()
+    stats = client.get(f"/links/{short_code}/stats", params={"from": past, "to": past, "granularity": "day"}).json()
+    assert stats["series"] == []
+
+def test_stats_unique_visitors():
+    create_response = client.post("/links/shorten", json={"original_url": "http://visitors.com"})
+    short_code = create_response.json()["short_code"]
+    for agent in ("agent-a", "agent-b", "agent-a", "agent-c"):
+        client.get(f"/links/{short_code}", headers={"User-Agent": agent}, follow_redirects=False)
+    stats = client.get(f"/links/{short_code}/stats").json()
+    assert stats["click_count"] == 4
+    assert stats["unique_visitors"] == 3
+    stats = client.get(f"/links/{short_code}/stats", params={"granularity": "day"}).json()
+    assert stats["unique_visitors"] == 3
+
+def test_missing_codes_are_negatively_cached(monkeypatch):
+    short_code = f"nope{int(time.time() * 1000)}"
+    assert client.get(f"/links/{short_code}").status_code == 404
+    assert redis_client.r.store[f"link:{short_code}"] == cache.NOT_FOUND
+
+    def no_db(*args, **kwargs):
+        raise AssertionError("negative cache hit must not query the database")
+    with monkeypatch.context() as patch:
+        patch.setattr(crud, "get_link_by_code", no_db)
+        assert client.get(f"/links/{short_code}").status_code == 404
+
+    response = client.post("/links/shorten", json={"original_url": "http://late.com", "custom_alias": short_code})
+    assert response.status_code == 200
+    assert client.get(f"/links/{short_code}", follow_redirects=False).status_code == 307
+
+def test_single_flight_coalesces_concurrent_misses():
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "value"
+
+    async def burst():
+        flight = cache.SingleFlight()
+        results = await asyncio.gather(*(flight.do("code", loader) for _ in range(10)))
+        return flight, results
+
+    flight, results = asyncio.run(burst())
+    assert results == ["value"] * 10
+    assert len(calls) == 1
+    assert flight.coalesced == 9
+
 def test_update_and_delete_link():
     unique_suffix = str(int(time.time() * 1000)) + str(random.randint(100, 999))
     username = f"tester_{unique_suffix}"
@@ -91,6 +256,27 @@ def test_search_link():
     assert isinstance(links, list)
     assert any(normalize_url(link["original_url"]) == normalize_url(original_url) for link in links)
 
+def test_search_by_domain_and_prefix_with_cursor():
+    domain = f"d{int(time.time() * 1000)}.example.com"
+    items = [{"original_url": f"http://{domain}/docs/{i}"} for i in range(5)]
+    items.append({"original_url": f"http://{domain}/blog/1"})
+    client.post("/links/shorten/batch", json={"items": items})
+
+    first_page = client.get("/links/search", params={"domain": domain, "limit": 4})
+    assert first_page.status_code == 200, first_page.text
+    assert len(first_page.json()) == 4
+    cursor = first_page.headers["X-Next-Cursor"]
+    second_page = client.get("/links/search", params={"domain": domain, "limit": 4, "cursor": cursor})
+    assert len(second_page.json()) == 2
+    assert "X-Next-Cursor" not in second_page.headers
+
+    prefix_results = client.get("/links/search", params={"prefix": f"http://{domain}/docs/"}).json()
+    assert len(prefix_results) == 5
+    assert len(client.get("/links/search", params={"prefix": f"HTTP://{domain.upper()}/docs/"}).json()) == 5
+    assert client.get("/links/search", params={"prefix": f"{domain}/docs/"}).status_code == 400
+    assert client.get("/links/search", params={"prefix": "https://"}).status_code == 400
+    assert client.get("/links/search").status_code == 400
+
 def test_expired_link():
     past_time = (datetime.utcnow() - timedelta(minutes=5)).isoformat()
     original_url = "http://expired.com"
@@ -100,6 +286,64 @@ def test_expired_link():
     redirect_response = client.get(f"/links/{short_code}", follow_redirects=False)
     assert redirect_response.status_code == 410
 
+def test_principal_cache_skips_user_lookup(monkeypatch):
+    username = f"cached_{int(time.time() * 1000)}{random.randint(100, 999)}"
+    headers = login(client, username)
+    assert client.post("/links/shorten", json={"original_url": "http://principal.com"}, headers=headers).status_code == 200
+
+    lookups = []
+    original_lookup = auth.get_user_by_username
+    async def counting_lookup(db, username):
+        lookups.append(username)
+        return await original_lookup(db, username)
+    monkeypatch.setattr(auth, "get_user_by_username", counting_lookup)
+    hits_before = auth.principals.stats()["hits"]
+    short_code = client.post("/links/shorten", json={"original_url": "http://principal.com"}, headers=headers).json()["short_code"]
+    assert client.delete(f"/links/{short_code}", headers=headers).status_code == 200
+    assert lookups == []
+    assert auth.principals.stats()["hits"] == hits_before + 2
+
+    with start_blocking_portal() as portal:
+        portal.call(auth.invalidate_user, username)
+    client.post("/links/shorten", json={"original_url": "http://principal.com"}, headers=headers)
+    assert lookups == [username]
+
+def test_expiry_sweeper_archives_and_purges():
+    long_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    short_code = client.post("/links/shorten", json={"original_url": "http://swept.com", "expires_at": long_ago}).json()["short_code"]
+    redis_client.r.store[f"link:{short_code}"] = "stale"
+    with start_blocking_portal() as portal:
+        swept = portal.call(sweeper.sweeper.run_once)
+    assert swept >= 1
+    assert f"link:{short_code}" not in redis_client.r.store
+    assert client.get(f"/links/{short_code}/stats").status_code == 404
+
+    recent = (datetime.utcnow() - timedelta(minutes=1)).isoformat()
+    short_code = client.post("/links/shorten", json={"original_url": "http://grace.com", "expires_at": recent}).json()["short_code"]
+    with start_blocking_portal() as portal:
+        portal.call(sweeper.sweeper.run_once)
+    assert client.get(f"/links/{short_code}", follow_redirects=False).status_code == 410
+
+def test_swept_link_ids_are_not_reused():
+    import models
+    from sqlalchemy import select
+    from database import SessionLocal
+
+    async def archived_ids(code):
+        async with SessionLocal() as db:
+            return (await db.execute(select(models.ArchivedLink.id, models.ArchivedLink.link_id)
+                                     .where(models.ArchivedLink.short_code == code))).one()
+
+    long_ago = (datetime.utcnow() - timedelta(days=30)).isoformat()
+    swept = []
+    for url in ("http://reuse1.com", "http://reuse2.com"):
+        code = client.post("/links/shorten", json={"original_url": url, "expires_at": long_ago}).json()["short_code"]
+        with start_blocking_portal() as portal:
+            portal.call(sweeper.sweeper.run_once)
+            swept.append(portal.call(archived_ids, code))
+    assert swept[0][1] != swept[1][1]
+    assert swept[0][0] != swept[1][0]
+
 def test_unauthorized_update():
     unique_suffix = str(int(time.time() * 1000)) + str(random.randint(100, 999))
     username1 = f"user1_{unique_suffix}"
@@ -146,4 +390,34 @@ def test_unauthorized_delete():
     headers2 = {"Authorization": f"Bearer {login2['access_token']}"}
 
     delete_response = client.delete(f"/links/{short_code}", headers=headers2)
-    assert delete_response.status_code == 404
\ No newline at end of file
+    assert delete_response.status_code == 404
+
+def test_list_my_links_pages_and_streams():
+    headers = login(client)
+    items = [{"original_url": f"http://mine.com/{i}"} for i in range(25)]
+    created = client.post("/links/shorten/batch", json={"items": items}, headers=headers).json()
+    codes = {item["short_code"] for item in created}
+
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 10, **({"cursor": cursor} if cursor else {})}
+        response = client.get("/users/me/links", params=params, headers=headers)
+        assert response.status_code == 200, response.text
+        seen += [link["short_code"] for link in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            break
+    assert len(seen) == 25 and set(seen) == codes
+    # same created_at second for the whole batch, so id order breaks the tie
+    assert seen == [item["short_code"] for item in reversed(created)]
+
+    streamed = client.get("/users/me/links", headers={**headers, "Accept": "application/x-ndjson"})
+    assert streamed.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in streamed.text.splitlines()]
+    assert [line["short_code"] for line in lines] == seen
+    first_page = client.get("/users/me/links", headers=headers).json()
+    assert lines[:len(first_page)] == first_page
+    assert "id" not in lines[0]
+
+    assert client.get("/users/me/links", params={"cursor": "nope"}, headers=headers).status_code == 400
+    assert client.get("/users/me/links").status_code == 401
@@ -0,0 +1,26 @@
+import random
+from tests.benchmark import ZipfSampler, compare
+
+
+def test_zipf_sampler_is_skewed():
+    sampler = ZipfSampler(1000, 1.1, random.Random(1))
+    samples = [sampler.sample() for _ in range(20000)]
+    assert all(0 <= rank < 1000 for rank in samples)
+    assert samples.count(0) > samples.count(1) > samples.count(10)
+    assert sum(rank < 10 for rank in samples) > len(samples) * 0.3
+
+
+def test_compare_flags_budget_overruns():
+    baseline = {"tolerance": 0.2, "scenarios": {
+        "redirect_hit": {"p95_ms": 10, "rps": 1000},
+        "shorten": {"p95_ms": 10, "rps": 100, "tolerance": 1.0},
+        "login": {"p95_ms": 10, "rps": 10},
+    }}
+    results = {"scenarios": {
+        "redirect_hit": {"p95_ms": 13, "rps": 700, "errors": 0},
+        "shorten": {"p95_ms": 19, "rps": 60, "errors": 2},
+    }}
+    failures = compare(results, baseline)
+    assert any(f.startswith("redirect_hit: p95") for f in failures)
+    assert any(f.startswith("redirect_hit: 700") for f in failures)
+    assert failures[2:] == ["shorten: 2 unexpected responses"]
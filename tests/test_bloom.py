@@ -0,0 +1,116 @@
+import asyncio
+from bloom import CountingBloomFilter, RedisBloomFilter, ShortCodeFilter, optimal_size
+import redis_client
+from tests.fake_redis import FakeRedis
+
+
+def test_optimal_size_matches_error_rate():
+    size, hashes = optimal_size(1_000_000, 0.01)
+    assert 9_500_000 < size < 9_700_000
+    assert hashes == 7
+
+
+def test_counting_filter_false_positive_rate():
+    codes = CountingBloomFilter(10000, 0.01)
+    for i in range(10000):
+        codes.add(f"code-{i}")
+    assert all(f"code-{i}" in codes for i in range(10000))
+    false_positives = sum(f"other-{i}" in codes for i in range(10000))
+    assert false_positives < 200
+
+
+def test_counting_filter_remove():
+    codes = CountingBloomFilter(1000, 0.01)
+    codes.add("abc")
+    codes.add("def")
+    codes.remove("abc")
+    assert "abc" not in codes
+    assert "def" in codes
+
+
+def test_short_code_filter_says_maybe_until_built(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    codes = ShortCodeFilter("local", 1000, 0.01, "bloom-test")
+    assert asyncio.run(codes.might_contain("missing"))
+    codes.ready = True
+    assert not asyncio.run(codes.might_contain("missing"))
+    asyncio.run(codes.add(["present"]))
+    assert asyncio.run(codes.might_contain("present"))
+    assert codes.rejected == 1
+
+
+def test_short_code_filter_applies_other_workers_updates(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    codes = ShortCodeFilter("local", 1000, 0.01, "bloom-test")
+    codes.ready = True
+    codes.apply_update("other-worker +abc +def")
+    codes.apply_update("other-worker -abc")
+    codes.apply_update(f"{codes.worker_id} +ghi")
+    assert asyncio.run(codes.might_contain_many(["abc", "def", "ghi"])) == {"def"}
+    codes.updates_lost()
+    assert asyncio.run(codes.might_contain("ghi"))
+
+
+def test_redis_filter_is_shared(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    first = ShortCodeFilter("redis", 1000, 0.01, "bloom-test")
+    second = ShortCodeFilter("redis", 1000, 0.01, "bloom-test")
+    first.ready = second.ready = True
+    asyncio.run(first.add(["abc"]))
+    asyncio.run(redis_client.r.set(first._filter.ready_key, "1"))
+    assert asyncio.run(second.might_contain("abc"))
+    assert not asyncio.run(second.might_contain("xyz"))
+
+
+def test_redis_filter_key_follows_layout():
+    assert RedisBloomFilter(1000, 0.01).key != RedisBloomFilter(2000, 0.01).key
+
+
+def test_evicted_redis_filter_is_rebuilt(monkeypatch):
+    server = FakeRedis()
+    monkeypatch.setattr(redis_client, "r", server)
+    codes = ShortCodeFilter("redis", 1000, 0.01, "bloom-test")
+
+    async def scenario():
+        async def load_codes(session_factory, sink):
+            await sink(["abc"])
+            return 1
+        monkeypatch.setattr(codes, "_load_codes", load_codes)
+        await codes.build()
+        assert not await codes.might_contain("xyz")
+        del server.store[codes._filter.key]
+        # gone bitmap: answer "maybe" and rebuild in the background
+        assert await codes.might_contain("xyz")
+        assert not codes.ready
+        await codes._task
+        assert codes.ready
+        assert await codes.might_contain("abc")
+        assert not await codes.might_contain("xyz")
+
+    asyncio.run(scenario())
+
+
+def test_shared_filter_is_rebuilt_after_running_without_it(monkeypatch):
+    server = FakeRedis()
+    monkeypatch.setattr(redis_client, "r", server)
+    codes = ShortCodeFilter("redis", 1000, 0.01, "bloom-test")
+    stored = ["abc"]
+
+    async def load_codes(session_factory, sink):
+        await sink(list(stored))
+        return len(stored)
+
+    async def scenario():
+        monkeypatch.setattr(codes, "_load_codes", load_codes)
+        await codes.build()
+        assert server.ttls[codes._filter.ready_key] == 24 * 3600
+        # a worker with the filter off creates "def", which the bitmap never sees
+        await ShortCodeFilter("off", 1000, 0.01, "bloom-test").retire_shared()
+        stored.append("def")
+        assert await codes.might_contain("def")
+        await codes._task
+        assert codes.ready
+        assert await codes.might_contain("abc") and await codes.might_contain("def")
+        assert not await codes.might_contain("xyz")
+
+    asyncio.run(scenario())
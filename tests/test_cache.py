@@ -0,0 +1,29 @@
+import time
+from cache import LocalCache
+
+
+def test_local_cache_evicts_least_recently_used():
+    local = LocalCache(maxsize=2, ttl=30)
+    local.set("a", 1)
+    local.set("b", 2)
+    assert local.get("a") == 1
+    local.set("c", 3)
+    assert local.get("b") is None
+    assert local.get("a") == 1
+    assert local.get("c") == 3
+    assert local.evictions == 1
+
+
+def test_local_cache_expires_entries():
+    local = LocalCache(maxsize=10, ttl=0.01)
+    local.set("a", 1)
+    time.sleep(0.02)
+    assert local.get("a") is None
+    assert local.stats() == {"size": 0, "hits": 0, "misses": 1, "evictions": 1}
+
+
+def test_local_cache_ttl_never_exceeds_default():
+    local = LocalCache(maxsize=10, ttl=0.01)
+    local.set("a", 1, ttl=3600)
+    time.sleep(0.02)
+    assert local.get("a") is None
@@ -0,0 +1,115 @@
+import asyncio
+import sqlite3
+from datetime import datetime
+from sqlalchemy import Select
+import analytics
+import crud
+import database
+import migrations
+import sweeper
+
+
+def test_sqlite_engine_applies_pragmas(tmp_path):
+    engine = database.build_engine(f"sqlite:///{tmp_path}/pragmas.db")
+
+    async def read_pragmas():
+        async with engine.connect() as conn:
+            values = [(await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                      for name in ("journal_mode", "synchronous", "busy_timeout")]
+        await engine.dispose()
+        return values
+
+    assert asyncio.run(read_pragmas()) == ["wal", 1, database.SQLITE_BUSY_TIMEOUT_MS]
+
+
+def test_replica_sessions_read_the_replica(tmp_path):
+    primary_url = f"sqlite:///{tmp_path}/primary.db"
+    replica_url = f"sqlite:///{tmp_path}/replica.db"
+    migrations.upgrade(primary_url)
+    migrations.upgrade(replica_url)
+    with sqlite3.connect(tmp_path / "replica.db") as conn:
+        conn.execute("INSERT INTO links (original_url, short_code, click_count) VALUES ('http://replica.com/', 'rep1', 0)")
+
+    async def lookup(url):
+        engine = database.build_engine(url)
+        async with database.build_sessionmaker(engine)() as db:
+            link = await crud.get_link_by_code(db, "rep1")
+        await engine.dispose()
+        return link
+
+    assert asyncio.run(lookup(replica_url)).original_url == "http://replica.com/"
+    assert asyncio.run(lookup(primary_url)) is None
+
+
+def test_async_url_picks_async_driver():
+    assert str(database.async_url("sqlite:///./x.db")) == "sqlite+aiosqlite:///./x.db"
+    assert str(database.async_url("postgresql://u@h/db")) == "postgresql+asyncpg://u@h/db"
+    assert str(database.sync_url("sqlite+aiosqlite:///./x.db")) == "sqlite:///./x.db"
+
+
+def test_rollup_upsert_covers_every_backend():
+    from sqlalchemy.dialects import mysql, postgresql, sqlite
+    for name, dialect in (("sqlite", sqlite), ("postgresql", postgresql), ("mysql", mysql)):
+        sql = str(analytics._upsert(name).compile(dialect=dialect.dialect()))
+        assert "click_rollups.count +" in sql
+
+
+class ReadThenPause:
+    # holds a run between reading its batch and writing it back
+    def __init__(self, db):
+        self.db = db
+        self.bind = db.bind
+
+    async def execute(self, statement, *args):
+        result = await self.db.execute(statement, *args)
+        if isinstance(statement, Select):
+            await asyncio.sleep(0.2)
+        return result
+
+    async def commit(self):
+        await self.db.commit()
+
+
+def run_twice_at_once(url, job):
+    async def run():
+        engine = database.build_engine(url)
+        sessions = database.build_sessionmaker(engine)
+
+        async def once():
+            async with sessions() as db:
+                return await job(ReadThenPause(db))
+
+        results = await asyncio.gather(once(), once())
+        await engine.dispose()
+        return results
+
+    return asyncio.run(run())
+
+
+def test_overlapping_rollups_count_each_event_once(tmp_path):
+    url = f"sqlite:///{tmp_path}/rollups.db"
+    migrations.upgrade(url)
+    with sqlite3.connect(tmp_path / "rollups.db") as conn:
+        conn.executemany("INSERT INTO click_events (link_id, bucket_start, count) VALUES (1, ?, 1)",
+                         [("2024-01-01 10:15:00",)] * 10)
+
+    assert sorted(run_twice_at_once(url, analytics.rollup_events)) == [0, 10]
+    with sqlite3.connect(tmp_path / "rollups.db") as conn:
+        counts = conn.execute("SELECT granularity, count FROM click_rollups ORDER BY granularity").fetchall()
+        assert counts == [("day", 10), ("hour", 10), ("minute", 10)]
+        assert conn.execute("SELECT COUNT(*) FROM click_events").fetchone() == (0,)
+
+
+def test_overlapping_sweeps_archive_each_link_once(tmp_path):
+    url = f"sqlite:///{tmp_path}/sweeps.db"
+    migrations.upgrade(url)
+    with sqlite3.connect(tmp_path / "sweeps.db") as conn:
+        conn.executemany("INSERT INTO links (original_url, short_code, click_count, expires_at)"
+                         " VALUES ('http://gone.com/', ?, 0, '2024-01-01 00:00:00')",
+                         [(f"gone{i}",) for i in range(10)])
+
+    swept = run_twice_at_once(url, lambda db: sweeper.sweep_batch(db, datetime(2025, 1, 1), 100, "archive"))
+    assert sorted(len(rows) for rows in swept) == [0, 10]
+    with sqlite3.connect(tmp_path / "sweeps.db") as conn:
+        assert conn.execute("SELECT COUNT(*) FROM archived_links").fetchone() == (10,)
+        assert conn.execute("SELECT COUNT(*) FROM links").fetchone() == (0,)
@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+import cache
+import fastpath
+import tracing
+from main import app
+
+client = TestClient(app)
+
+
+pytestmark = pytest.mark.usefixtures("fake_redis")
+
+
+def both_paths(url, monkeypatch):
+    fast = client.get(url, follow_redirects=False)
+    monkeypatch.setattr(fastpath, "enabled", False)
+    slow = client.get(url, follow_redirects=False)
+    monkeypatch.setattr(fastpath, "enabled", True)
+    return fast, slow
+
+
+def test_cache_hit_matches_handler(monkeypatch):
+    url = "http://fast.example.com/a path?q=1"
+    code = client.post("/links/shorten", json={"original_url": url}).json()["short_code"]
+    client.get(f"/links/{code}", follow_redirects=False)
+    with tracing.capture() as traces:
+        fast, slow = both_paths(f"/links/{code}", monkeypatch)
+    assert fast.status_code == slow.status_code == 307
+    assert fast.headers["location"] == slow.headers["location"]
+    assert fast.content == slow.content == b""
+    tracing.assert_query_budget(traces[0], sql=0, redis=0)
+
+
+def test_cached_errors_match_handler(monkeypatch):
+    client.get("/links/fastmissing", follow_redirects=False)
+    asyncio.run(cache.set_negative("fastgone", cache.EXPIRED))
+    for code, status in (("fastmissing", 404), ("fastgone", 410)):
+        assert asyncio.run(cache.get_link(code))
+        fast, slow = both_paths(f"/links/{code}", monkeypatch)
+        assert fast.status_code == slow.status_code == status
+        assert fast.json() == slow.json()
+        assert fast.headers["content-type"] == slow.headers["content-type"]
+
+
+def test_miss_falls_through_to_handler(fake_redis):
+    code = client.post("/links/shorten", json={"original_url": "http://miss.example.com"}).json()["short_code"]
+    cache.local.clear()
+    fake_redis.store.clear()
+    with tracing.capture() as traces:
+        response = client.get(f"/links/{code}", follow_redirects=False)
+    assert response.status_code == 307
+    # the handler does not repeat the cache read the fast path already made
+    assert [command for command, _ in traces[0].redis].count("GET") == 1
+
+
+def test_static_routes_are_not_taken_as_codes():
+    response = client.get("/links/search", params={"domain": "fast.example.com"})
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
@@ -0,0 +1,38 @@
+import asyncio
+import time
+from hashing import HashingPool, PoolSaturated, hash_password, check_password
+
+
+def test_hash_roundtrip_in_pool():
+    pool = HashingPool(workers=1, max_queue=4)
+    try:
+        hashed = asyncio.run(pool.run(hash_password, "secret"))
+        assert asyncio.run(pool.run(check_password, "secret", hashed))
+        assert not asyncio.run(pool.run(check_password, "wrong", hashed))
+        assert pool.stats()["calls"] == 3
+    finally:
+        pool.shutdown()
+
+
+def test_pool_rejects_when_queue_is_full():
+    pool = HashingPool(workers=0, max_queue=1)
+
+    async def burst():
+        return await asyncio.gather(*(pool.run(time.sleep, 0.05) for _ in range(4)), return_exceptions=True)
+
+    try:
+        results = asyncio.run(burst())
+    finally:
+        pool.shutdown()
+    assert sum(isinstance(result, PoolSaturated) for result in results) == 2
+    assert pool.rejected == 2
+
+
+def test_pool_starts_workers_without_forking_the_server():
+    pool = HashingPool(workers=2, max_queue=4)
+    try:
+        asyncio.run(pool.start())
+        assert pool._executor._mp_context.get_start_method() == "forkserver"
+        assert len(pool._executor._processes) == 2
+    finally:
+        pool.shutdown()
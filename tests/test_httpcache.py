@@ -0,0 +1,99 @@
+import random
+from datetime import datetime, timedelta
+import pytest
+from fastapi.testclient import TestClient
+import cache
+import fastpath
+import httpcache
+from main import app
+from tests.conftest import login
+
+client = TestClient(app)
+
+
+pytestmark = pytest.mark.usefixtures("fake_redis")
+
+
+def test_redirect_policy():
+    now = 1000.0
+    assert httpcache.redirect_policy(None, True, now) == (301, httpcache.PERMANENT_CACHE_CONTROL)
+    assert httpcache.redirect_policy(None, False, now) == (307, httpcache.TEMPORARY_CACHE_CONTROL)
+    assert httpcache.redirect_policy(now + 5, False, now) == (307, "public, max-age=5")
+    assert httpcache.redirect_policy(now - 5, False, now) == (307, "public, max-age=0")
+
+
+def test_etag_matching():
+    etag = httpcache.make_etag(b"body", version=2)
+    assert httpcache.etag_matches(etag, etag)
+    assert httpcache.etag_matches(f'"other", {etag.removeprefix("W/")}', etag)
+    assert httpcache.etag_matches("*", etag)
+    assert not httpcache.etag_matches(httpcache.make_etag(b"body", version=3), etag)
+    assert not httpcache.etag_matches(None, etag)
+
+
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_permanent_and_expiring_redirects(monkeypatch, fast_path):
+    monkeypatch.setattr(fastpath, "enabled", fast_path)
+    permanent = client.post("/links/shorten", json={"original_url": "http://forever.example.com",
+                                                    "permanent": True}).json()["short_code"]
+    expires_at = (datetime.utcnow() + timedelta(seconds=30)).isoformat()
+    expiring = client.post("/links/shorten", json={"original_url": "http://soon.example.com",
+                                                   "expires_at": expires_at}).json()["short_code"]
+    for _ in range(2):
+        # the second round is served from the cache
+        response = client.get(f"/links/{permanent}", follow_redirects=False)
+        assert response.status_code == 301
+        assert response.headers["cache-control"] == httpcache.PERMANENT_CACHE_CONTROL
+        response = client.get(f"/links/{expiring}", follow_redirects=False)
+        assert response.status_code == 307
+        assert 0 <= int(response.headers["cache-control"].split("max-age=")[1]) <= 30
+
+
+def test_permanent_links_cannot_change_and_keep_their_code():
+    response = client.post("/links/shorten", json={"original_url": "http://x.example.com", "permanent": True,
+                                                   "expires_at": datetime.utcnow().isoformat()})
+    assert response.status_code == 400
+    headers = login(client)
+    code = client.post("/links/shorten", json={"original_url": "http://fixed.example.com", "permanent": True},
+                       headers=headers).json()["short_code"]
+    response = client.put(f"/links/{code}", json={"original_url": "http://moved.example.com"}, headers=headers)
+    assert response.status_code == 409
+    assert client.get(f"/links/{code}", follow_redirects=False).status_code == 301
+
+    # deletable, but the code is never handed out again
+    assert client.delete(f"/links/{code}", headers=headers).status_code == 200
+    assert client.get(f"/links/{code}", follow_redirects=False).status_code == 404
+    response = client.post("/links/shorten", json={"original_url": "http://reuse.example.com", "custom_alias": code})
+    assert response.status_code == 400
+    batch = client.post("/links/shorten/batch",
+                        json={"items": [{"original_url": "http://reuse.example.com", "custom_alias": code}]}).json()
+    assert batch[0]["error"] == "Short code already in use"
+
+
+def test_stats_etag_revalidates_until_update():
+    headers = login(client)
+    code = client.post("/links/shorten", json={"original_url": "http://etag.example.com"},
+                       headers=headers).json()["short_code"]
+    first = client.get(f"/links/{code}/stats")
+    etag = first.headers["etag"]
+    assert first.headers["cache-control"] == "no-cache"
+    assert etag.startswith('W/"1-')
+    unchanged = client.get(f"/links/{code}/stats", headers={"If-None-Match": etag})
+    assert unchanged.status_code == 304
+    assert unchanged.content == b""
+
+    client.put(f"/links/{code}", json={"original_url": "http://etag2.example.com"}, headers=headers)
+    changed = client.get(f"/links/{code}/stats", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"].startswith('W/"2-')
+
+
+def test_search_etag_and_cursor():
+    domain = f"etag{random.randint(1000, 9999)}.example.com"
+    client.post("/links/shorten/batch", json={"items": [{"original_url": f"http://{domain}/{i}"} for i in range(3)]})
+    first = client.get("/links/search", params={"domain": domain, "limit": 2})
+    assert len(first.json()) == 2
+    assert "x-next-cursor" in first.headers
+    again = client.get("/links/search", params={"domain": domain, "limit": 2},
+                       headers={"If-None-Match": first.headers["etag"]})
+    assert again.status_code == 304
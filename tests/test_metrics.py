@@ -0,0 +1,45 @@
+from fastapi.testclient import TestClient
+import metrics
+from main import app
+import redis_client
+from tests.fake_redis import FakeRedis
+
+client = TestClient(app)
+
+
+def test_histogram_renders_cumulative_buckets():
+    registry = []
+    latency = metrics.Histogram("op_seconds", "Op latency.", ("op",), buckets=(0.1, 1.0), registry=registry)
+    latency.labels("a").observe(0.05)
+    latency.labels("a").observe(0.5)
+    latency.labels("a").observe(5)
+    text = metrics.render(registry)
+    assert 'op_seconds_bucket{op="a",le="0.1"} 1.0' in text
+    assert 'op_seconds_bucket{op="a",le="1.0"} 2.0' in text
+    assert 'op_seconds_bucket{op="a",le="+Inf"} 3.0' in text
+    assert 'op_seconds_count{op="a"} 3.0' in text
+
+
+def test_counter_escapes_label_values():
+    registry = []
+    errors = metrics.Counter("errors", "Errors.", ("reason",), registry=registry)
+    errors.labels('bad "quote"').inc(2)
+    assert 'errors_total{reason="bad \\"quote\\""} 2.0' in metrics.render(registry)
+
+
+def test_metrics_endpoint_reports_routes_and_queries(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    selects = metrics.sql_queries.labels("SELECT")
+    before = sum(selects.counts)
+    response = client.post("/links/shorten", json={"original_url": "http://metrics.example.com"})
+    code = response.json()["short_code"]
+    client.get(f"/links/{code}", follow_redirects=False)
+    client.get("/links/nope-not-here", follow_redirects=False)
+
+    text = client.get("/metrics").text
+    assert 'http_requests_total{route="/links/{short_code}",method="GET",status="307"}' in text
+    assert 'http_requests_total{route="/links/{short_code}",method="GET",status="404"}' in text
+    assert 'http_request_duration_seconds_count{route="/links/shorten",method="POST"}' in text
+    assert "db_pool_checkout_wait_seconds_count" in text
+    assert 'principal_cache{stat="hits"}' in text
+    assert sum(selects.counts) > before
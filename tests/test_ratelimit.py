@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from redis.exceptions import ConnectionError
+import auth
+import ratelimit
+import redis_client
+from main import app
+from ratelimit import LocalBuckets, RateLimiter, parse_rules, take
+from tests.fake_redis import FakeRedis
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    limiter = RateLimiter(parse_rules("POST /links/shorten 2/60, POST /token 1/60 1"), user_multiplier=2)
+    monkeypatch.setattr(ratelimit, "limiter", limiter)
+    monkeypatch.setattr(ratelimit, "enabled", True)
+    return limiter
+
+
+class BrokenRedis(FakeRedis):
+    # the link cache still works, only the limiter's script calls fail
+    async def script_load(self, script):
+        raise ConnectionError("redis is down")
+
+
+def shorten(headers=None):
+    return client.post("/links/shorten", json={"original_url": "http://limited.example.com"}, headers=headers)
+
+
+def test_parse_rules():
+    rule, = parse_rules("post /links/shorten 30/60 10")
+    assert (rule.method, rule.path, rule.rate, rule.burst) == ("POST", "/links/shorten", 0.5, 10)
+    with pytest.raises(ValueError):
+        parse_rules("POST /links/shorten 30")
+
+
+def test_take_refills_up_to_burst():
+    allowed, tokens, _ = take(None, 0, 0, rate=1, burst=2)
+    assert allowed and tokens == 1
+    allowed, tokens, _ = take(tokens, 0, 0, rate=1, burst=2)
+    allowed, tokens, retry_after = take(tokens, 0, 0.5, rate=1, burst=2)
+    assert not allowed and retry_after == pytest.approx(0.5)
+    assert take(tokens, 0.5, 100, rate=1, burst=2)[1] == 1
+
+
+def test_local_buckets_evict_oldest():
+    buckets = LocalBuckets(2)
+    for key in ("a", "b", "c"):
+        buckets.take(key, 1, 1, now=0)
+    assert buckets.take("a", 1, 1, now=0)[0]
+    assert not buckets.take("c", 1, 1, now=0)[0]
+
+
+def test_limit_returns_429_with_retry_after(limiter):
+    assert [shorten().status_code for _ in range(3)] == [200, 200, 429]
+    rejected = shorten()
+    assert rejected.json() == {"detail": "Too many requests, retry later"}
+    assert 1 <= int(rejected.headers["retry-after"]) <= 30
+    # unlisted routes are not limited
+    assert client.get("/").status_code == 200
+
+
+def test_signed_in_users_get_their_own_bucket(limiter):
+    headers = {"Authorization": f"Bearer {auth.create_access_token({'sub': 'limited-user'})}"}
+    assert [shorten(headers).status_code for _ in range(5)] == [200, 200, 200, 200, 429]
+    assert shorten().status_code == 200
+
+
+def test_falls_back_to_local_buckets_without_redis(limiter, monkeypatch):
+    monkeypatch.setattr(redis_client, "r", BrokenRedis())
+    assert [shorten().status_code for _ in range(3)] == [200, 200, 429]
+    assert limiter.redis_down_until > 0
+
+
+def test_reloads_script_on_a_new_server(limiter, monkeypatch):
+    rule = limiter.rules[("POST", "/token")]
+    assert asyncio.run(limiter.hit(rule, "ip:1"))[0]
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    assert asyncio.run(limiter.hit(rule, "ip:1"))[0]
+    assert not asyncio.run(limiter.hit(rule, "ip:1"))[0]
+
+
+def test_sheds_load_when_too_many_requests_in_flight(limiter):
+    limiter.max_inflight = 1
+    limiter.inflight = 1
+    response = client.get("/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert client.get("/metrics").status_code == 200
@@ -0,0 +1,59 @@
+import asyncio
+from fastapi.testclient import TestClient
+import redis_client
+from redis_client import HashRing, ShardedRedis
+from main import app
+from tests.fake_redis import FakeRedis
+
+client = TestClient(app)
+
+
+def test_ring_spreads_keys_evenly():
+    ring = HashRing(["a", "b", "c"])
+    owners = [ring.node_for(f"link:{i}") for i in range(30000)]
+    for node in ("a", "b", "c"):
+        assert 8000 < owners.count(node) < 12000
+
+
+def test_adding_a_node_moves_few_keys():
+    ring = HashRing(["a", "b", "c"])
+    keys = [f"link:{i}" for i in range(20000)]
+    before = {key: ring.node_for(key) for key in keys}
+    ring.add("d")
+    moved = [key for key in keys if ring.node_for(key) != before[key]]
+    assert all(ring.node_for(key) == "d" for key in moved)
+    assert 0.15 < len(moved) / len(keys) < 0.35
+    ring.remove("d")
+    assert all(ring.node_for(key) == before[key] for key in keys)
+
+
+def test_pipeline_routes_and_keeps_order():
+    nodes = {name: FakeRedis() for name in ("a", "b", "c")}
+    sharded = ShardedRedis(nodes)
+
+    async def run():
+        async with sharded.pipeline() as pipe:
+            for i in range(100):
+                pipe.set(f"link:{i}", str(i), ex=60)
+            await pipe.execute()
+        async with sharded.pipeline() as pipe:
+            for i in range(100):
+                pipe.get(f"link:{i}")
+            return await pipe.execute()
+
+    assert asyncio.run(run()) == [str(i) for i in range(100)]
+    for i in range(100):
+        assert nodes[sharded.ring.node_for(f"link:{i}")].store[f"link:{i}"] == str(i)
+    assert sum(len(node.store) for node in nodes.values()) == 100
+    assert asyncio.run(sharded.delete(*(f"link:{i}" for i in range(50)))) == 50
+
+
+def test_redirects_use_sharded_link_cache(monkeypatch):
+    nodes = {name: FakeRedis() for name in ("a", "b")}
+    monkeypatch.setattr(redis_client, "r", FakeRedis())
+    monkeypatch.setattr(redis_client, "links", ShardedRedis(nodes))
+    code = client.post("/links/shorten", json={"original_url": "http://sharded.example.com"}).json()["short_code"]
+    assert client.get(f"/links/{code}", follow_redirects=False).status_code == 307
+    owner = nodes[redis_client.links.ring.node_for(f"link:{code}")]
+    assert f"link:{code}" in owner.store
+    assert f"link:{code}" not in redis_client.r.store
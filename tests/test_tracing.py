@@ -0,0 +1,48 @@
+import pytest
+from fastapi.testclient import TestClient
+import cache
+import clicks
+import tracing
+from main import app
+
+client = TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def no_inline_flush(fake_redis, monkeypatch):
+    # keep the inline click flush out of the measured requests
+    monkeypatch.setattr(clicks.buffer, "flush_max_events", 10 ** 9)
+
+
+def test_redirect_cache_hit_budget():
+    code = client.post("/links/shorten", json={"original_url": "http://budget.example.com"}).json()["short_code"]
+    client.get(f"/links/{code}", follow_redirects=False)
+    cache.local.clear()
+    with tracing.capture() as traces:
+        redis_hit = client.get(f"/links/{code}", follow_redirects=False)
+        local_hit = client.get(f"/links/{code}", follow_redirects=False)
+    assert redis_hit.status_code == 307
+    tracing.assert_query_budget(traces[0], sql=0, redis=1)
+    tracing.assert_query_budget(traces[1], sql=0, redis=0)
+    assert redis_hit.headers["x-query-count"] == "sql=0;redis=1"
+
+
+def test_budget_failure_lists_statements():
+    with tracing.capture() as traces:
+        client.get("/links/search", params={"domain": "budget.example.com"})
+    assert traces[0].sql_count >= 1
+    with pytest.raises(AssertionError, match="SQL SELECT"):
+        tracing.assert_query_budget(traces[0], sql=0)
+
+
+def test_duplicate_statements_are_reported():
+    trace = tracing.RequestTrace("GET", "/x")
+    for _ in range(3):
+        trace.sql.append(("SELECT * FROM links\n WHERE id = ?", 0.001))
+    trace.sql.append(("SELECT 1", 0.001))
+    assert trace.duplicate_statements() == {"SELECT * FROM links WHERE id = ?": 3}
+
+
+def test_no_header_without_tracing():
+    response = client.get("/")
+    assert "x-query-count" not in response.headers
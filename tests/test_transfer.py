@@ -0,0 +1,97 @@
+import asyncio
+import csv
+import io
+import json
+import time
+from fastapi.testclient import TestClient
+import redis_client
+import transfer
+from main import app
+from tests.conftest import login
+from tests.fake_redis import FakeRedis
+
+client = TestClient(app)
+redis_client.r = FakeRedis()
+
+
+def test_iter_lines_handles_split_characters():
+    async def chunks():
+        data = "first é\nsecond\nthird".encode()
+        for i in range(len(data)):
+            yield data[i:i + 1]
+
+    async def collect():
+        return [line async for line in transfer.iter_lines(chunks())]
+
+    assert asyncio.run(collect()) == ["first é", "second", "third"]
+
+
+
+def test_iter_lines_reports_overlong_lines():
+    async def chunks():
+        data = ("ok\n" + "x" * 50 + "\nnext\n" + "y" * 30).encode()
+        for i in range(0, len(data), 8):
+            yield data[i:i + 8]
+
+    async def collect():
+        return [line async for line in transfer.iter_lines(chunks(), max_length=20)]
+
+    assert asyncio.run(collect()) == ["ok", None, "next", None]
+
+    async def records():
+        progress = transfer.Progress("Imported")
+        data = [b'{"original_url": "https://example.com"}\n', b'{"a": "' + b"x" * (70 * 1024) + b'"}\n']
+        parsed = [line_no async for line_no, _ in transfer.parse_records(_aiter(data), "ndjson", progress)]
+        return parsed, progress.errors
+
+    parsed, errors = asyncio.run(records())
+    assert parsed == [1]
+    assert errors == [{"line": 2, "error": f"Line longer than {transfer.IMPORT_MAX_LINE_LENGTH} characters"}]
+
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+def test_export_then_import_round_trip():
+    source = login(client)
+    items = [{"original_url": f"http://export.com/{i}", "permanent": i == 0} for i in range(5)]
+    client.post("/links/shorten/batch", json={"items": items}, headers=source)
+
+    exported = client.get("/links/export", headers=source)
+    assert exported.headers["content-type"].startswith("application/x-ndjson")
+    records = [json.loads(line) for line in exported.text.splitlines()]
+    assert len(records) == 5 and all(record["click_count"] == 0 for record in records)
+
+    suffix = str(int(time.time() * 1000))
+    moved = [{**record, "short_code": f"{record['short_code']}{suffix}", "click_count": 7} for record in records]
+    body = "\n".join(json.dumps(record) for record in moved + records[:1]) + "\n{broken\n"
+    target = login(client)
+    response = client.post("/links/import", content=body.encode(), headers=target)
+    assert response.status_code == 200, response.text
+    summary = response.json()
+    assert summary["imported"] == 5
+    assert summary["failed"] == 2
+    assert {error["error"] for error in summary["errors"]} == {"Short code already in use", "Unparseable ndjson row"}
+
+    csv_export = client.get("/links/export", params={"format": "csv"}, headers=target)
+    rows = list(csv.DictReader(io.StringIO(csv_export.text)))
+    assert {row["short_code"] for row in rows} == {record["short_code"] for record in moved}
+    assert all(row["click_count"] == "7" for row in rows)
+    assert sorted(row["permanent"] for row in rows) == ["False"] * 4 + ["True"]
+    for record in moved:
+        redirect = client.get(f"/links/{record['short_code']}", follow_redirects=False)
+        assert redirect.status_code == (301 if record["permanent"] else 307)
+
+
+def test_cli_import_csv(tmp_path, capsys):
+    suffix = str(int(time.time() * 1000))
+    path = tmp_path / "links.csv"
+    path.write_text("short_code,original_url,click_count\n"
+                    f"cli{suffix},http://cli.com/a,3\n"
+                    ",http://cli.com/b,\n"
+                    "bad,not a url,\n")
+    assert transfer.main(["import", str(path), "--format", "csv", "--chunk-size", "1"]) == 1
+    summary = json.loads(capsys.readouterr().out)
+    assert summary["imported"] == 2
+    assert summary["errors"] == [{"line": 4, "error": "Invalid link"}]
@@ -1,5 +1,5 @@
 import pytest
-from utils import generate_short_code
+from utils import generate_short_code, encode_base62, permute
 from crud import normalize_url
 
 def test_generate_short_code_length():
@@ -17,4 +17,19 @@ def test_normalize_url():
     url2 = "http://example.com/"
     normalized1 = normalize_url(url1)
     normalized2 = normalize_url(url2)
-    assert normalized1 == normalized2
\ No newline at end of file
+    assert normalized1 == normalized2
+
+def test_encode_base62_is_fixed_width():
+    assert encode_base62(0, 6) == "aaaaaa"
+    assert len(encode_base62(62 ** 6 - 1, 6)) == 6
+    with pytest.raises(ValueError):
+        encode_base62(62 ** 6, 6)
+
+def test_permute_is_a_bijection():
+    domain = 62 ** 2
+    outputs = {permute(n, domain, b"key") for n in range(domain)}
+    assert outputs == set(range(domain))
+
+def test_permute_depends_on_key():
+    domain = 62 ** 6
+    assert [permute(n, domain, b"a") for n in range(10)] != [permute(n, domain, b"b") for n in range(10)]
\ No newline at end of file
@@ -0,0 +1,57 @@
+from datetime import date
+import asyncio
+from visitors import HyperLogLog, MemoryVisitorCounter
+
+
+def test_hyperloglog_estimate_is_close():
+    sketch = HyperLogLog()
+    for i in range(20000):
+        sketch.add(f"visitor-{i}")
+    assert abs(sketch.count() - 20000) < 20000 * 0.03
+
+
+def test_hyperloglog_small_counts_are_exact_enough():
+    sketch = HyperLogLog()
+    for value in ("a", "b", "c", "a"):
+        sketch.add(value)
+    assert sketch.count() == 3
+
+
+def test_hyperloglog_merge_is_a_union():
+    first, second = HyperLogLog(), HyperLogLog()
+    for i in range(5000):
+        first.add(str(i))
+    for i in range(2500, 7500):
+        second.add(str(i))
+    assert abs(first.merge(second).count() - 7500) < 7500 * 0.03
+
+
+def test_memory_counter_merges_days():
+    counter = MemoryVisitorCounter(retention_days=36500)
+    counter.add(1, "x", day=date(2024, 1, 1))
+    counter.add(1, "y", day=date(2024, 1, 2))
+    counter.add(1, "x", day=date(2024, 1, 3))
+    counter.add(2, "z", day=date(2024, 1, 2))
+    assert asyncio.run(counter.count(1, date(2024, 1, 1), date(2024, 1, 3))) == 2
+    assert asyncio.run(counter.count(1, date(2024, 1, 2), date(2024, 1, 2))) == 1
+
+
+def test_hyperloglog_stays_sparse_until_it_pays_to_densify():
+    sketch = HyperLogLog()
+    for i in range(100):
+        sketch.add(f"visitor-{i}")
+    assert sketch.registers is None and sketch.count() == 100
+    dense = HyperLogLog()
+    for i in range(5000):
+        dense.add(f"visitor-{i}")
+    assert dense.registers is not None
+    assert abs(HyperLogLog().merge(sketch).merge(dense).count() - 5000) < 5000 * 0.03
+
+
+def test_memory_counter_caps_its_sketches():
+    counter = MemoryVisitorCounter(retention_days=36500, max_sketches=2)
+    for link_id in (1, 2, 3):
+        counter.add(link_id, "x", day=date(2024, 1, 1))
+    assert len(counter._sketches) == 2
+    assert asyncio.run(counter.count(1, date(2024, 1, 1), date(2024, 1, 1))) == 0
+    assert asyncio.run(counter.count(3, date(2024, 1, 1), date(2024, 1, 1))) == 1
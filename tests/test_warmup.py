@@ -0,0 +1,34 @@
+import asyncio
+import json
+import pytest
+import cache
+import redis_client
+import warmup
+
+
+pytestmark = pytest.mark.usefixtures("fake_redis")
+
+
+def test_first_worker_fills_redis_and_publishes_codes():
+    warmer = warmup.CacheWarmer("clicks", 5, 24, 5000, 300)
+    assert asyncio.run(warmer.run()) > 0
+    codes = redis_client.r.store[warmup.WARMUP_CODES_KEY]
+    assert len(cache.local) == warmer.loaded
+    for code in json.loads(codes):
+        assert f"link:{code}" in redis_client.r.store
+
+
+def test_other_workers_copy_from_redis():
+    first = warmup.CacheWarmer("clicks", 5, 24, 5000, 300)
+    asyncio.run(first.run())
+    cache.local.clear()
+    second = warmup.CacheWarmer("clicks", 5, 24, 5000, 300, session_factory=None)
+    assert asyncio.run(second.run()) == first.loaded
+    assert len(cache.local) == first.loaded
+
+
+def test_warmup_gives_up_after_timeout():
+    redis_client.r.store[warmup.WARMUP_LOCK_KEY] = "1"
+    warmer = warmup.CacheWarmer("rollups", 5, 24, 50, 300)
+    assert asyncio.run(warmer.run()) == 0
+    assert warmer.seconds >= 0.05
@@ -0,0 +1,118 @@
+import contextvars
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from config import QUERY_TRACE_ENABLED, QUERY_TRACE_HEADER, QUERY_TRACE_DUPLICATE_THRESHOLD
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("request_trace", default=None)
+_captures = []
+
+
+# Every SQL statement and Redis command issued while handling one request.
+class RequestTrace:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.sql = []
+        self.redis = []
+
+    @property
+    def sql_count(self) -> int:
+        return len(self.sql)
+
+    @property
+    def redis_count(self) -> int:
+        return len(self.redis)
+
+    @property
+    def sql_seconds(self) -> float:
+        return sum(elapsed for _, elapsed in self.sql)
+
+    @property
+    def redis_seconds(self) -> float:
+        return sum(elapsed for _, elapsed in self.redis)
+
+    def duplicate_statements(self) -> dict:
+        counts = Counter(" ".join(statement.split()) for statement, _ in self.sql)
+        return {statement: count for statement, count in counts.items() if count > 1}
+
+    def header(self) -> str:
+        return f"sql={self.sql_count};redis={self.redis_count}"
+
+    def summary(self) -> str:
+        lines = [f"{self.method} {self.path}: {self.sql_count} SQL in {self.sql_seconds * 1000:.1f}ms, "
+                 f"{self.redis_count} Redis in {self.redis_seconds * 1000:.1f}ms"]
+        lines.extend(f"  SQL {statement}" for statement, _ in self.sql)
+        lines.extend(f"  Redis {command}" for command, _ in self.redis)
+        return "\n".join(lines)
+
+
+def record_sql(statement: str, elapsed: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.sql.append((statement, elapsed))
+
+
+def record_redis(command: str, elapsed: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.redis.append((command, elapsed))
+
+
+# Test helper: traces every request while the block runs and collects them.
+@contextmanager
+def capture():
+    traces = []
+    _captures.append(traces)
+    try:
+        yield traces
+    finally:
+        _captures.remove(traces)
+
+
+def assert_query_budget(trace: RequestTrace, sql: int = None, redis: int = None):
+    if (sql is not None and trace.sql_count > sql) or (redis is not None and trace.redis_count > redis):
+        raise AssertionError(f"Query budget sql={sql} redis={redis} exceeded by\n{trace.summary()}")
+
+
+def _finish(trace: RequestTrace):
+    for traces in _captures:
+        traces.append(trace)
+    duplicates = {statement: count for statement, count in trace.duplicate_statements().items()
+                  if count >= QUERY_TRACE_DUPLICATE_THRESHOLD}
+    if duplicates:
+        logger.warning("Possible N+1 in %s %s: %s", trace.method, trace.path,
+                       "; ".join(f"{count}x {statement}" for statement, count in duplicates.items()))
+    logger.info("%s %s: %d SQL (%.1fms, %d duplicated), %d Redis (%.1fms)", trace.method, trace.path,
+                trace.sql_count, trace.sql_seconds * 1000, len(trace.duplicate_statements()),
+                trace.redis_count, trace.redis_seconds * 1000)
+
+
+# Opt-in via QUERY_TRACE_ENABLED (or tracing.capture() in tests); when off
+# it costs one check per request.
+class QueryTraceMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (QUERY_TRACE_ENABLED or _captures):
+            await self.app(scope, receive, send)
+            return
+        trace = RequestTrace(scope["method"], scope["path"])
+        token = _current.set(trace)
+
+        async def send_with_counts(message):
+            if message["type"] == "http.response.start" and QUERY_TRACE_HEADER:
+                headers = list(message.get("headers", []))
+                headers.append((b"x-query-count", trace.header().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_counts)
+        finally:
+            _current.reset(token)
+            _finish(trace)
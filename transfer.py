@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import codecs
+import csv
+import io
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+
+from pydantic import ValidationError
+
+import bloom
+import cache
+import crud
+import migrations
+from config import IMPORT_CHUNK_SIZE, IMPORT_MAX_LINE_LENGTH, EXPORT_BATCH_SIZE, TRANSFER_PROGRESS_EVERY
+from database import SessionLocal, ReplicaSessionLocal
+from schemas import LinkCreate
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+EXPORT_FIELDS = ("short_code", "original_url", "created_at", "expires_at", "last_accessed", "click_count",
+                 "permanent")
+MAX_REPORTED_ERRORS = 100
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class Progress:
+    def __init__(self, action: str, log_every: int = TRANSFER_PROGRESS_EVERY):
+        self.action = action
+        self.log_every = log_every
+        self.rows = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.monotonic()
+        self._next_log = log_every
+
+    @property
+    def seconds(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def add(self, rows: int):
+        self.rows += rows
+        if self.rows >= self._next_log:
+            logger.info("%s %d links so far (%.0f rows/s)", self.action, self.rows, self.rate)
+            self._next_log = (self.rows // self.log_every + 1) * self.log_every
+
+    def fail(self, line: int, error: str):
+        self.failed += 1
+        # keep memory flat on a file full of bad rows
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": error})
+
+    def finish(self):
+        logger.info("%s %d links (%d failed) in %.1fs, %.0f rows/s",
+                    self.action, self.rows, self.failed, self.seconds, self.rate)
+
+    def summary(self) -> dict:
+        return {
+            "imported": self.rows,
+            "failed": self.failed,
+            "seconds": round(self.seconds, 3),
+            "rows_per_second": round(self.rate, 1),
+            "errors": self.errors,
+        }
+
+
+def _format_value(value):
+    if value is None:
+        return None
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _format_ndjson(rows) -> str:
+    return "".join(
+        json.dumps({field: _format_value(getattr(row, field)) for field in EXPORT_FIELDS}) + "\n" for row in rows
+    )
+
+
+def _format_csv(rows) -> str:
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerows([_format_value(getattr(row, field)) for field in EXPORT_FIELDS] for row in rows)
+    return out.getvalue()
+
+
+async def export_links(fmt: str, owner_id: int = None, session_factory=ReplicaSessionLocal,
+                       batch_size: int = EXPORT_BATCH_SIZE, progress: Progress = None):
+    progress = progress or Progress("Exported")
+    formatter = _format_csv if fmt == "csv" else _format_ndjson
+    if fmt == "csv":
+        yield ",".join(EXPORT_FIELDS) + "\n"
+    async with session_factory() as db:
+        if owner_id is None:
+            batches = crud.stream_all_links(db, batch_size)
+        else:
+            batches = crud.stream_user_links(db, owner_id, batch_size=batch_size)
+        async for rows in batches:
+            yield formatter(rows)
+            progress.add(len(rows))
+    progress.finish()
+
+
+# Yields None in place of a line longer than `max_length` characters. The
+# rest of such a line is skipped as it arrives instead of being buffered.
+async def iter_lines(chunks, max_length: int = IMPORT_MAX_LINE_LENGTH):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    overlong = False
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield None if overlong or len(line) > max_length else line
+            overlong = False
+        if len(pending) > max_length:
+            pending, overlong = "", True
+    pending += decoder.decode(b"", final=True)
+    if overlong or pending:
+        yield None if overlong or len(pending) > max_length else pending
+
+
+# Yields (line number, record) pairs, skipping blank lines. CSV rows are
+# parsed one line at a time, so quoted fields may not contain newlines.
+async def parse_records(chunks, fmt: str, progress: Progress):
+    header = None
+    line_no = 0
+    async for line in iter_lines(chunks):
+        line_no += 1
+        if line is None:
+            progress.fail(line_no, f"Line longer than {IMPORT_MAX_LINE_LENGTH} characters")
+            continue
+        line = line.rstrip("\r")
+        if not line.strip():
+            continue
+        try:
+            if fmt == "ndjson":
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("not an object")
+            elif header is None:
+                header = next(csv.reader([line]))
+                continue
+            else:
+                record = dict(zip(header, next(csv.reader([line]))))
+        except ValueError:
+            progress.fail(line_no, f"Unparseable {fmt} row")
+            continue
+        yield line_no, record
+
+
+def _parse_datetime(value):
+    if value in (None, ""):
+        return None
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def _parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes")
+    return bool(value)
+
+
+def _link_from_record(record: dict):
+    # an exported short code is imported like a custom alias: kept as is, or
+    # reported when it is already taken here
+    link_in = LinkCreate(
+        original_url=crud.normalize_url(str(record["original_url"])),
+        custom_alias=record.get("short_code") or None,
+        expires_at=record.get("expires_at") or None,
+        permanent=_parse_bool(record.get("permanent")),
+    )
+    extra = {
+        "created_at": _parse_datetime(record.get("created_at")) or datetime.utcnow(),
+        "last_accessed": _parse_datetime(record.get("last_accessed")),
+        "click_count": int(record.get("click_count") or 0),
+    }
+    return link_in, extra
+
+
+async def _import_chunk(chunk: list, owner_id: int, session_factory, progress: Progress):
+    links_in, extras, line_numbers = [], [], []
+    for line_no, record in chunk:
+        try:
+            link_in, extra = _link_from_record(record)
+        except (KeyError, TypeError, ValueError, ValidationError):
+            progress.fail(line_no, "Invalid link")
+            continue
+        links_in.append(link_in)
+        extras.append(extra)
+        line_numbers.append(line_no)
+    if not links_in:
+        return
+    try:
+        async with session_factory() as db:
+            results = await crud.create_links_bulk(db, links_in, owner_id, extra=extras)
+    except crud.ShortCodeTaken:
+        for line_no in line_numbers:
+            progress.fail(line_no, "Short codes changed during the import, retry these rows")
+        return
+    created = []
+    for line_no, (link, error) in zip(line_numbers, results):
+        if link is None:
+            progress.fail(line_no, error)
+        else:
+            created.append(link.short_code)
+    progress.add(len(created))
+    if created:
+        try:
+            await cache.invalidate_links(created)
+            await bloom.codes.add(created)
+        except Exception:
+            logger.exception("Could not publish imported short codes")
+
+
+# Reads the stream incrementally and commits every `chunk_size` rows as one
+# bulk insert, so memory stays flat however large the input is.
+async def import_links(chunks, fmt: str, owner_id: int = None, session_factory=SessionLocal,
+                       chunk_size: int = IMPORT_CHUNK_SIZE, progress: Progress = None):
+    progress = progress or Progress("Imported")
+    chunk = []
+    async for record in parse_records(chunks, fmt, progress):
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            await _import_chunk(chunk, owner_id, session_factory, progress)
+            chunk = []
+    if chunk:
+        await _import_chunk(chunk, owner_id, session_factory, progress)
+    progress.finish()
+    return progress
+
+
+async def _read_file(f):
+    while True:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _export_to(out, fmt: str, owner_id: int):
+    async for text in export_links(fmt, owner_id):
+        out.write(text)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk export and import of links")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write links with their stats")
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--owner-id", type=int, help="only this user's links")
+    export_parser.add_argument("--output", default="-", help="file to write, - for stdout")
+    import_parser = commands.add_parser("import", help="load links from an export")
+    import_parser.add_argument("input", help="file to read, - for stdin")
+    import_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    import_parser.add_argument("--owner-id", type=int, help="assign the imported links to this user")
+    import_parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    migrations.upgrade()
+
+    if args.command == "export":
+        if args.output == "-":
+            asyncio.run(_export_to(sys.stdout, args.format, args.owner_id))
+        else:
+            with open(args.output, "w", newline="") as out:
+                asyncio.run(_export_to(out, args.format, args.owner_id))
+        return 0
+
+    source = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+    try:
+        progress = asyncio.run(import_links(_read_file(source), args.format, args.owner_id,
+                                            chunk_size=args.chunk_size))
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    json.dump(progress.summary(), sys.stdout, indent=2)
+    print()
+    return 1 if progress.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
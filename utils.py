@@ -1,6 +1,48 @@
+import hashlib
 import random
 import string
+from urllib.parse import urlsplit
+
+BASE62_ALPHABET = string.ascii_letters + string.digits
 
 def generate_short_code(length: int = 6):
     characters = string.ascii_letters + string.digits
-    return ''.join(random.choices(characters, k=length))
\ No newline at end of file
+    return ''.join(random.choices(characters, k=length))
+
+def encode_base62(number: int, width: int) -> str:
+    chars = []
+    for _ in range(width):
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    if number:
+        raise ValueError("number does not fit in the requested width")
+    return ''.join(reversed(chars))
+
+def _feistel(number: int, half_bits: int, key: bytes, rounds: int) -> int:
+    mask = (1 << half_bits) - 1
+    left, right = number >> half_bits, number & mask
+    for round_no in range(rounds):
+        digest = hashlib.blake2b(right.to_bytes(8, "big"), key=key, digest_size=8, person=bytes([round_no])).digest()
+        left, right = right, left ^ (int.from_bytes(digest, "big") & mask)
+    return (left << half_bits) | right
+
+def permute(number: int, domain: int, key: bytes, rounds: int = 4) -> int:
+    # keyed bijection on [0, domain): a balanced Feistel network over the
+    # smallest even bit width covering the domain, cycle-walking until the
+    # result lands back inside it
+    if not 0 <= number < domain:
+        raise ValueError("number out of range")
+    half_bits = ((domain - 1).bit_length() + 1) // 2
+    number = _feistel(number, half_bits, key, rounds)
+    while number >= domain:
+        number = _feistel(number, half_bits, key, rounds)
+    return number
+
+def url_hash(url: str) -> str:
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def url_domain(url: str) -> str:
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:
+        return ""
\ No newline at end of file
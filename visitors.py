@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import logging
+import math
+from datetime import date, datetime, timedelta
+
+import redis_client
+from config import (SECRET_KEY, CLICK_FLUSH_INTERVAL_MS, VISITOR_HLL_BACKEND, VISITOR_HLL_RETENTION_DAYS,
+                    VISITOR_HLL_MEMORY_MAX_SKETCHES)
+
+logger = logging.getLogger(__name__)
+
+_FINGERPRINT_KEY = hashlib.blake2b(SECRET_KEY.encode(), digest_size=32).digest()
+
+
+def visitor_fingerprint(client_ip: str, user_agent: str) -> str:
+    # keyed so stored fingerprints cannot be brute-forced back to an IP
+    data = f"{client_ip or ''}|{user_agent or ''}".encode()
+    return hashlib.blake2b(data, key=_FINGERPRINT_KEY, digest_size=16).hexdigest()
+
+
+# Starts sparse, holding only the registers that were set, and switches to
+# the dense `size` byte array once that stops being the smaller of the two.
+# Most links see a handful of visitors a day, so most sketches stay sparse.
+class HyperLogLog:
+    def __init__(self, precision: int = 14):
+        self.precision = precision
+        self.size = 1 << precision
+        # a dict entry costs roughly 64 bytes against one byte per dense register
+        self.sparse_limit = self.size // 64
+        self.sparse = {}
+        self.registers = None
+
+    def _densify(self):
+        self.registers = bytearray(self.size)
+        for index, rank in self.sparse.items():
+            self.registers[index] = rank
+        self.sparse = None
+
+    def add(self, value) -> bool:
+        if isinstance(value, str):
+            value = value.encode()
+        hashed = int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "big")
+        index = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if self.registers is None:
+            if rank <= self.sparse.get(index, 0):
+                return False
+            self.sparse[index] = rank
+            if len(self.sparse) > self.sparse_limit:
+                self._densify()
+            return True
+        if rank <= self.registers[index]:
+            return False
+        self.registers[index] = rank
+        return True
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLogs of different precision")
+        if self.registers is None and other.registers is None:
+            for index, rank in other.sparse.items():
+                if rank > self.sparse.get(index, 0):
+                    self.sparse[index] = rank
+            if len(self.sparse) > self.sparse_limit:
+                self._densify()
+            return self
+        if self.registers is None:
+            self._densify()
+        if other.registers is None:
+            for index, rank in other.sparse.items():
+                if rank > self.registers[index]:
+                    self.registers[index] = rank
+        else:
+            self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self) -> int:
+        if self.registers is None:
+            zeros = self.size - len(self.sparse)
+            harmonic = zeros + sum(2.0 ** -register for register in self.sparse.values())
+        else:
+            zeros = self.registers.count(0)
+            harmonic = sum(2.0 ** -register for register in self.registers)
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / harmonic
+        if estimate <= 2.5 * self.size and zeros:
+            return round(self.size * math.log(self.size / zeros))
+        return round(estimate)
+
+
+def _days(start: date, end: date):
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def hll_prefix(link_id: int) -> str:
+    return f"visitors:{link_id}:"
+
+
+def hll_key(link_id: int, day: date) -> str:
+    return hll_prefix(link_id) + day.isoformat()
+
+
+# One HyperLogLog per link per day; range queries merge the daily sketches.
+class RedisVisitorCounter:
+    def __init__(self, retention_days: int, flush_interval_ms: int):
+        self.retention = timedelta(days=retention_days)
+        self.flush_interval = flush_interval_ms / 1000
+        self._pending = {}
+        self._stopping = None
+        self._task = None
+
+    def add(self, link_id: int, fingerprint: str, day: date = None):
+        key = hll_key(link_id, day or datetime.utcnow().date())
+        self._pending.setdefault(key, set()).add(fingerprint)
+
+    def forget(self, link_ids):
+        # stored sketches of removed links are never read again (link ids are
+        # not reused) and expire with the retention TTL
+        prefixes = tuple(hll_prefix(link_id) for link_id in link_ids)
+        for key in [key for key in self._pending if key.startswith(prefixes)]:
+            del self._pending[key]
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            async with redis_client.r.pipeline(transaction=False) as pipe:
+                for key, fingerprints in pending.items():
+                    pipe.pfadd(key, *fingerprints)
+                    pipe.expire(key, int(self.retention.total_seconds()))
+                await pipe.execute()
+        except Exception:
+            logger.exception("Dropped %d visitor sketches updates", len(pending))
+
+    async def count(self, link_id: int, start: date, end: date) -> int:
+        await self.flush()
+        start = max(start, datetime.utcnow().date() - self.retention)
+        keys = [hll_key(link_id, day) for day in _days(start, end)]
+        if not keys:
+            return 0
+        try:
+            return await redis_client.r.pfcount(*keys)
+        except Exception:
+            logger.exception("Could not read visitor sketches for link %s", link_id)
+            return None
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self):
+        if self._task is not None:
+            return
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopping.set()
+        await self._task
+        self._task = None
+
+
+# Per-worker fallback for deployments without Redis. Past `max_sketches` the
+# oldest sketches are dropped, so their days undercount instead of the worker
+# growing without bound.
+class MemoryVisitorCounter:
+    def __init__(self, retention_days: int, max_sketches: int = VISITOR_HLL_MEMORY_MAX_SKETCHES):
+        self.retention = timedelta(days=retention_days)
+        self.max_sketches = max_sketches
+        self._sketches = {}
+
+    def add(self, link_id: int, fingerprint: str, day: date = None):
+        key = hll_key(link_id, day or datetime.utcnow().date())
+        sketch = self._sketches.get(key)
+        if sketch is None:
+            self._prune()
+            while self._sketches and len(self._sketches) >= self.max_sketches:
+                del self._sketches[next(iter(self._sketches))]
+            sketch = self._sketches[key] = HyperLogLog()
+        sketch.add(fingerprint)
+
+    def forget(self, link_ids):
+        prefixes = tuple(hll_prefix(link_id) for link_id in link_ids)
+        for key in [key for key in self._sketches if key.startswith(prefixes)]:
+            del self._sketches[key]
+
+    def _prune(self):
+        oldest = hll_key(0, datetime.utcnow().date() - self.retention).rsplit(":", 1)[1]
+        for key in [key for key in self._sketches if key.rsplit(":", 1)[1] < oldest]:
+            del self._sketches[key]
+
+    async def count(self, link_id: int, start: date, end: date) -> int:
+        merged = HyperLogLog()
+        for day in _days(start, end):
+            sketch = self._sketches.get(hll_key(link_id, day))
+            if sketch is not None:
+                merged.merge(sketch)
+        return merged.count()
+
+    async def flush(self):
+        pass
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+def build_counter(backend: str = VISITOR_HLL_BACKEND):
+    if backend == "redis":
+        return RedisVisitorCounter(VISITOR_HLL_RETENTION_DAYS, CLICK_FLUSH_INTERVAL_MS)
+    if backend == "memory":
+        return MemoryVisitorCounter(VISITOR_HLL_RETENTION_DAYS)
+    raise ValueError(f"Unknown visitor counter backend: {backend}")
+
+
+counter = build_counter()
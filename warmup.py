@@ -0,0 +1,79 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+
+import analytics
+import cache
+import crud
+import redis_client
+from config import (CACHE_WARMUP_SOURCE, CACHE_WARMUP_SIZE, CACHE_WARMUP_WINDOW_HOURS, CACHE_WARMUP_TIMEOUT_MS,
+                    CACHE_WARMUP_LOCK_TTL)
+from database import ReplicaSessionLocal
+
+logger = logging.getLogger(__name__)
+
+WARMUP_LOCK_KEY = "warmup:lock"
+WARMUP_CODES_KEY = "warmup:codes"
+
+
+# Preloads the hottest links after a deploy. The first worker to take the
+# lock reads them from the database and writes Redis; the others only copy
+# the published code list from Redis into their local cache.
+class CacheWarmer:
+    def __init__(self, source: str, size: int, window_hours: int, timeout_ms: int, lock_ttl: int,
+                 session_factory=ReplicaSessionLocal):
+        if source not in ("off", "clicks", "rollups"):
+            raise ValueError(f"Unknown cache warm-up source: {source}")
+        self.source = source
+        self.size = size
+        self.window = timedelta(hours=window_hours)
+        self.timeout = timeout_ms / 1000
+        self.lock_ttl = lock_ttl
+        self.session_factory = session_factory
+        self.loaded = 0
+        self.seconds = None
+
+    async def _hot_links(self):
+        async with self.session_factory() as db:
+            if self.source == "rollups":
+                link_ids = await analytics.hot_link_ids(db, datetime.utcnow() - self.window, self.size)
+                links = {link.id: link for link in await crud.get_links_by_ids(db, link_ids)}
+                return [links[link_id] for link_id in link_ids if link_id in links]
+            return await crud.top_links_by_clicks(db, self.size)
+
+    async def _published_codes(self, poll_interval: float = 0.05):
+        while True:
+            codes = await redis_client.r.get(WARMUP_CODES_KEY)
+            if codes is not None:
+                return json.loads(codes)
+            await asyncio.sleep(poll_interval)
+
+    async def _warm(self) -> int:
+        if await redis_client.r.set(WARMUP_LOCK_KEY, "1", nx=True, ex=self.lock_ttl):
+            links = await self._hot_links()
+            loaded = await cache.set_links(links)
+            await redis_client.r.set(WARMUP_CODES_KEY, json.dumps([link.short_code for link in links]),
+                                     ex=self.lock_ttl)
+            return loaded
+        codes = await self._published_codes()
+        return await cache.load_local(codes[:cache.local.maxsize])
+
+    async def run(self) -> int:
+        if self.source == "off" or self.size <= 0:
+            return 0
+        started = time.monotonic()
+        try:
+            self.loaded = await asyncio.wait_for(self._warm(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Cache warm-up timed out after %.1fs, starting with a cold cache", self.timeout)
+        except Exception:
+            logger.exception("Cache warm-up failed, starting with a cold cache")
+        self.seconds = time.monotonic() - started
+        logger.info("Cache warm-up loaded %d links in %.2fs", self.loaded, self.seconds)
+        return self.loaded
+
+
+warmer = CacheWarmer(CACHE_WARMUP_SOURCE, CACHE_WARMUP_SIZE, CACHE_WARMUP_WINDOW_HOURS, CACHE_WARMUP_TIMEOUT_MS,
+                     CACHE_WARMUP_LOCK_TTL)